@@ -12,6 +12,7 @@ import numpy as np
 
 from ntg_common import db_tools
 from ntg_common.db_tools import execute, executemany, executemany_raw
+from ntg_common.interval_index import PassageRangeIndex
 from ntg_common.tools import log
 
 
@@ -121,15 +122,14 @@ def create_labez_matrix (dba, parameters, val):
 
         # get no. of ranges
         Range = collections.namedtuple ('Range', 'rg_id range start end')
-        res = execute (conn, """
-        SELECT rg_id, range, MIN (pass_id) - 1 AS first_id, MAX (pass_id) AS last_id
-        FROM ranges ch
-        JOIN passages p ON ch.passage @> p.passage
-        GROUP BY rg_id, range
-        ORDER BY lower (ch.passage), upper (ch.passage) DESC
-        """, parameters)
-        val.n_ranges = res.rowcount
-        val.ranges = list (map (Range._make, res))
+        index = PassageRangeIndex.load (conn)
+        val.ranges = []
+        for rg_id in index.ranges.ids.tolist ():
+            pass_ids = index.passages_of_range (rg_id)
+            if len (pass_ids):
+                val.ranges.append (Range (rg_id, index.range_names[rg_id][1],
+                                          int (pass_ids[0]) - 1, int (pass_ids[-1])))
+        val.n_ranges = len (val.ranges)
         log (logging.INFO, '  No. of ranges: ' + str (val.n_ranges))
 
         # Matrix ms x pass
@@ -612,3 +612,94 @@ def write_affinity_table (dba, parameters, val):
         log (logging.DEBUG, "ancestor:"  + str (val.ancestor_matrix))
         log (logging.DEBUG, "unclear:"   + str (val.unclear_ancestor_matrix))
         log (logging.DEBUG, "and:"       + str (val.and_matrix))
+
+
+def update_congruence_table (conn, parameters, pass_id = None):
+    """Rewrite the congruence table for one passage or for all passages.
+
+    "Das Prüfprogramm soll eine Inkongruenz anzeigen, wenn der Zeuge einer Lesart
+    x, die im lokalen Stemma von y abhängt UND (bei x keinen pV mit Conn <= 5
+    hat ODER bei y keinen pV mit höherem Rang hat als ein weiterer pV bei einer
+    anderen Variante), nicht mit x ODER x(n) der Quelle "?" zugeordnet wird."
+    -- email K. Wachtel 16.01.2020
+
+    Wenn Lesart x im lokalen Stemma von y != ? abhängt, muß jeder Zeuge der
+    Lesart x:
+
+    1. einen pV(conn=5) der Lesart x haben, oder
+
+    2. der höchste pV(!= zz) die Lesart y haben.
+
+    Wenn Lesart x im lokalen Stemma von ? abhängt, ist keine Aussage möglich.
+
+    The potential ancestors are ranked in the 'All' range of the passage's book.
+    Call this after the affinity table was rewritten and after every change to
+    the local stemma or the cliques of a passage.
+
+    :param int pass_id: The passage to refresh or None for all passages.
+
+    """
+
+    where = 'AND pr.pass_id = :pass_id' if pass_id is not None else ''
+    params = dict (parameters, pass_id = pass_id, where = where, connectivity = 5, exclude = (2,))
+
+    execute (conn, """
+    DELETE FROM congruence
+    WHERE :pass_id IS NULL OR pass_id = :pass_id
+    """, params)
+
+    execute (conn, """
+    -- get the closest ancestors ms1 for every manuscript ms2
+    WITH ranks AS (
+      SELECT
+        q2.pass_id,
+        aff.ms_id1,
+        aff.ms_id2,
+        labez_clique (q1.labez, q1.clique) as lq1,
+        labez_clique (q2.labez, q2.clique) as lq2,
+        l.source_labez,
+        labez_clique (l.source_labez, l.source_clique) as source_lq,
+        rank () OVER (PARTITION BY q2.pass_id, aff.ms_id2
+                      ORDER BY affinity DESC, common, older, newer DESC, ms_id1) AS rank
+      FROM passage_ranges pr
+        JOIN ranges rg ON rg.rg_id = pr.rg_id AND rg.range = 'All'
+        JOIN affinity_p_view aff ON aff.rg_id = pr.rg_id
+        JOIN apparatus_cliques_view q1 ON q1.ms_id = aff.ms_id1 AND q1.pass_id = pr.pass_id
+        JOIN apparatus_cliques_view q2 ON q2.ms_id = aff.ms_id2 AND q2.pass_id = pr.pass_id
+        JOIN locstem l ON (l.pass_id, l.labez, l.clique) = (q2.pass_id, q2.labez, q2.clique)
+      WHERE ms_id1 NOT IN :exclude
+        AND ms_id2 NOT IN :exclude
+        AND q1.labez != 'zz'
+        AND q2.labez != 'zz'
+        AND q1.certainty = 1.0
+        AND q2.certainty = 1.0
+        AND aff.newer < aff.older
+        AND aff.common > aff.ms2_length / 2
+        {where}
+    )
+
+    -- store mss that fail both rules
+    INSERT INTO congruence (pass_id, ms_id1, ms_id2, labez_clique1, labez_clique2,
+                            source_labez_clique, rank)
+    SELECT pass_id, ms_id1, ms_id2, lq1, lq2, source_lq, rank
+    FROM ranks r
+    WHERE lq1 != lq2
+      AND r.source_labez != '?'
+      AND r.rank <= :connectivity
+      AND -- ms2 fails rule 1
+        NOT EXISTS (
+          SELECT 1 FROM ranks rr
+          WHERE rr.pass_id = r.pass_id
+            AND rr.ms_id2  = r.ms_id2
+            AND rr.lq1     = r.lq2
+            AND rr.rank   <= :connectivity
+        )
+      AND -- ms2 fails rule 2
+        NOT EXISTS (
+          SELECT 1 FROM ranks rr
+          WHERE rr.pass_id = r.pass_id
+            AND rr.ms_id2  = r.ms_id2
+            AND (rr.source_lq = r.lq1 OR rr.source_labez = '?')
+            AND rr.rank   <= 1
+        )
+    """, params)
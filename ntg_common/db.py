@@ -5,7 +5,7 @@ we need for doing the CBGM and running the application server.
 
 """
 
-from sqlalchemy import String, Integer, Float, Boolean, DateTime, Column, Index, ForeignKey
+from sqlalchemy import String, Integer, BigInteger, Float, Boolean, DateTime, Column, Index, ForeignKey
 from sqlalchemy import UniqueConstraint, CheckConstraint, ForeignKeyConstraint, PrimaryKeyConstraint
 from sqlalchemy.dialects.postgresql import TSTZRANGE
 from sqlalchemy.ext import compiler
@@ -1158,6 +1158,31 @@ class Ranges (Base2):
     )
 
 
+class Passage_Ranges (Base2):
+    """A table that relates each passage to the ranges containing it.
+
+    This table is a precomputed form of the join :code:`ranges JOIN passages ON
+    ranges.passage @> passages.passage`.  It lets SQL users find the passages in
+    a range with an equijoin instead of a range containment test.
+
+    .. pic:: sauml -i passage_ranges
+             postgresql+psycopg2://ntg@localhost:5432/acts_ph4
+
+    """
+
+    __tablename__ = 'passage_ranges'
+
+    rg_id      = Column (Integer, nullable = False)
+    pass_id    = Column (Integer, nullable = False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (rg_id, pass_id),
+        Index ('ix_passage_ranges_pass_id', pass_id),
+        ForeignKeyConstraint ([rg_id],   ['ranges.rg_id'],     ondelete = 'CASCADE'),
+        ForeignKeyConstraint ([pass_id], ['passages.pass_id'], ondelete = 'CASCADE'),
+    )
+
+
 class Ms_Ranges (Base2):
     """A table that contains CBGM output related to each manuscript.
 
@@ -1257,6 +1282,232 @@ class Affinity (Base2):
     )
 
 
+class Set_Cover (Base2):
+    """A table that contains the precomputed set covers of the manuscripts.
+
+    Filled by :mod:`scripts.cceh.set_cover`.  It has one row for each step of
+    the greedy set cover of each manuscript, computed without pre-selected
+    manuscripts and without 'A' and 'MT'.
+
+    .. pic:: sauml -i set_cover
+             postgresql+psycopg2://ntg@localhost:5432/acts_ph4
+
+    .. attribute:: n
+
+        The step of the cover, starting at 1.
+
+    .. attribute:: cover_ms_id
+
+        The manuscript chosen in this step.
+
+    .. attribute:: explains
+
+        No. of passages newly explained in this step.
+
+    .. attribute:: equal
+
+        No. of those passages explained by agreement.
+
+    .. attribute:: unknown
+
+        No. of passages still unexplained after this step whose source is unknown.
+
+    .. attribute:: open
+
+        No. of passages still unexplained after this step, including unknown.
+
+    .. attribute:: generation
+
+        The data generation the cover was computed from.
+
+    """
+
+    __tablename__ = 'set_cover'
+
+    ms_id       = Column (Integer,    nullable = False)
+    n           = Column (Integer,    nullable = False)
+    cover_ms_id = Column (Integer,    nullable = False)
+    explains    = Column (Integer,    nullable = False)
+    equal       = Column (Integer,    nullable = False)
+    unknown     = Column (Integer,    nullable = False)
+    open        = Column (Integer,    nullable = False)
+    generation  = Column (BigInteger, nullable = False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (ms_id, n),
+        ForeignKeyConstraint ([ms_id],       ['manuscripts.ms_id'], ondelete = 'CASCADE'),
+        ForeignKeyConstraint ([cover_ms_id], ['manuscripts.ms_id'], ondelete = 'CASCADE'),
+    )
+
+
+class Locstem_Closure (Base2):
+    """A table that contains the transitive closure of the local stemmas.
+
+    It has one row for every reading and every reading it derives from,
+    directly or indirectly, including the sources '*' and '?'.  Triggers on
+    the locstem table keep this table up to date.
+
+    .. pic:: sauml -i locstem_closure
+             postgresql+psycopg2://ntg@localhost:5432/acts_ph4
+
+    .. attribute:: anc_labez
+
+        The labez of an ancestor reading.
+
+    .. attribute:: anc_clique
+
+        The clique of an ancestor reading.
+
+    """
+
+    __tablename__ = 'locstem_closure'
+
+    pass_id    = Column (Integer,    nullable = False)
+    labez      = Column (String (3), nullable = False)
+    clique     = Column (String (2), nullable = False)
+    anc_labez  = Column (String (3), nullable = False)
+    anc_clique = Column (String (2), nullable = False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (pass_id, labez, clique, anc_labez, anc_clique),
+        ForeignKeyConstraint ([pass_id], ['passages.pass_id'], ondelete = 'CASCADE'),
+    )
+
+
+class Congruence (Base2):
+    """A table that contains the congruence violations of each passage.
+
+    Filled by :mod:`scripts.cceh.cbgm` and refreshed for one passage whenever
+    its local stemma is edited.  See
+    :func:`~ntg_common.cbgm_common.update_congruence_table`.
+
+    .. pic:: sauml -i congruence
+             postgresql+psycopg2://ntg@localhost:5432/acts_ph4
+
+    .. attribute:: ms_id1
+
+        The potential ancestor.
+
+    .. attribute:: ms_id2
+
+        The manuscript that violates the congruence.
+
+    .. attribute:: labez_clique1
+
+        The reading and clique of the potential ancestor.
+
+    .. attribute:: labez_clique2
+
+        The reading and clique of the manuscript.
+
+    .. attribute:: source_labez_clique
+
+        The source of the manuscript's reading in the local stemma.  A reading
+        with more than one source yields one row for each source.
+
+    .. attribute:: rank
+
+        The rank of the potential ancestor.
+
+    """
+
+    __tablename__ = 'congruence'
+
+    pass_id             = Column (Integer,    nullable = False)
+    ms_id1              = Column (Integer,    nullable = False)
+    ms_id2              = Column (Integer,    nullable = False)
+    labez_clique1       = Column (String (5), nullable = False)
+    labez_clique2       = Column (String (5), nullable = False)
+    source_labez_clique = Column (String (5), nullable = False)
+    rank                = Column (Integer,    nullable = False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (pass_id, ms_id2, ms_id1, source_labez_clique),
+        ForeignKeyConstraint ([pass_id], ['passages.pass_id'],  ondelete = 'CASCADE'),
+        ForeignKeyConstraint ([ms_id1],  ['manuscripts.ms_id'], ondelete = 'CASCADE'),
+        ForeignKeyConstraint ([ms_id2],  ['manuscripts.ms_id'], ondelete = 'CASCADE'),
+    )
+
+
+class Textflow_Cache (Base2):
+    """A table that contains the precomputed global textflows.
+
+    Filled in the background by the application server, see
+    :func:`server.textflow.fill_textflow_cache`.  It has one row for each
+    passage and mode of the global textflow with the default options.  The
+    rows of a passage are deleted whenever the passage is edited.  All rows
+    are stale after the affinity table has changed.
+
+    .. pic:: sauml -i textflow_cache
+             postgresql+psycopg2://ntg@localhost:5432/acts_ph4
+
+    .. attribute:: mode
+
+        The mode of the textflow: 'sim' or 'rec'.
+
+    .. attribute:: graph
+
+        The node and edge statements of the graph in dot format, without the
+        layout parameters.
+
+    .. attribute:: dot
+
+        The whole graph laid out by GraphViz with :attr:`width` and
+        :attr:`fontsize`.  NULL if GraphViz failed.
+
+    .. attribute:: width
+
+        The width in pixels the graph was laid out for.
+
+    .. attribute:: fontsize
+
+        The font size in pixels the graph was laid out for.
+
+    .. attribute:: generation
+
+        The generation of the affinity table the graph was computed from.
+
+    """
+
+    __tablename__ = 'textflow_cache'
+
+    pass_id    = Column (Integer,    nullable = False)
+    mode       = Column (String (3), nullable = False)
+    graph      = Column (String,     nullable = False)
+    dot        = Column (String)
+    width      = Column (Float,      nullable = False)
+    fontsize   = Column (Float,      nullable = False)
+    generation = Column (BigInteger, nullable = False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint (pass_id, mode),
+        ForeignKeyConstraint ([pass_id], ['passages.pass_id'], ondelete = 'CASCADE'),
+    )
+
+
+class Table_Generation (Base2):
+    """A table that records the data generation of the last change to a table.
+
+    Only the tables in :data:`TABLE_GENERATION_TABLES` are recorded.  A cache
+    built from one of those tables alone can be tagged with its generation and
+    survive changes to other tables.
+
+    .. attribute:: table_name
+
+        The name of the table.
+
+    .. attribute:: generation
+
+        The data generation after the last statement that changed the table.
+
+    """
+
+    __tablename__ = 'table_generation'
+
+    table_name = Column (String (64), primary_key = True)
+    generation = Column (BigInteger,  nullable = False)
+
+
 function ('labez_array_to_string', Base2.metadata, 'a CHAR[]', 'CHAR', '''
 SELECT array_to_string (a, '/', '')
 ''', volatility = 'IMMUTABLE')
@@ -1387,6 +1638,29 @@ view ('apparatus_view_agg', Base2.metadata, '''
    GROUP BY pass_id, ms_id, hs, hsnr
    ''')
 
+# materialized copies of apparatus_cliques_view and apparatus_view_agg
+#
+# The application server reads these tables instead of the views.  They are
+# refreshed by :func:`ntg_common.db_tools.refresh_apparatus_tables`: in full by
+# the prepare.py and cbgm.py scripts and one passage at a time by the editor.
+
+generic (Base2.metadata, '''
+    CREATE TABLE apparatus_cliques_mat AS SELECT * FROM apparatus_cliques_view WITH NO DATA;
+    ALTER TABLE apparatus_cliques_mat ADD PRIMARY KEY (pass_id, ms_id, labez);
+    CREATE INDEX ix_apparatus_cliques_mat_ms_id ON apparatus_cliques_mat (ms_id);
+''', '''
+    DROP TABLE IF EXISTS apparatus_cliques_mat
+'''
+)
+
+generic (Base2.metadata, '''
+    CREATE TABLE apparatus_view_agg_mat AS SELECT * FROM apparatus_view_agg WITH NO DATA;
+    ALTER TABLE apparatus_view_agg_mat ADD PRIMARY KEY (pass_id, ms_id);
+''', '''
+    DROP TABLE IF EXISTS apparatus_view_agg_mat
+'''
+)
+
 view ('affinity_view', Base2.metadata, '''
     SELECT ch.bk_id, ch.rg_id, ch.range, ms_id1, ms_id2, common, equal,
            older, newer, unclear,
@@ -1464,24 +1738,18 @@ DROP INDEX IF EXISTS readings_unique_pass_id_lesart
 )
 
 
-LOCSTEM_REC = '''
-WITH RECURSIVE locstem_rec (pass_id, labez, clique, source_labez, source_clique) AS (
-  SELECT pass_id, labez, clique, source_labez, source_clique
-  FROM locstem i
-  WHERE i.pass_id = passage_id AND i.labez = labez1 AND i.clique = clique1
-  UNION
-  SELECT l.pass_id, l.labez, l.clique, l.source_labez, l.source_clique
-  FROM locstem l, locstem_rec r
-  WHERE l.pass_id = r.pass_id AND l.labez = r.source_labez AND l.clique = r.source_clique
-  )
-'''
-
-function ('is_older', Base2.metadata, 'passage_id INTEGER, labez2 CHAR, clique2 CHAR, labez1 CHAR, clique1 CHAR', 'BOOLEAN', LOCSTEM_REC + '''
-SELECT EXISTS (SELECT * FROM locstem_rec WHERE source_labez = labez2 AND source_clique = clique2);
+function ('is_older', Base2.metadata, 'passage_id INTEGER, labez2 CHAR, clique2 CHAR, labez1 CHAR, clique1 CHAR', 'BOOLEAN', '''
+SELECT EXISTS (SELECT * FROM locstem_closure
+               WHERE pass_id = passage_id AND
+                     labez = labez1 AND clique = clique1 AND
+                     anc_labez = labez2 AND anc_clique = clique2);
 ''', volatility = 'STABLE')
 
-function ('is_unclear', Base2.metadata, 'passage_id INTEGER, labez1 CHAR, clique1 CHAR', 'BOOLEAN', LOCSTEM_REC + '''
-SELECT EXISTS (SELECT * FROM locstem_rec WHERE source_labez = '?');
+function ('is_unclear', Base2.metadata, 'passage_id INTEGER, labez1 CHAR, clique1 CHAR', 'BOOLEAN', '''
+SELECT EXISTS (SELECT * FROM locstem_closure
+               WHERE pass_id = passage_id AND
+                     labez = labez1 AND clique = clique1 AND
+                     anc_labez = '?');
 ''', volatility = 'STABLE')
 
 function ('is_p_older', Base2.metadata, 'passage_id INTEGER, labez2 CHAR, clique2 CHAR, labez1 CHAR, clique1 CHAR', 'BOOLEAN', '''
@@ -1594,6 +1862,84 @@ generic (Base2.metadata, '''
 '''
 )
 
+# maintain the transitive closure of locstem
+#
+# The statement-level triggers recompute the closure of all passages touched by
+# the statement.
+
+function ('locstem_closure_trigger_f', Base2.metadata, '', 'TRIGGER', '''
+   DECLARE
+      pass_ids INTEGER[];
+   BEGIN
+      IF TG_OP = 'TRUNCATE' THEN
+        TRUNCATE locstem_closure;
+        RETURN NULL;
+      ELSIF TG_OP = 'INSERT' THEN
+        SELECT array_agg (DISTINCT pass_id) INTO pass_ids FROM new_rows;
+      ELSIF TG_OP = 'UPDATE' THEN
+        SELECT array_agg (DISTINCT pass_id) INTO pass_ids
+        FROM (SELECT pass_id FROM new_rows UNION SELECT pass_id FROM old_rows) AS u;
+      ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg (DISTINCT pass_id) INTO pass_ids FROM old_rows;
+      END IF;
+
+      DELETE FROM locstem_closure WHERE pass_id = ANY (pass_ids);
+
+      INSERT INTO locstem_closure (pass_id, labez, clique, anc_labez, anc_clique)
+      WITH RECURSIVE closure (pass_id, labez, clique, anc_labez, anc_clique) AS (
+        SELECT pass_id, labez, clique, source_labez, source_clique
+        FROM locstem
+        WHERE pass_id = ANY (pass_ids)
+        UNION
+        SELECT c.pass_id, c.labez, c.clique, l.source_labez, l.source_clique
+        FROM closure c
+          JOIN locstem l ON (l.pass_id, l.labez, l.clique) = (c.pass_id, c.anc_labez, c.anc_clique)
+      )
+      SELECT * FROM closure;
+
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+generic (Base2.metadata, '''
+    CREATE TRIGGER locstem_closure_insert_trigger
+    AFTER INSERT ON locstem
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE locstem_closure_trigger_f ()
+''', '''
+    DROP TRIGGER IF EXISTS locstem_closure_insert_trigger ON locstem
+'''
+)
+
+generic (Base2.metadata, '''
+    CREATE TRIGGER locstem_closure_update_trigger
+    AFTER UPDATE ON locstem
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE locstem_closure_trigger_f ()
+''', '''
+    DROP TRIGGER IF EXISTS locstem_closure_update_trigger ON locstem
+'''
+)
+
+generic (Base2.metadata, '''
+    CREATE TRIGGER locstem_closure_delete_trigger
+    AFTER DELETE ON locstem
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE locstem_closure_trigger_f ()
+''', '''
+    DROP TRIGGER IF EXISTS locstem_closure_delete_trigger ON locstem
+'''
+)
+
+generic (Base2.metadata, '''
+    CREATE TRIGGER locstem_closure_truncate_trigger
+    AFTER TRUNCATE ON locstem
+    FOR EACH STATEMENT EXECUTE PROCEDURE locstem_closure_trigger_f ()
+''', '''
+    DROP TRIGGER IF EXISTS locstem_closure_truncate_trigger ON locstem
+'''
+)
+
 generic (Base2.metadata, '''
     CREATE TRIGGER ms_cliques_trigger
     BEFORE INSERT OR UPDATE OR DELETE ON ms_cliques
@@ -1648,6 +1994,62 @@ generic (Base2.metadata, '''
 '''
 )
 
+# implement a data generation counter
+#
+# The counter is bumped by every statement that changes a table the application
+# server caches in memory.  The server polls the counter to find out when its
+# caches are stale.
+
+generic (Base2.metadata, '''
+    CREATE SEQUENCE IF NOT EXISTS generation_seq
+''', '''
+    DROP SEQUENCE IF EXISTS generation_seq CASCADE
+'''
+)
+
+function ('generation_trigger_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      PERFORM nextval ('generation_seq');
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+GENERATION_TABLES = ('manuscripts', 'passages', 'ranges', 'apparatus', 'cliques',
+                     'ms_cliques', 'locstem', 'affinity')
+""" The tables that bump the data generation counter. """
+
+for table in GENERATION_TABLES:
+    generic (Base2.metadata, '''
+    CREATE TRIGGER {table}_generation_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE generation_trigger_f ()
+    '''.format (table = table), '''
+    DROP TRIGGER IF EXISTS {table}_generation_trigger ON {table}
+    '''.format (table = table)
+    )
+
+function ('table_generation_trigger_f', Base2.metadata, '', 'TRIGGER', '''
+   BEGIN
+      INSERT INTO table_generation (table_name, generation)
+      SELECT TG_TABLE_NAME, last_value FROM generation_seq
+      ON CONFLICT (table_name) DO UPDATE SET generation = EXCLUDED.generation;
+      RETURN NULL;
+   END;
+''', language = 'plpgsql', volatility = 'VOLATILE')
+
+TABLE_GENERATION_TABLES = ('affinity', 'manuscripts', 'passages', 'ranges')
+""" The tables whose last change is recorded in :class:`Table_Generation`. """
+
+for table in TABLE_GENERATION_TABLES:
+    generic (Base2.metadata, '''
+    CREATE TRIGGER {table}_table_generation_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_generation_trigger_f ()
+    '''.format (table = table), '''
+    DROP TRIGGER IF EXISTS {table}_table_generation_trigger ON {table}
+    '''.format (table = table)
+    )
+
 
 Base4 = declarative_base ()
 Base4.metadata.schema = 'ntg'
@@ -6,12 +6,15 @@ import collections
 import csv
 import configparser
 import datetime
+import hashlib
 import io
 import itertools
 import logging
 import os
 import os.path
+import re
 import textwrap
+import threading
 import time
 
 import networkx as nx
@@ -27,14 +30,180 @@ MYSQL_DEFAULT_FILES  = ( '/etc/my.cnf', '/etc/mysql/my.cnf', '~/.my.cnf' )
 MYSQL_DEFAULT_GROUPS = ( 'mysql', 'client', 'client-server', 'client-mariadb' )
 
 
+RE_BIND = re.compile (r'(?<![:\w\x5c]):(\w+)(?!:)')
+""" A bind parameter in a text query, the same regex sqlalchemy uses. """
+
+RE_PREPARABLE = re.compile (r'^(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+
+def pg_type (value):
+    """Return the type of a prepared statement parameter.
+
+    Mimic the types postgres gives to the literals psycopg2 would send instead.
+
+    """
+
+    if isinstance (value, bool):
+        return 'boolean'
+    if isinstance (value, int):
+        return 'integer' if -2**31 <= value < 2**31 else 'bigint'
+    if isinstance (value, float):
+        return 'numeric'
+    return 'unknown'
+
+
+class Statement ():
+    """ A named variant of a query. """
+
+    def __init__ (self, name, sql, binds, types):
+        self.name        = name
+        self.sql         = sql
+        self.binds       = binds
+        self.executions  = 0
+        self.prepares    = 0
+        self.failed      = False
+
+        numbers = {}
+        def number (m):
+            return '$%d' % numbers.setdefault (m.group (1), len (numbers) + 1)
+
+        sql = RE_BIND.sub (number, sql)
+        if binds:
+            self.prepare_sql = 'PREPARE %s (%s) AS %s' % (name, ', '.join (types), sql)
+            self.execute_sql = 'EXECUTE %s (%s)' % (name, ', '.join (':' + b for b in binds))
+        else:
+            self.prepare_sql = 'PREPARE %s AS %s' % (name, sql)
+            self.execute_sql = 'EXECUTE %s' % name
+
+
+class StatementRegistry ():
+    """Keep the queries run through :func:`execute` prepared on the server.
+
+    A query variant, that is the query text after formatting together with the
+    types of its parameters, gets a name after it was executed `threshold`
+    times.  It is then prepared once on every connection that executes it and
+    postgres can reuse the plan.  Queries with more than one statement or with
+    tuple parameters are never prepared.  At most `max_statements` variants get
+    a name.
+
+    The registry is disabled by default.
+
+    """
+
+    def __init__ (self, threshold = 2, max_statements = 500):
+        self.enabled        = False
+        self.threshold      = threshold
+        self.max_statements = max_statements
+        self.statements     = {}
+        self.candidates     = collections.Counter ()
+        self.lock           = threading.Lock ()
+
+
+    def get (self, conn, sql, parameters):
+        """ Return the named statement for the query or None. """
+
+        if not self.enabled or conn.dialect.name != 'postgresql' or not conn.in_transaction ():
+            return None
+        if not RE_PREPARABLE.match (sql) or ';' in sql.rstrip (';'):
+            return None
+
+        binds = tuple (collections.OrderedDict.fromkeys (RE_BIND.findall (sql)))
+        values = []
+        for b in binds:
+            if b not in parameters:
+                return None
+            value = parameters[b]
+            if isinstance (value, (tuple, list, set, dict)):
+                return None
+            values.append (value)
+        key = (sql, tuple (pg_type (v) for v in values))
+
+        with self.lock:
+            statement = self.statements.get (key)
+            if statement is None:
+                if len (self.statements) >= self.max_statements:
+                    return None
+                self.candidates[key] += 1
+                if self.candidates[key] < self.threshold:
+                    if len (self.candidates) > 10 * self.max_statements:
+                        self.candidates.clear ()
+                    return None
+                del self.candidates[key]
+                name = 'ntg_' + hashlib.md5 (repr (key).encode ('utf-8')).hexdigest ()[:16]
+                statement = Statement (name, sql, binds, key[1])
+                self.statements[key] = statement
+        return None if statement.failed else statement
+
+
+    def execute (self, conn, statement, parameters):
+        """Execute a named statement.
+
+        Prepares the statement first if this connection has not seen it yet.
+        Returns None if the statement cannot be prepared.
+
+        """
+
+        prepared = conn.info.setdefault ('ntg_prepared', set ())
+        if statement.name not in prepared:
+            try:
+                conn.execute (text ('SAVEPOINT ntg_prepare; {sql}; RELEASE SAVEPOINT ntg_prepare'.format (
+                    sql = statement.prepare_sql)))
+            except sqlalchemy.exc.DBAPIError as e:
+                conn.execute (text ('ROLLBACK TO SAVEPOINT ntg_prepare; RELEASE SAVEPOINT ntg_prepare'))
+                if getattr (e.orig, 'pgcode', None) != '42P05': # duplicate_prepared_statement
+                    log (logging.INFO, 'Cannot prepare statement %s: %s' % (statement.name, e.orig))
+                    statement.failed = True
+                    return None
+            prepared.add (statement.name)
+            with self.lock:
+                statement.prepares += 1
+            log (logging.DEBUG, 'Prepared statement %s: %s' % (statement.name, statement.sql))
+
+        with self.lock:
+            statement.executions += 1
+        return conn.execute (text (statement.execute_sql), parameters)
+
+
+    def stats (self):
+        """ Return a list of all named statements, the most executed first. """
+
+        with self.lock:
+            statements = list (self.statements.values ())
+        return sorted (statements, key = lambda s: -s.executions)
+
+
+statements = StatementRegistry ()
+""" The statement registry of this process. """
+
+
 def execute (conn, sql, parameters, debug_level = logging.DEBUG):
     sql = sql.strip ().format (**parameters)
     start_time = datetime.datetime.now ()
-    result = conn.execute (text (sql), parameters)
+    result = None
+    statement = statements.get (conn, sql, parameters)
+    if statement is not None:
+        result = statements.execute (conn, statement, parameters)
+    if result is None:
+        result = conn.execute (text (sql), parameters)
     log (debug_level, '%d rows in %.3fs', result.rowcount, (datetime.datetime.now () - start_time).total_seconds ())
     return result
 
 
+def execute_stream (conn, sql, parameters, debug_level = logging.DEBUG):
+    """Execute a query on a server-side cursor.
+
+    The rows are fetched in batches while iterating over the result, so the
+    whole result is never held in memory.
+
+    """
+
+    sql = sql.strip ().format (**parameters)
+    start_time = datetime.datetime.now ()
+    result = conn.execution_options (stream_results = True).execute (text (sql), parameters)
+    log (debug_level, 'cursor opened in %.3fs', (datetime.datetime.now () - start_time).total_seconds ())
+    return result
+
+
 def executemany (conn, sql, parameters, param_array, debug_level = logging.DEBUG):
     sql = sql.strip ().format (**parameters)
     start_time = datetime.datetime.now ()
@@ -183,6 +352,93 @@ def tabulate (res):
     return ''.join (a)
 
 
+def get_generation (conn):
+    """Get the data generation of the database.
+
+    The generation is a counter that is bumped by every statement that changes
+    one of the tables in :data:`ntg_common.db.GENERATION_TABLES`.  Caches built
+    from those tables may be tagged with it.  The generation is 0 until the
+    counter is bumped for the first time.
+
+    """
+
+    res = execute (conn, """
+    SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM generation_seq
+    """, {})
+
+    return res.fetchone ()[0]
+
+
+def get_table_generation (conn, table):
+    """Get the data generation of the last change to a table.
+
+    Only the tables in :data:`ntg_common.db.TABLE_GENERATION_TABLES` are
+    recorded.  Returns None if the table was never changed.
+
+    """
+
+    res = execute (conn, """
+    SELECT generation FROM table_generation WHERE table_name = :table
+    """, dict (table = table))
+
+    row = res.fetchone ()
+    return row[0] if row else None
+
+
+def refresh_apparatus_tables (conn, pass_id = None):
+    """Refresh the materialized apparatus tables.
+
+    Copies apparatus_cliques_view and apparatus_view_agg into the tables
+    apparatus_cliques_mat and apparatus_view_agg_mat.  Refreshes only one
+    passage if pass_id is given, else all passages.
+
+    Uses DELETE instead of TRUNCATE, because TRUNCATE takes an ACCESS EXCLUSIVE
+    lock that would block the readers of the apparatus until commit.
+
+    """
+
+    if pass_id is None:
+        execute (conn, """
+        DELETE FROM apparatus_cliques_mat;
+        DELETE FROM apparatus_view_agg_mat;
+        """, {})
+        where = ''
+    else:
+        execute (conn, """
+        DELETE FROM apparatus_cliques_mat  WHERE pass_id = :pass_id;
+        DELETE FROM apparatus_view_agg_mat WHERE pass_id = :pass_id;
+        """, dict (pass_id = pass_id))
+        where = 'WHERE pass_id = :pass_id'
+
+    execute (conn, """
+    INSERT INTO apparatus_cliques_mat
+    SELECT * FROM apparatus_cliques_view {where};
+
+    INSERT INTO apparatus_view_agg_mat
+    SELECT * FROM apparatus_view_agg {where};
+    """, dict (pass_id = pass_id, where = where))
+
+
+def invalidate_textflow_cache (conn, pass_id = None):
+    """Delete the precomputed global textflows.
+
+    Deletes only the textflows of one passage if pass_id is given, else all.
+    The application server computes them again in the background.
+
+    Locks the passages until the end of the transaction, so that the server
+    cannot write a textflow computed from the data before the change.  Call
+    this in the transaction that changes the data.
+
+    """
+
+    where = '' if pass_id is None else 'WHERE pass_id = :pass_id'
+
+    execute (conn, """
+    SELECT pass_id FROM passages {where} ORDER BY pass_id FOR NO KEY UPDATE;
+    DELETE FROM textflow_cache {where};
+    """, dict (pass_id = pass_id, where = where))
+
+
 def truncate_editor_tables (conn):
     execute (conn, """
     TRUNCATE cliques_tts, ms_cliques_tts, locstem_tts, notes_tts RESTART IDENTITY;
@@ -334,20 +590,104 @@ class MySQLEngine ():
         return connection
 
 
-class PostgreSQLEngine ():
-    """ PostgreSQL Database Interface """
+SESSION_OPTIONS = '-c ntg.user_id=0'
+"""Session defaults sent with the startup packet of every new connection.
 
-    @staticmethod
-    def receive_checkout (dbapi_connection, _connection_record, _connection_proxy):
-        """Set a default for the postgres variable ntg.user_id that is used by
-        :ref:`tts` tables.
+Give the postgres variable ntg.user_id, that is used by :ref:`tts` tables, a
+default value so postgres won't choke.  The actual user is set with SET LOCAL in
+editor.py, which lasts only until the end of the transaction.
 
-        """
+"""
+
+PoolStats = collections.namedtuple (
+    'PoolStats', 'database size checked_out overflow checkouts wait_seconds')
 
-        # just give a default value so postgres won't choke.  the actual user is
-        # set in editor.py
-        dbapi_connection.cursor ().execute ("SET ntg.user_id = 0")
 
+class TimedQueuePool (sqlalchemy.pool.QueuePool):
+    """ A QueuePool that records how long checkouts wait for a connection. """
+
+    def __init__ (self, *args, **kwargs):
+        super ().__init__ (*args, **kwargs)
+        self.stats_lock   = threading.Lock ()
+        self.checkouts    = 0
+        self.wait_seconds = 0.0
+
+
+    def _do_get (self):
+        start = time.perf_counter ()
+        try:
+            return super ()._do_get ()
+        finally:
+            with self.stats_lock:
+                self.checkouts    += 1
+                self.wait_seconds += time.perf_counter () - start
+
+
+class PoolManager ():
+    """Hand out one engine per database URL.
+
+    All users of the same database in a process share one connection pool, eg.
+    the main app and the user authentication of every book.  The pool is sized
+    by the first user.
+
+    """
+
+    def __init__ (self):
+        self.engines = collections.OrderedDict ()
+        self.lock    = threading.Lock ()
+
+
+    def get_engine (self, url, pool_size = 5, max_overflow = 10, pool_timeout = 30, pool_recycle = -1):
+        """ Return the engine for the URL, creating it if necessary. """
+
+        key = str (sqlalchemy.engine.url.make_url (url))
+        with self.lock:
+            engine = self.engines.get (key)
+            if engine is None:
+                engine = sqlalchemy.create_engine (
+                    url,
+                    use_batch_mode = True,
+                    poolclass      = TimedQueuePool,
+                    pool_size      = pool_size,
+                    max_overflow   = max_overflow,
+                    pool_timeout   = pool_timeout,
+                    pool_recycle   = pool_recycle,
+                    connect_args   = { 'options' : SESSION_OPTIONS },
+                )
+                self.engines[key] = engine
+            return engine
+
+
+    def stats (self):
+        """ Return a list of :class:`PoolStats`, one for each engine. """
+
+        stats = []
+        with self.lock:
+            engines = list (self.engines.values ())
+        for engine in engines:
+            pool = engine.pool
+            stats.append (PoolStats (
+                engine.url.database,
+                pool.size (),
+                pool.checkedout (),
+                max (pool.overflow (), 0),
+                getattr (pool, 'checkouts', 0),
+                getattr (pool, 'wait_seconds', 0.0),
+            ))
+        return stats
+
+
+pool_manager = PoolManager ()
+""" The pool manager of this process. """
+
+
+class PostgreSQLEngine ():
+    """PostgreSQL Database Interface
+
+    The pool is sized by the configuration keys POOL_SIZE, POOL_MAX_OVERFLOW,
+    POOL_TIMEOUT and POOL_RECYCLE.
+
+    """
 
     def __init__ (self, **kwargs):
 
@@ -362,15 +702,16 @@ class PostgreSQLEngine ():
 
         log (logging.DEBUG, "PostgreSQLEngine: Connecting to URL: {url}".format (url = self.url))
 
-        self.engine = sqlalchemy.create_engine (
+        self.engine = pool_manager.get_engine (
             self.url,
-            use_batch_mode = True
+            pool_size    = int (kwargs.get ('POOL_SIZE', 5)),
+            max_overflow = int (kwargs.get ('POOL_MAX_OVERFLOW', 10)),
+            pool_timeout = float (kwargs.get ('POOL_TIMEOUT', 30)),
+            pool_recycle = int (kwargs.get ('POOL_RECYCLE', -1)),
         )
 
         self.params = args
 
-        sqlalchemy.event.listen (self.engine, 'checkout', self.receive_checkout)
-
         self.wait_for_server ()
 
 
@@ -418,12 +759,67 @@ class PostgreSQLEngine ():
         log (logging.INFO, ''.join (connection.notices))
 
 
+    def maintain (self, tables, full_ratio = 0.9):
+        """Vacuum and analyze the tables a run has rewritten.
+
+        Picks for every table by its ratio of dead tuples:
+
+        - VACUUM FULL ANALYZE if the ratio is at least `full_ratio`,
+        - VACUUM ANALYZE if there are any dead tuples,
+        - ANALYZE otherwise.
+
+        Only VACUUM FULL locks out the readers of a table.  A table rewritten
+        once has about half dead tuples, and the next rewrite reuses the space a
+        plain VACUUM frees, so VACUUM FULL is only worth it when the table has
+        shrunk a lot.  Pass None as `full_ratio` for tables that are rewritten
+        every run: they never get a VACUUM FULL.
+
+        """
+
+        # closing the idle connections makes their backends report the dead
+        # tuples they left behind
+        self.engine.dispose ()
+
+        connection = self.engine.raw_connection ()
+        try:
+            # vacuum won't work in a transaction
+            connection.connection.autocommit = True
+            cursor = connection.cursor ()
+            for table in tables:
+                cursor.execute ("""
+                SELECT n_live_tup, n_dead_tup
+                FROM pg_stat_user_tables
+                WHERE relid = to_regclass (%s)
+                """, (table, ))
+                row = cursor.fetchone ()
+                if row is None:
+                    log (logging.WARNING, "Maintenance: no table %s" % table)
+                    continue
+
+                live, dead = row
+                ratio = dead / max (live + dead, 1)
+                if full_ratio is not None and ratio >= full_ratio:
+                    command = 'VACUUM FULL ANALYZE'
+                elif dead > 0:
+                    command = 'VACUUM ANALYZE'
+                else:
+                    command = 'ANALYZE'
+
+                start_time = time.perf_counter ()
+                cursor.execute ('%s %s' % (command, table))
+                log (logging.INFO, "Maintenance: %s %s (%.0f%% dead tuples) in %.3fs" % (
+                    command, table, ratio * 100, time.perf_counter () - start_time))
+        finally:
+            connection.connection.autocommit = False
+            connection.close ()
+
+
     def wait_for_server (self, retries = 60):
         """ Wait for the Postgres server to come up. """
 
         while retries > 0:
             try:
-                self.connect ()
+                self.connect ().close ()
                 return
             except sqlalchemy.exc.OperationalError as e:
                 if retries <= 0:
@@ -0,0 +1,161 @@
+# -*- encoding: utf-8 -*-
+
+"""Static interval indexes over passages and ranges.
+
+Passages and ranges are half-open intervals of word addresses,
+eg. [begadr, endadr + 1), just like the int4range columns in the database.
+This module answers the containment queries that otherwise need the int4range
+operators :code:`@>` and :code:`<@` at query time.
+
+The indexes are sorted arrays built once.  They are used by the application
+server and by the scripts.
+
+"""
+
+import numpy as np
+
+from ntg_common.db_tools import execute
+
+
+class IntervalIndex ():
+    """An index over a static set of half-open integer intervals.
+
+    Build from (id, lower, upper) tuples.  Each interval is [lower, upper).
+
+    For stabbing queries the number line is cut into elementary segments at
+    every interval bound and each segment remembers the intervals that cover
+    it.  For containment queries the intervals are kept sorted by lower bound.
+
+    """
+
+    def __init__ (self, intervals):
+        intervals = sorted (intervals, key = lambda i: (i[1], -i[2], i[0]))
+
+        self.ids    = np.array ([ i[0] for i in intervals ], dtype = np.int64)
+        self.lowers = np.array ([ i[1] for i in intervals ], dtype = np.int64)
+        self.uppers = np.array ([ i[2] for i in intervals ], dtype = np.int64)
+
+        # the elementary segments: [points[n], points[n + 1])
+        self.points = np.unique (np.concatenate ((self.lowers, self.uppers)))
+        covers = [ [] for dummy in range (len (self.points)) ]
+        firsts = np.searchsorted (self.points, self.lowers)
+        lasts  = np.searchsorted (self.points, self.uppers)
+        for id_, first, last in zip (self.ids.tolist (), firsts.tolist (), lasts.tolist ()):
+            for n in range (first, last):
+                covers[n].append (id_)
+        self.covers = [ tuple (c) for c in covers ]
+
+
+    def __len__ (self):
+        return len (self.ids)
+
+
+    def stab (self, point):
+        """ Return the ids of the intervals that contain the point. """
+
+        n = int (np.searchsorted (self.points, point, side = 'right')) - 1
+        if n < 0:
+            return ()
+        return self.covers[n]
+
+
+    def containing (self, lower, upper):
+        """Return the ids of the intervals that contain [lower, upper).
+
+        The ids are returned in the order of the lower bound, widest interval
+        first.
+
+        """
+
+        first = self.stab (lower)
+        if upper - lower <= 1:
+            return first
+        last = set (self.stab (upper - 1))
+        return tuple ([ id_ for id_ in first if id_ in last ])
+
+
+    def contained_in (self, lower, upper):
+        """Return the ids of the intervals that are contained in [lower, upper).
+
+        The ids are returned in the order of the lower bound, widest interval
+        first.
+
+        """
+
+        first = np.searchsorted (self.lowers, lower, side = 'left')
+        last  = np.searchsorted (self.lowers, upper, side = 'left')
+        mask  = self.uppers[first:last] <= upper
+        return self.ids[first:last][mask]
+
+
+class PassageRangeIndex ():
+    """An index relating the passages to the ranges of one database.
+
+    :param passages: (pass_id, begadr, endadr) tuples
+    :param ranges:   (rg_id, bk_id, range, lower, upper) tuples
+
+    """
+
+    def __init__ (self, passages, ranges):
+        self.passages = IntervalIndex ([ (p[0], p[1], p[2] + 1) for p in passages ])
+        self.ranges   = IntervalIndex ([ (r[0], r[3], r[4])     for r in ranges ])
+        self.passage_bounds = { p[0] : (p[1], p[2] + 1) for p in passages }
+        self.range_bounds   = { r[0] : (r[3], r[4])     for r in ranges }
+        self.range_names    = { r[0] : (r[1], r[2])     for r in ranges }
+
+
+    @classmethod
+    def load (cls, conn):
+        """ Load the index from the database. """
+
+        res = execute (conn, """
+        SELECT pass_id, begadr, endadr
+        FROM passages
+        """, {})
+        passages = [ tuple (row) for row in res ]
+
+        res = execute (conn, """
+        SELECT rg_id, bk_id, range, lower (passage), upper (passage)
+        FROM ranges
+        """, {})
+        ranges = [ tuple (row) for row in res ]
+
+        return cls (passages, ranges)
+
+
+    def ranges_of_passage (self, pass_id):
+        """ Return the rg_ids of the ranges that contain the passage. """
+
+        bounds = self.passage_bounds.get (pass_id)
+        if bounds is None:
+            return ()
+        return self.ranges.containing (*bounds)
+
+
+    def passages_of_range (self, rg_id):
+        """ Return the sorted pass_ids of the passages in the range. """
+
+        bounds = self.range_bounds.get (rg_id)
+        if bounds is None:
+            return np.zeros (0, dtype = np.int64)
+        return np.sort (self.passages.contained_in (*bounds))
+
+
+    def passages_containing (self, begadr, endadr):
+        """ Return the pass_ids of the passages that contain [begadr, endadr]. """
+
+        return self.passages.containing (begadr, endadr + 1)
+
+
+    def passages_inside (self, begadr, endadr):
+        """ Return the pass_ids of the passages that are contained in [begadr, endadr]. """
+
+        return self.passages.contained_in (begadr, endadr + 1)
+
+
+    def membership (self):
+        """ Return all (pass_id, rg_id) pairs of passages contained in ranges. """
+
+        return [ (int (pass_id), rg_id)
+                 for rg_id in self.range_bounds
+                 for pass_id in self.passages_of_range (rg_id) ]
@@ -0,0 +1,158 @@
+# -*- encoding: utf-8 -*-
+
+"""A store of read-only memory-mapped numpy arrays.
+
+The CBGM matrices of one database are large and take seconds to build.  This
+store writes them once into a directory of :file:`.npy` files and every process
+that needs them maps the files read-only into memory.  All processes thus share
+the same physical pages.
+
+Use one store per database.  A snapshot is identified by a key of the form
+:samp:`{oid}-{generation}-v{version}`: the oid of the generation counter, which
+changes when the database is rebuilt, the data generation the snapshot was
+built from, and the version of its layout.  A snapshot is written into a
+temporary directory that is renamed into place when complete, so readers never
+see a half-written snapshot.  A lock file makes sure only one process builds a
+snapshot.  Building a snapshot removes all older ones.  Newer ones are kept,
+because a process that has not yet noticed a change may still build the
+snapshot of an older generation.
+
+"""
+
+import fcntl
+import logging
+import os
+import os.path
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from ntg_common.tools import log
+
+
+RE_KEY = re.compile (r'^(\d+)-(\d+)-v(\d+)$')
+""" The key of a snapshot: oid, generation and version. """
+
+
+def parse_key (key):
+    """ Return the oid, generation and version in a key or None. """
+
+    m = RE_KEY.match (key)
+    return tuple (map (int, m.groups ())) if m else None
+
+
+class MatrixStore ():
+    """A directory of snapshots.
+
+    :param str directory: The directory that holds the snapshots.
+
+    """
+
+    def __init__ (self, directory):
+        self.directory = os.path.abspath (directory)
+
+
+    def path (self, key):
+        """ Return the directory of the snapshot. """
+
+        return os.path.join (self.directory, key)
+
+
+    def load (self, key):
+        """Map the arrays of a snapshot into memory.
+
+        Returns a dict of name => read-only array or None if there is no such
+        snapshot.
+
+        """
+
+        path = self.path (key)
+        if not os.path.isdir (path):
+            return None
+
+        arrays = {}
+        try:
+            for fn in os.listdir (path):
+                name, ext = os.path.splitext (fn)
+                if ext == '.npy':
+                    arrays[name] = np.load (os.path.join (path, fn), mmap_mode = 'r')
+        except FileNotFoundError:
+            # pruned by another process while we were loading
+            return None
+        return arrays
+
+
+    def save (self, key, arrays):
+        """ Write a dict of name => array as snapshot. """
+
+        os.makedirs (self.directory, exist_ok = True)
+        tmp = tempfile.mkdtemp (prefix = '.' + key + '-', dir = self.directory)
+        try:
+            for name, array in arrays.items ():
+                np.save (os.path.join (tmp, name + '.npy'), np.ascontiguousarray (array))
+            os.rename (tmp, self.path (key))
+        except:
+            shutil.rmtree (tmp, ignore_errors = True)
+            raise
+
+
+    def get (self, key, build):
+        """Map a snapshot into memory, building it first if necessary.
+
+        :param str key: The key of the snapshot.
+        :param build: A function that returns a dict of name => array.
+
+        """
+
+        arrays = self.load (key)
+        if arrays is not None:
+            return arrays
+
+        os.makedirs (self.directory, exist_ok = True)
+        with open (os.path.join (self.directory, '.lock'), 'w') as lock:
+            fcntl.flock (lock, fcntl.LOCK_EX)
+            try:
+                # maybe another process built it while we were waiting
+                arrays = self.load (key)
+                if arrays is None:
+                    log (logging.INFO, 'Building matrix snapshot %s' % self.path (key))
+                    self.save (key, build ())
+                    arrays = self.load (key)
+                    self.prune (key)
+            finally:
+                fcntl.flock (lock, fcntl.LOCK_UN)
+        return arrays
+
+
+    def prune (self, keep):
+        """Remove the snapshots older than the one to keep.
+
+        A snapshot is older if it was built from an older generation or with an
+        older version, or from another database.  Also removes the leftovers
+        of snapshots that were never completed.
+
+        Processes that still map a removed snapshot keep their pages until
+        they unmap them.
+
+        """
+
+        keep_key = parse_key (keep)
+        if keep_key is None:
+            return
+        oid, generation, version = keep_key
+
+        for fn in os.listdir (self.directory):
+            path = os.path.join (self.directory, fn)
+            if fn == keep or not os.path.isdir (path):
+                continue
+            if fn.startswith ('.'):
+                # we hold the lock, so nobody is writing this
+                shutil.rmtree (path, ignore_errors = True)
+                continue
+            key = parse_key (fn)
+            if key is None:
+                continue
+            if key[0] != oid or key[2] < version or (key[2] == version and key[1] < generation):
+                shutil.rmtree (path, ignore_errors = True)
@@ -0,0 +1,396 @@
+# -*- encoding: utf-8 -*-
+
+"""Common routines for the set cover and the optimal substemma.
+
+These routines are used by the application server and by the batch script
+:mod:`scripts.cceh.set_cover`.
+
+See: CBGM_Pres.pdf p. 490ff.
+
+"""
+
+import collections
+import itertools
+import os.path
+
+import numpy as np
+
+from ntg_common.db_tools import execute
+from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix
+from ntg_common.matrix_store import MatrixStore
+
+
+MAX_COVER_SIZE = 12
+
+MATRICES = ('variant_matrix', 'labez_matrix', 'def_matrix', 'mask_matrix',
+            'ancestor_mask_matrix', 'parent_mask_matrix', 'labez_mask_matrix',
+            'reading_matrix')
+""" The matrices of :class:`~ntg_common.cbgm_common.CBGM_Params` this module uses. """
+
+MATRICES_VERSION = 3
+""" Bump this whenever :data:`MATRICES` or their layout change. """
+
+WITH_SELECT = """
+  SELECT pass_id, labez, clique,
+         (1 << (ROW_NUMBER () OVER (PARTITION BY pass_id ORDER BY labez, clique)::integer)) AS rn
+  FROM cliques
+  WHERE labez !~ '^z'
+"""
+
+
+def get_ancestors (conn, rg_id, ms_id):
+    """ Get all ancestors of ms. """
+
+    mode = 'sim'
+    view = 'affinity_view' if mode == 'rec' else 'affinity_p_view'
+
+    res = execute (conn, """
+    SELECT aff.ms_id2 as ms_id
+    FROM
+      {view} aff
+    WHERE aff.ms_id1 = :ms_id1 AND aff.rg_id = :rg_id
+          AND aff.common > 0 AND aff.older < aff.newer
+    ORDER BY affinity DESC, newer DESC, older DESC
+    """, dict (ms_id1  = ms_id,
+               rg_id   = rg_id,
+               view    = view))
+
+    return frozenset ([r[0] for r in res])
+
+
+
+def build_matrices (db):
+    """Build the matrices used by the set cover.
+
+    Returns a :class:`~ntg_common.cbgm_common.CBGM_Params` with the
+    :data:`MATRICES` filled in.
+
+    """
+
+    val = CBGM_Params ()
+
+    with db.engine.begin () as conn:
+        # get max number of different cliques in any one passage
+        res = execute (conn, """
+        SELECT MAX (c)
+        FROM (
+          SELECT COUNT ((labez, clique)) AS c
+          FROM locstem
+          WHERE labez !~ '^z'
+          GROUP BY pass_id
+        ) AS foo
+        """, {})
+        n_cliques = res.fetchone ()[0]
+        # see that the bitmask fits into uint64
+        # one bit is reserved for 'unknown' derivation
+        assert n_cliques < 64
+
+        # load all attestations into one big numpy array
+        create_labez_matrix (db, {}, val)
+
+        # build a mask of all readings of all mss.
+        # every labez_clique gets an id (in the range 1..63)
+
+        # Matrix mss x passages containing the bitmask of all manuscripts readings
+        val.mask_matrix = np.zeros ((val.n_mss, val.n_passages), dtype = np.uint64)
+
+        res = execute (conn, """
+        WITH rn AS (
+          {with}
+        )
+        SELECT msq.ms_id, msq.pass_id, rn1.rn
+        FROM ms_cliques AS msq
+        JOIN (select * from rn) as rn1
+          USING (pass_id, labez, clique)
+        """, { 'with' : WITH_SELECT })
+
+        mask_row = collections.namedtuple ('Mask_Row', 'ms_id, pass_id, shift')
+        for r in res:
+            mask = mask_row._make (r)
+            val.mask_matrix[mask.ms_id - 1, mask.pass_id - 1] = np.uint64 (mask.shift)
+
+        # Matrix mss x passages containing the bitmask of the reading the
+        # manuscript offers to the CBGM, 0 if none or a lacuna
+        val.reading_matrix = np.zeros ((val.n_mss, val.n_passages), dtype = np.uint64)
+
+        res = execute (conn, """
+        WITH rn AS (
+          {with}
+        )
+        SELECT a.ms_id, a.pass_id, rn1.rn
+        FROM apparatus_cliques_view a
+        JOIN rn AS rn1
+          USING (pass_id, labez, clique)
+        WHERE a.cbgm
+        """, { 'with' : WITH_SELECT })
+
+        for ms_id, pass_id, rn in res:
+            val.reading_matrix[ms_id - 1, pass_id - 1] = np.uint64 (rn)
+
+        # Matrix passages x 64 containing for every labez_clique id the bitmask
+        # of all labez_cliques with the same labez
+        val.labez_mask_matrix = np.zeros ((val.n_passages, 64), dtype = np.uint64)
+
+        res = execute (conn, """
+        {with}
+        ORDER BY pass_id, labez
+        """, { 'with' : WITH_SELECT })
+
+        for (pass_id, labez), rows in itertools.groupby (res, lambda r: (r[0], r[1])):
+            rns = [ r[3] for r in rows ]
+            mask = 0
+            for rn in rns:
+                mask |= rn
+            for rn in rns:
+                val.labez_mask_matrix[pass_id - 1, rn.bit_length () - 1] = np.uint64 (mask)
+
+        # Matrix passages x 64 containing for every labez_clique id the bitmask
+        # of the labez_clique and all its ancestors in the local stemma.
+        # Bit 0 is set if any of those readings stems from an unknown source.
+        val.ancestor_mask_matrix = np.zeros ((val.n_passages, 64), dtype = np.uint64)
+
+        # Matrix passages x 64 containing for every labez_clique id the bitmask
+        # of its direct sources.  Bit 0 is set if a source is unknown.
+        val.parent_mask_matrix = np.zeros ((val.n_passages, 64), dtype = np.uint64)
+
+        res = execute (conn, """
+        WITH rn AS (
+          {with}
+        )
+        SELECT ls.pass_id, rn1.rn, ls.source_labez = '?', rn2.rn
+        FROM locstem ls
+        JOIN rn AS rn1
+          USING (pass_id, labez, clique)
+        LEFT JOIN rn AS rn2
+          ON (ls.pass_id, ls.source_labez, ls.source_clique) = (rn2.pass_id, rn2.labez, rn2.clique)
+        ORDER BY ls.pass_id
+        """, { 'with' : WITH_SELECT })
+
+        locstem_row = collections.namedtuple ('LocStem_Row', 'pass_id, rn, unknown, source_rn')
+        for pass_id, rows in itertools.groupby (map (locstem_row._make, res), lambda r: r.pass_id):
+            sources = collections.defaultdict (list)
+            for r in rows:
+                sources[r.rn].append (r)
+
+            for rn in sources:
+                parents = 0
+                for r in sources[rn]:
+                    parents |= (r.source_rn or 0) | (1 if r.unknown else 0)
+                val.parent_mask_matrix[pass_id - 1, rn.bit_length () - 1] = np.uint64 (parents)
+
+                # walk up the local stemma
+                mask = 0
+                todo = [rn]
+                seen = set ()
+                while todo:
+                    n = todo.pop ()
+                    if n in seen:
+                        continue
+                    seen.add (n)
+                    for r in sources.get (n, ()):
+                        mask |= r.rn | (1 if r.unknown else 0)
+                        if r.source_rn is not None:
+                            todo.append (r.source_rn)
+                val.ancestor_mask_matrix[pass_id - 1, rn.bit_length () - 1] = np.uint64 (mask)
+
+    return val
+
+def load_matrices (dba, directory, generation):
+    """Load the matrices for the given data generation.
+
+    The matrices are mapped read-only from a snapshot in `directory` shared by
+    all processes that use the same database.  The first process to need a
+    snapshot builds it.
+
+    Returns a :class:`~ntg_common.cbgm_common.CBGM_Params`.
+
+    """
+
+    with dba.engine.begin () as conn:
+        # the sequence gets a new oid if the database is rebuilt
+        res = execute (conn, "SELECT 'generation_seq'::regclass::oid", {})
+        seq_oid = res.fetchone ()[0]
+
+    def build ():
+        val = build_matrices (dba)
+        return { name : getattr (val, name) for name in MATRICES }
+
+    store = MatrixStore (os.path.join (directory, dba.params['database']))
+    matrices = store.get ('%d-%d-v%d' % (seq_oid, generation, MATRICES_VERSION), build)
+
+    val = CBGM_Params ()
+    for name in MATRICES:
+        setattr (val, name, matrices[name])
+    val.n_mss, val.n_passages = val.labez_matrix.shape
+    return val
+
+
+def build_explain_matrix (val, ms_id):
+    """Build the explain matrix.
+
+    A matrix of 1 x n_passages containing the bitmask of all those readings that
+    would explain the reading in the manuscript under scrutiny.
+
+    Bit 1 means: the reading stems from an unknown source.
+    Bit 2..64 are the bitmask of all cliques.
+
+    The matrix is gathered from the precomputed
+    :attr:`ancestor_mask_matrix` by the readings in :attr:`mask_matrix`.
+
+    """
+
+    mask = val.mask_matrix[ms_id - 1]
+    explain_matrix = np.zeros (val.n_passages, dtype = np.uint64)
+
+    bits = int (np.bitwise_or.reduce (mask)) if len (mask) else 0
+    for bit in range (1, 64):
+        if bits & (1 << bit):
+            b_set = np.bitwise_and (mask, np.uint64 (1 << bit)) > 0
+            explain_matrix[b_set] |= val.ancestor_mask_matrix[b_set, bit]
+
+    return explain_matrix
+
+def cover_vectors (val, ms_id, ancestors, include = ()):
+    """Build the inputs of :func:`greedy_cover` for a manuscript.
+
+    :param int ms_id:     The manuscript to explain.
+    :param ancestors:     The ms_ids of the potential ancestors of the ms.
+    :param include:       Include 'A' and / or 'MT' as potential ancestors.
+
+    """
+
+    ms_id = ms_id - 1  # numpy indices start at 0
+
+    # The mss x passages boolean matrix that is TRUE whenever the inspected
+    # ms. and the source ms. are both defined.
+    b_common = np.logical_and (val.def_matrix, val.def_matrix[ms_id])
+
+    # Remove mss. we don't want to compare
+    b_common[ms_id] = False  # don't find original ms.
+    if 'A' not in include:
+        b_common[0] = False
+    if 'MT' not in include:
+        b_common[1] = False
+    # also eliminate all descendants
+    for i in range (0, val.n_mss):
+        if (i + 1) not in ancestors:
+            b_common[i] = False
+
+    # mask_matrix ist the mss x passages matrix containing the bitmask of
+    # all readings
+    explain_matrix       = build_explain_matrix (val, ms_id + 1)
+    explain_equal_matrix = val.mask_matrix[ms_id]
+
+    # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
+    # agrees with the potential source ms.
+    b_equal = np.bitwise_and (val.mask_matrix, explain_equal_matrix) > 0
+    b_equal = np.logical_and (b_equal, b_common)
+
+    # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
+    # agrees with the potential source ms. or is posterior to it.
+    b_post = np.bitwise_and (val.mask_matrix, explain_matrix) > 0
+    b_post = np.logical_and (b_post, b_common)
+
+    # The 1 x passages boolean matrix that is TRUE whenever the passage is
+    # still unexplained.
+    b_open = np.copy (val.def_matrix[ms_id])
+
+    # The 1 x passages boolean matrix that is TRUE whenever the source of
+    # the reading in the inspected ms. is unknown
+    b_unknown = np.bitwise_and (explain_matrix, 0x1)
+    b_unknown = np.logical_and (b_unknown, b_open)
+
+    return b_equal, b_post, b_unknown, b_open
+
+
+POPCOUNT_TABLE = np.array ([ bin (n).count ('1') for n in range (256) ], dtype = np.uint8)
+""" The number of set bits in every byte. """
+
+
+def pack_bits (b):
+    """Pack a boolean matrix (rows x passages) into a matrix of uint64 words."""
+
+    packed = np.packbits (np.atleast_2d (b), axis = 1)
+    pad = -packed.shape[1] % 8
+    if pad:
+        packed = np.pad (packed, ((0, 0), (0, pad)), 'constant')
+    return np.ascontiguousarray (packed).view (np.uint64)
+
+
+def popcount (words):
+    """ Count the set bits along the last axis of an array of uint64 words. """
+
+    if hasattr (np, 'bitwise_count'):
+        # numpy >= 2.0
+        return np.bitwise_count (words).sum (axis = -1, dtype = np.int64)
+    return POPCOUNT_TABLE[np.ascontiguousarray (words).view (np.uint8)].sum (axis = -1, dtype = np.int64)
+
+
+CoverStep = collections.namedtuple ('CoverStep', 'ms_id explains equal unknown open')
+
+
+def greedy_cover (b_equal, b_post, b_unknown, b_open, pre_selected = (), max_size = MAX_COVER_SIZE):
+    """Approximate the minimum set cover greedily.
+
+    At every step take the manuscript that explains the most still
+    unexplained passages by agreement, and mark the passages it explains by
+    agreement or by being posterior as explained.  The user may pre-select
+    the first manuscripts.
+
+    The passage vectors are packed into bits.  The per-manuscript counts of
+    agreements are updated only in the words that a step newly explains.
+
+    :param b_equal:   Boolean matrix (mss x passages), TRUE where the ms.
+                      explains the passage by agreement.
+    :param b_post:    Boolean matrix (mss x passages), TRUE where the ms.
+                      explains the passage by agreement or by being posterior.
+    :param b_unknown: Boolean vector (passages), TRUE where the source of the
+                      reading is unknown.
+    :param b_open:    Boolean vector (passages), TRUE where the passage needs
+                      explaining.
+    :param pre_selected: Row indices of the pre-selected mss.
+    :return: A list of CoverStep.  CoverStep.ms_id is the row index,
+             CoverStep.unknown and CoverStep.open count the passages still
+             unexplained after the step.
+
+    """
+
+    equal   = pack_bits (b_equal)
+    post    = pack_bits (b_post)
+    unknown = pack_bits (b_unknown)[0]
+    open_   = pack_bits (b_open)[0]
+
+    explained = np.zeros_like (unknown)
+    n_equal   = popcount (equal)
+    steps     = []
+
+    for n in range (max_size):
+        if n < len (pre_selected):
+            # use manuscript pre-selected by user
+            row = pre_selected[n]
+        else:
+            # find manuscript that explains the most passages by agreement
+            row = int (np.argmax (n_equal))
+
+        newly_explained = post[row] & ~explained
+        n_explains = int (popcount (newly_explained))
+        # exit if no passages could be explained
+        if n_explains == 0:
+            break
+
+        step_equal = int (popcount (equal[row] & ~explained))
+
+        # remove "explained" readings, so they will not be matched again
+        words = np.nonzero (newly_explained)[0]
+        n_equal -= popcount (equal[:, words] & newly_explained[words])
+        explained |= newly_explained
+
+        steps.append (CoverStep (
+            row,
+            n_explains,
+            step_equal,
+            int (popcount (unknown & ~explained)),
+            int (popcount (open_ & ~explained))
+        ))
+
+    return steps
@@ -6,7 +6,8 @@ This script
 
 - rebuilds the 'A' text from the local stemmas,
 - calculates the pre-coherence similarity of manuscripts, and
-- calculates the post-coherence ancestrality of manuscripts.
+- calculates the post-coherence ancestrality of manuscripts, and
+- checks the congruence of all passages.
 
 This script updates the tables shown in red in the `overview <db-overwiew>`.
 It also updates the Apparatus table where manuscript 'A is concerned.
@@ -27,10 +28,16 @@ from ntg_common.tools import log
 from ntg_common.config import args, init_logging, config_from_pyfile
 
 from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix, \
-    calculate_mss_similarity_preco, calculate_mss_similarity_postco, write_affinity_table
+    calculate_mss_similarity_preco, calculate_mss_similarity_postco, write_affinity_table, \
+    update_congruence_table
 
 MS_ID_A  = 1
 
+MAINTAIN_TABLES = ('apparatus', 'ms_cliques', 'ms_cliques_tts',
+                   'apparatus_cliques_mat', 'apparatus_view_agg_mat',
+                   'ms_ranges', 'affinity', 'congruence')
+""" The tables this script rewrites. """
+
 def build_A_text (dba, parameters):
     """Build the 'A' text
 
@@ -102,6 +109,11 @@ if __name__ == '__main__':
     log (logging.INFO, "Rebuilding the 'A' text ...")
     build_A_text (db, parameters)
 
+    log (logging.INFO, "Materializing the apparatus views ...")
+    with db.engine.begin () as conn:
+        db_tools.refresh_apparatus_tables (conn)
+        db_tools.invalidate_textflow_cache (conn)
+
     log (logging.INFO, "Creating the labez matrix ...")
     create_labez_matrix (db, parameters, v)
 
@@ -114,7 +126,11 @@ if __name__ == '__main__':
     log (logging.INFO, "Writing affinity table ...")
     write_affinity_table (db, parameters, v)
 
-    log (logging.INFO, "Vacuum ...")
-    db.vacuum ()
+    log (logging.INFO, "Checking the congruence ...")
+    with db.engine.begin () as conn:
+        update_congruence_table (conn, parameters)
+
+    log (logging.INFO, "Maintenance ...")
+    db.maintain (MAINTAIN_TABLES, full_ratio = None)
 
     log (logging.INFO, "Done")
@@ -24,6 +24,8 @@ from ntg_common.db_tools import execute, executemany, warn
 from ntg_common.tools import log
 from ntg_common.config import args, init_logging, config_from_pyfile
 
+from ntg_common.cbgm_common import update_congruence_table
+
 
 def build_parser ():
     parser = argparse.ArgumentParser (description = __doc__)
@@ -187,6 +189,8 @@ if __name__ == '__main__':
         ALTER TABLE ms_cliques ENABLE TRIGGER ms_cliques_trigger;
         """, parameters)
 
+        db_tools.refresh_apparatus_tables (conn)
+        db_tools.invalidate_textflow_cache (conn)
 
     log (logging.INFO, "Loading locstem ...")
 
@@ -269,6 +273,12 @@ if __name__ == '__main__':
         """, parameters)
 
 
+    log (logging.INFO, "Checking the congruence ...")
+
+    with db.engine.begin () as conn:
+        update_congruence_table (conn, parameters)
+
+
     log (logging.INFO, "Loading notes ...")
 
     with db.engine.begin () as conn:
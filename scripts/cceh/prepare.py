@@ -60,11 +60,19 @@ from ntg_common import db
 from ntg_common import tools
 from ntg_common import db_tools
 from ntg_common.db_tools import execute, executemany, executemany_raw, warn, debug, fix
+from ntg_common.interval_index import PassageRangeIndex
 from ntg_common.tools import log
 from ntg_common.config import args, init_logging, config_from_pyfile
 
 MS_ID_MT = 2
 
+MAINTAIN_TABLES = ('att', 'lac', 'books', 'passages', 'ranges', 'passage_ranges',
+                   'manuscripts', 'ms_ranges', 'readings', 'cliques', 'locstem',
+                   'locstem_tts', 'locstem_closure', 'ms_cliques', 'ms_cliques_tts',
+                   'apparatus', 'apparatus_cliques_mat', 'apparatus_view_agg_mat',
+                   'notes', 'nestle')
+""" The tables this script rewrites. """
+
 book = None
 
 
@@ -1187,6 +1195,14 @@ def fill_passages_table (dba, parameters):
         WHERE passage = '[51534013,51534014)';
         """, parameters) # not spanned because inserted after the end
 
+        # The Passage_Ranges Table
+
+        index = PassageRangeIndex.load (conn)
+        executemany_raw (conn, """
+        INSERT INTO passage_ranges (pass_id, rg_id)
+        VALUES (%s, %s)
+        """, parameters, index.membership ())
+
         # Notes
 
         if 'MYSQL_MEMO_TABLE' in config:
@@ -1891,9 +1907,15 @@ if __name__ == '__main__':
                 build_MT_text (dbdest, parameters)
                 continue
 
+            if step == 42:
+                log (logging.INFO, "Step 42 : Materializing the apparatus views ...")
+                with dbdest.engine.begin () as conn:
+                    db_tools.refresh_apparatus_tables (conn)
+                continue
+
             if step == 99:
-                log (logging.INFO, "Step 99 : Vacuum ...")
-                dbdest.vacuum ()
+                log (logging.INFO, "Step 99 : Maintenance ...")
+                dbdest.maintain (MAINTAIN_TABLES)
 
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,144 @@
+# -*- encoding: utf-8 -*-
+
+"""Precompute the set covers of all manuscripts.
+
+This script computes the greedy set cover of every manuscript in a book, the
+same way the application server does for the set cover page when no
+manuscripts are pre-selected.  The manuscripts are distributed over several
+worker processes that share one memory-mapped snapshot of the CBGM matrices.
+
+The results are written into the set_cover table, from where the application
+server serves them until the data changes, or into a CSV file.
+
+Run this script after :mod:`scripts.cceh.cbgm`.
+
+"""
+
+import argparse
+import csv
+import logging
+import multiprocessing
+import sys
+
+from ntg_common import db_tools
+from ntg_common.db_tools import execute, executemany_raw, get_generation
+from ntg_common.tools import log
+from ntg_common.config import args, init_logging, config_from_pyfile
+from ntg_common.set_cover_common import load_matrices, cover_vectors, greedy_cover
+
+val = None
+""" The matrices, mapped before the worker processes are forked. """
+
+
+def cover (task):
+    """ Compute the set cover of one manuscript in a worker process. """
+
+    ms_id, ancestors = task
+    b_equal, b_post, b_unknown, b_open = cover_vectors (val, ms_id, ancestors)
+    return ms_id, greedy_cover (b_equal, b_post, b_unknown, b_open)
+
+
+def build_parser ():
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument ('profile', metavar='path/to/file.conf',
+                         help="a .conf file (required)")
+    parser.add_argument ('-v', '--verbose', dest='verbose', action='count',
+                         help='increase output verbosity', default=0)
+    parser.add_argument ('-j', '--jobs', dest='jobs', type=int,
+                         help='no. of worker processes (default: no. of cpus)',
+                         default=multiprocessing.cpu_count ())
+    parser.add_argument ('--cache-dir', dest='cache_dir', metavar='path/to/cache',
+                         help="the matrix cache directory of the server (default='cache')",
+                         default='cache')
+    parser.add_argument ('-o', '--output', metavar='path/to/output.csv',
+                         help="write a CSV file instead of the set_cover table")
+    return parser
+
+
+if __name__ == '__main__':
+
+    build_parser ().parse_args (namespace = args)
+    config = config_from_pyfile (args.profile)
+
+    init_logging (
+        args,
+        logging.StreamHandler (), # stderr
+        logging.FileHandler ('set_cover.log')
+    )
+
+    parameters = dict ()
+    dba = db_tools.PostgreSQLEngine (**config)
+
+    with dba.engine.begin () as conn:
+        res = execute (conn, "SELECT to_regclass ('generation_seq') IS NOT NULL", parameters)
+        if not res.fetchone ()[0]:
+            log (logging.ERROR, 'This database has no data generation counter.')
+            sys.exit (1)
+        generation = get_generation (conn)
+
+        res = execute (conn, """
+        SELECT rg.rg_id
+        FROM ranges rg
+          JOIN books b USING (bk_id)
+        WHERE b.book = :book AND rg.range = 'All'
+        """, dict (parameters, book = config['BOOK']))
+        rg_id_all = res.fetchone ()[0]
+
+        res = execute (conn, """
+        SELECT ms_id, hs
+        FROM manuscripts
+        ORDER BY ms_id
+        """, parameters)
+        hs = dict (list (res))
+
+        # the potential ancestors of all mss., see set_cover_common.get_ancestors ()
+        res = execute (conn, """
+        SELECT aff.ms_id1, aff.ms_id2
+        FROM affinity_p_view aff
+        WHERE aff.rg_id = :rg_id AND aff.common > 0 AND aff.older < aff.newer
+        """, dict (parameters, rg_id = rg_id_all))
+        ancestors = { ms_id : set () for ms_id in hs }
+        for ms_id1, ms_id2 in res:
+            ancestors[ms_id1].add (ms_id2)
+
+    log (logging.INFO, "Loading the matrices for generation %d ..." % generation)
+    val = load_matrices (dba, args.cache_dir, generation)
+
+    # the workers inherit the memory mapping of the matrices
+    log (logging.INFO, "Computing the set covers with %d processes ..." % args.jobs)
+    tasks = [ (ms_id, frozenset (ancestors[ms_id])) for ms_id in sorted (hs) ]
+    with multiprocessing.get_context ('fork').Pool (args.jobs) as pool:
+        covers = dict (pool.imap_unordered (cover, tasks, chunksize = 8))
+
+    if args.output:
+        log (logging.INFO, "Writing %s ..." % args.output)
+        fp = sys.stdout if args.output == '-' else open (args.output, 'w', encoding='utf-8')
+        writer = csv.writer (fp, dialect='excel')
+        writer.writerow (('hs', 'n', 'cover', 'explains', 'explained', 'equal', 'post',
+                          'unknown', 'open'))
+        for ms_id in sorted (covers):
+            n_explained = 0
+            for n, step in enumerate (covers[ms_id]):
+                n_explained += step.explains
+                writer.writerow ((hs[ms_id], n + 1, hs[step.ms_id + 1],
+                                  step.explains, n_explained, step.equal,
+                                  step.explains - step.equal,
+                                  step.unknown, step.open - step.unknown))
+        if fp is not sys.stdout:
+            fp.close ()
+    else:
+        log (logging.INFO, "Filling the set_cover table ...")
+        with dba.engine.begin () as conn:
+            execute (conn, "TRUNCATE set_cover", parameters)
+            executemany_raw (conn, """
+            INSERT INTO set_cover (ms_id, n, cover_ms_id, explains, equal, unknown, open, generation)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, parameters, [
+                (ms_id, n + 1, step.ms_id + 1, step.explains, step.equal,
+                 step.unknown, step.open, generation)
+                for ms_id in sorted (covers)
+                for n, step in enumerate (covers[ms_id])
+            ])
+
+    log (logging.INFO, "Done")
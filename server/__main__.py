@@ -35,7 +35,12 @@ from ntg_common.config import args, init_logging
 from ntg_common import db_tools
 from ntg_common.exceptions import EditException
 
+import helpers
 import login
+import lookups
+import metrics
+import admission
+import warmup
 import main
 import info
 import static
@@ -45,7 +50,15 @@ import editor
 import set_cover
 import checks
 
-dba = flask_sqlalchemy.SQLAlchemy ()
+
+class SQLAlchemy (flask_sqlalchemy.SQLAlchemy):
+    """ Take the engine of the user authentication database from the pool manager. """
+
+    def create_engine (self, sa_url, engine_opts):
+        return db_tools.pool_manager.get_engine (str (sa_url))
+
+
+dba = SQLAlchemy ()
 user, _role, _roles_users = login.declare_user_model_on (dba)
 db_adapter = flask_user.SQLAlchemyAdapter (dba, user)
 login_manager = flask_login.LoginManager ()
@@ -72,6 +85,28 @@ class Config ():
     WRITE_ACCESS        = 'none'
     CORS_ALLOW_ORIGIN   = '*'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    GENERATION_CHECK_INTERVAL = 5.0
+    MATRIX_CACHE_DIR    = 'cache'
+    SUBSTEMMA_SEARCH_BUDGET = 10.0
+    BATCH_MAX_PASSAGES  = 100
+    TEXTFLOW_CACHE      = True
+    TEXTFLOW_CACHE_WIDTH    = 960.0
+    TEXTFLOW_CACHE_FONTSIZE = 10.0
+    METRICS_TOKEN       = None
+    POOL_SIZE           = 5
+    POOL_MAX_OVERFLOW   = 10
+    POOL_TIMEOUT        = 30
+    POOL_RECYCLE        = -1
+    PREPARED_STATEMENTS = True
+    ADMISSION_CLASSES   = {
+        'heavy'  : (2, 8, 10.0),
+        'medium' : (8, 32, 10.0),
+    }
+    ADMISSION_RATE      = {}
+    ADMISSION_RETRY_AFTER = 5
+    AIO_POOL_SIZE       = 10
+    AIO_THREADS         = 16
+    WARMUP              = True
 
 
 def build_parser (default_config_file = Config.CONFIG_FILE):
@@ -88,6 +123,10 @@ def build_parser (default_config_file = Config.CONFIG_FILE):
         default=default_config_file, metavar='CONFIG_FILE',
         help="the config file (default='./instance/%s')" % default_config_file
     )
+    parser.add_argument (
+        '--async', dest='async_mode', action='store_true',
+        help='serve the most frequent read-only endpoints asynchronously (needs aiohttp and asyncpg)'
+    )
     return parser
 
 
@@ -101,6 +140,8 @@ def do_init_app (app):
     login.init_app (app)
     user_manager.init_app (app, login_manager = login_manager,
                            make_safe_url_function = login.make_safe_url)
+    metrics.init_app (app)
+    admission.init_app (app)
 
     @app.errorhandler (EditException)
     def handle_invalid_edit (ex):
@@ -144,6 +185,8 @@ def create_app (Config):
     app.register_blueprint (static.bp)
     app.register_blueprint (login.bp)
 
+    db_tools.statements.enabled = app.config['PREPARED_STATEMENTS']
+
     app.config.dba = db_tools.PostgreSQLEngine (**app.config)
     user_db_url = app.config.dba.url
     # tell flask_sqlalchemy where the user authentication database is
@@ -151,6 +194,7 @@ def create_app (Config):
 
     static.init_app (app)
     do_init_app (app)
+    warmup.init_app (app)
 
     instances = collections.OrderedDict ()
     extra_files = [instance_path + '/' + Config.CONFIG_FILE]
@@ -178,21 +222,27 @@ def create_app (Config):
         sub_app.register_blueprint (checks.bp)
 
         sub_app.config.dba = db_tools.PostgreSQLEngine (**sub_app.config)
+        sub_app.config.generation = helpers.Generation (
+            sub_app.config.dba, sub_app.config['GENERATION_CHECK_INTERVAL'])
         sub_app.config['SQLALCHEMY_DATABASE_URI'] = user_db_url
 
         do_init_app (sub_app)
+        lookups.init_app (sub_app)
         main.init_app (sub_app)
         textflow.init_app (sub_app)
         comparison.init_app (sub_app)
         editor.init_app (sub_app)
         set_cover.init_app (sub_app)
         checks.init_app (sub_app)
+        warmup.init_app (sub_app)
 
         instances[sub_app.config['APPLICATION_ROOT']] = sub_app
 
     info_app = flask.Flask (__name__)
     info_app.config.update (app.config)
     info_app.register_blueprint (info.bp)
+    info_app.register_blueprint (metrics.bp)
+    info_app.register_blueprint (warmup.bp)
     do_init_app (info_app)
     info.init_app (app, instances)
 
@@ -218,11 +268,16 @@ if __name__ == "__main__":
     Config.CONFIG_FILE = args.config_file
     app = create_app (Config)
 
-    run_simple (
-        app.config['APPLICATION_HOST'],
-        app.config['APPLICATION_PORT'],
-        app,
-        use_reloader = app.config['USE_RELOADER'],
-        use_debugger = app.config['USE_DEBUGGER'],
-        extra_files  = app.config['EXTRA_FILES']
-    )
+    if args.async_mode:
+        import aio
+        aio.run (app)
+    else:
+        run_simple (
+            app.config['APPLICATION_HOST'],
+            app.config['APPLICATION_PORT'],
+            app,
+            threaded     = True,
+            use_reloader = app.config['USE_RELOADER'],
+            use_debugger = app.config['USE_DEBUGGER'],
+            extra_files  = app.config['EXTRA_FILES']
+        )
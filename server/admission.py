@@ -0,0 +1,210 @@
+# -*- encoding: utf-8 -*-
+
+"""An application server for CBGM.  Admission control.
+
+Every endpoint belongs to a cost class.  The endpoints of the classes
+configured in :attr:`ADMISSION_CLASSES` pass a gate that limits how many of
+their requests run at once in this process and how many more may wait for a
+free slot.  Requests that find the queue full, or that wait too long, are
+answered at once with 503.  The endpoints of all other classes are not
+limited, so cheap requests stay responsive while the expensive ones queue.
+
+Optionally :attr:`ADMISSION_RATE` limits how often one user may call the
+endpoints of a class.  Requests over the limit are answered with 429.
+
+Both answers carry a Retry-After header and may be cached for as long.
+
+"""
+
+import math
+import threading
+import time
+
+import flask
+from flask import current_app
+import flask_login
+
+import metrics
+from helpers import make_json_response
+
+
+ROUTE_CLASSES = {
+    'checks.congruence_list_json'           : 'heavy',
+    'set_cover.optimal_substemma_json'      : 'heavy',
+    'set_cover.optimal_substemma_csv'       : 'heavy',
+    'set_cover.optimal_substemma_search_csv': 'heavy',
+    'set_cover.optimal_substemma_detail_csv': 'heavy',
+    'textflow.textflow_png'                 : 'heavy',
+    'textflow.stemma_png'                   : 'heavy',
+    'checks.congruence_json'                : 'medium',
+    'set_cover.set_cover_json'              : 'medium',
+    'textflow.textflow_dot'                 : 'medium',
+    'textflow.stemma_dot'                   : 'medium',
+    'comparison.comparison_summary_csv'     : 'medium',
+    'comparison.comparison_detail_csv'      : 'medium',
+    'main.relatives_csv'                    : 'medium',
+    'main.attesting_csv'                    : 'medium',
+    'main.passages_json'                    : 'medium',
+}
+""" The cost class of the expensive endpoints.  All other endpoints are 'light'. """
+
+
+class Gate ():
+    """Limit the no. of concurrent requests of one cost class.
+
+    At most `limit` requests run at once.  At most `queue` more requests wait
+    for a free slot, each one for at most `timeout` seconds.
+
+    """
+
+    def __init__ (self, limit, queue, timeout):
+        self.limit     = limit
+        self.queue     = queue
+        self.timeout   = timeout
+        self.active    = 0
+        self.waiting   = 0
+        self.condition = threading.Condition ()
+
+
+    def acquire (self):
+        """ Wait for a free slot.  Return False if there is none. """
+
+        with self.condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+            try:
+                if not self.condition.wait_for (lambda: self.active < self.limit, self.timeout):
+                    return False
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+
+    def release (self):
+        """ Free a slot. """
+
+        with self.condition:
+            self.active -= 1
+            self.condition.notify ()
+
+
+class RateLimiter ():
+    """Limit how often each user may call the endpoints of one cost class.
+
+    A token bucket per user that holds up to `burst` tokens and refills at
+    `rate` tokens per second.  A full bucket is the same as none, so the full
+    buckets are dropped every time a bucket takes to refill.
+
+    """
+
+    def __init__ (self, rate, burst):
+        self.rate    = rate
+        self.burst   = burst
+        self.buckets = {}
+        self.pruned  = time.monotonic ()
+        self.lock    = threading.Lock ()
+
+
+    def take (self, user):
+        """ Take a token.  Return 0 on success, else the seconds until the next token. """
+
+        now = time.monotonic ()
+        with self.lock:
+            if now - self.pruned >= self.burst / self.rate:
+                self.prune (now)
+            tokens, last = self.buckets.get (user, (self.burst, now))
+            tokens = min (self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1.0:
+                self.buckets[user] = (tokens - 1.0, now)
+                return 0.0
+            self.buckets[user] = (tokens, now)
+            return (1.0 - tokens) / self.rate
+
+
+    def prune (self, now):
+        """ Drop the buckets that have refilled.  Call with the lock held. """
+
+        self.buckets = {
+            user : (tokens, last) for user, (tokens, last) in self.buckets.items ()
+            if tokens + (now - last) * self.rate < self.burst
+        }
+        self.pruned = now
+
+
+gates = {}
+""" The gates of this process by cost class, set up by the first app. """
+
+limiters = {}
+""" The rate limiters of this process by cost class, set up by the first app. """
+
+lock = threading.Lock ()
+
+
+def get_user ():
+    """ Return the key of the current user for the rate limits. """
+
+    user = flask_login.current_user
+    if user is not None and user.is_authenticated:
+        return 'user:%s' % user.get_id ()
+    return 'addr:%s' % flask.request.remote_addr
+
+
+def reject (status, message, retry_after, cost_class, reason):
+    """ Answer a request that was not admitted. """
+
+    metrics.registry.inc ('ntg_admission_rejected_total', (
+        ('app', current_app.config['APPLICATION_NAME']), ('class', cost_class), ('reason', reason)))
+
+    retry_after = max (1, int (math.ceil (retry_after)))
+    response = make_json_response (None, status, message)
+    response.headers['Retry-After'] = str (retry_after)
+    response.headers['Cache-Control'] = '%s, max-age=%d' % (
+        'private' if status == 429 else 'public', retry_after)
+    return response
+
+
+def init_app (app):
+    """ Initialize the flask app. """
+
+    with lock:
+        for cost_class, (limit, queue, timeout) in app.config['ADMISSION_CLASSES'].items ():
+            if cost_class not in gates:
+                gates[cost_class] = Gate (limit, queue, timeout)
+        for cost_class, (rate, burst) in app.config['ADMISSION_RATE'].items ():
+            if cost_class not in limiters:
+                limiters[cost_class] = RateLimiter (rate, burst)
+
+    @app.before_request
+    def admit ():
+        cost_class = ROUTE_CLASSES.get (flask.request.endpoint, 'light')
+
+        limiter = limiters.get (cost_class)
+        if limiter is not None:
+            wait = limiter.take (get_user ())
+            if wait > 0.0:
+                return reject (429, 'Too many requests.  Please retry later.',
+                               wait, cost_class, 'rate')
+
+        gate = gates.get (cost_class)
+        if gate is not None:
+            start = time.perf_counter ()
+            admitted = gate.acquire ()
+            metrics.registry.observe ('ntg_admission_wait_seconds', (('class', cost_class), ),
+                                      time.perf_counter () - start)
+            if not admitted:
+                return reject (503, 'The server is busy.  Please retry later.',
+                               app.config['ADMISSION_RETRY_AFTER'], cost_class, 'busy')
+            flask.g.ntg_admission_gate = gate
+
+        return None
+
+    @app.teardown_request
+    def leave (_exc):
+        gate = flask.g.pop ('ntg_admission_gate', None)
+        if gate is not None:
+            gate.release ()
@@ -0,0 +1,685 @@
+# -*- encoding: utf-8 -*-
+
+"""An application server for CBGM.  The asynchronous serving mode.
+
+Start the server with :option:`--async` to serve the apps with aiohttp instead
+of the werkzeug development server.
+
+The most frequent read-only endpoints of the books with public read access are
+answered by coroutines.  They query the database through a pool of asyncpg
+connections and run the GraphViz dot program as an asynchronous subprocess.  A
+request that waits on the database or on GraphViz does not hold a thread.
+
+These endpoints are answered by coroutines:
+
+- readings.json, cliques.json, apparatus.json and attestation.json,
+- textflow.dot and textflow.png, from the precomputed textflow if there is one,
+  see :func:`textflow.cached_textflow`, else by running the textflow queries,
+  and
+- checks/congruence.json.
+
+The textflow graph itself is built in a worker thread, because it is CPU bound.
+
+All other requests, and those the coroutines cannot answer, go to the WSGI
+apps, which run in a pool of :attr:`AIO_THREADS` threads.  The editor, the login
+and the books without public read access are always served by the WSGI apps.
+So are the comparison tables and the congruence list: they are computed from
+snapshots held in memory and spend their time in numpy, not waiting.
+
+This mode needs the packages listed in :file:`server/requirements-async.txt`.
+
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import io
+import logging
+import math
+import sys
+import threading
+import time
+import urllib.parse
+
+import aiohttp.web
+import asyncpg
+import flask
+import werkzeug.datastructures
+
+from ntg_common import db_tools
+from ntg_common.tools import log
+
+import admission
+import checks
+import helpers
+import metrics
+import textflow
+
+
+QUEUE_SIZE = 8
+""" The no. of chunks a WSGI app may produce ahead of the client. """
+
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding')
+""" The headers of a WSGI response that aiohttp sets itself. """
+
+TEXTFLOW_SQL = """
+SELECT graph, dot, width, fontsize
+FROM textflow_cache
+WHERE (pass_id, mode) = (:pass_id, :mode)
+  AND generation >= COALESCE ((SELECT generation
+                               FROM table_generation
+                               WHERE table_name = 'affinity'), 0)
+"""
+
+
+def to_asyncpg (sql, parameters):
+    """Convert a query in the style of :func:`ntg_common.db_tools.execute`.
+
+    Formats the query with the parameters and replaces the bind parameters with
+    the positional parameters asyncpg understands.  Returns the query and the
+    list of arguments.
+
+    """
+
+    sql     = sql.format (**parameters)
+    numbers = {}
+
+    def number (m):
+        return '$%d' % numbers.setdefault (m.group (1), len (numbers) + 1)
+
+    sql = db_tools.RE_BIND.sub (number, sql)
+    return sql, [ parameters[name] for name in numbers ]
+
+
+async def fetch (pool, sql, parameters):
+    """ Execute a query and return all rows. """
+
+    sql, args = to_asyncpg (sql, parameters)
+    return await pool.fetch (sql, *args)
+
+
+async def fetchrow (pool, sql, parameters):
+    """ Execute a query and return the first row or None. """
+
+    sql, args = to_asyncpg (sql, parameters)
+    return await pool.fetchrow (sql, *args)
+
+
+async def graphviz_layout (dot, format = 'dot'):
+    """ Like :func:`ntg_common.tools.graphviz_layout` but does not block. """
+
+    p = await asyncio.create_subprocess_exec (
+        'dot', '-T%s' % format,
+        stdin  = asyncio.subprocess.PIPE,
+        stdout = asyncio.subprocess.PIPE,
+        stderr = asyncio.subprocess.PIPE)
+
+    try:
+        outs, errs = await asyncio.wait_for (p.communicate (dot.encode ('utf-8')), 15)
+    except asyncio.TimeoutError:
+        p.kill ()
+        outs, errs = await p.communicate ()
+
+    if errs:
+        log (logging.ERROR, errs)
+
+    return outs
+
+
+class Gate ():
+    """Limit the no. of concurrent coroutines of one cost class.
+
+    The asynchronous counterpart of :class:`admission.Gate`.  Its slots are
+    separate from those of the WSGI apps.
+
+    """
+
+    def __init__ (self, limit, queue, timeout):
+        self.semaphore = asyncio.Semaphore (limit)
+        self.queue     = queue
+        self.timeout   = timeout
+        self.waiting   = 0
+
+
+    async def acquire (self):
+        """ Wait for a free slot.  Return False if there is none. """
+
+        if self.semaphore.locked () and self.waiting >= self.queue:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for (self.semaphore.acquire (), self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+
+    def release (self):
+        """ Free a slot. """
+
+        self.semaphore.release ()
+
+
+class Instance ():
+    """ The coroutines serve one book through this. """
+
+    def __init__ (self, app):
+        self.app    = app
+        self.config = app.config
+        self.name   = app.config['APPLICATION_NAME']
+        self.root   = app.config['APPLICATION_ROOT']
+        self.pool   = None
+
+
+    async def open (self):
+        """ Open the pool of database connections. """
+
+        params = self.config.dba.params
+        self.pool = await asyncpg.create_pool (
+            host     = params['host'],
+            port     = int (params['port']),
+            user     = params['user'],
+            database = params['database'],
+            min_size = 1,
+            max_size = int (self.config['AIO_POOL_SIZE']),
+            server_settings = { 'ntg.user_id' : '0' },
+        )
+
+
+    async def close (self):
+        """ Close the pool of database connections. """
+
+        if self.pool is not None:
+            await self.pool.close ()
+
+
+    async def passage (self, passage_or_id):
+        """Find a passage by passage or id like :class:`helpers.Passage` does.
+
+        Returns the pass_id and the id of the range 'All' of the book or None if
+        there is no such passage.
+
+        """
+
+        start, end = helpers.Passage.fix (str (passage_or_id))
+
+        if int (start) > 10000000:
+            where, params = 'p.begadr = :begadr AND p.endadr = :endadr', dict (
+                begadr = int (start), endadr = int (end))
+        else:
+            where, params = 'p.pass_id = :pass_id', dict (pass_id = int (start))
+
+        return await fetchrow (self.pool, """
+        SELECT p.pass_id, r.rg_id
+        FROM passages p
+          LEFT JOIN ranges_view r
+            ON r.bk_id = adr2bk_id (p.begadr) AND r.range = 'All'
+        WHERE {where}
+        """, dict (params, where = where))
+
+
+    def make_response (self, body, content_type):
+        """ Make a response with the headers the WSGI apps add. """
+
+        if isinstance (body, str):
+            body = body.encode ('utf-8')
+        return aiohttp.web.Response (body = body, headers = {
+            'content-type' : content_type,
+            'Access-Control-Allow-Origin'      : self.config['CORS_ALLOW_ORIGIN'],
+            'Access-Control-Allow-Credentials' : 'true',
+            'Content-Security-Policy'          : 'worker-src blob:',
+            'Server'                           : 'Jetty 0.8.15',
+        })
+
+
+    def make_json_response (self, json = None, status = 200, message = None):
+        """ Like :func:`helpers.make_json_response`. """
+
+        d = dict (status = status)
+        if json is not None:
+            d['data'] = json
+        if message is not None:
+            d['message'] = message
+        response = self.make_response (
+            flask.json.dumps (d, app = self.app, separators = (',', ':')) + '\n',
+            'application/json;charset=utf-8')
+        response.set_status (status)
+        return response
+
+
+def wants_columns (request):
+    """ Like :func:`helpers.wants_columns`.  The coroutines leave that format to the WSGI apps. """
+
+    return (request.query.get ('format') == 'columns'
+            or helpers.COLUMNS_MIMETYPE in request.headers.get ('Accept', ''))
+
+
+async def readings_json (instance, request, passage):
+    res = await fetch (instance.pool, """
+    SELECT labez
+    FROM readings
+    WHERE pass_id = :pass_id AND labez != 'zz'
+    ORDER BY labez
+    """, dict (pass_id = passage['pass_id']))
+
+    response = instance.make_json_response ([
+        { 'labez' : r['labez'], 'labez_i18n' : helpers.LABEZ_I18N.get (r['labez'], r['labez']) }
+        for r in res
+    ])
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+
+async def cliques_json (instance, request, passage):
+    res = await fetch (instance.pool, """
+    SELECT labez, clique, labez_clique (labez, clique) AS labez_clique
+    FROM cliques
+    WHERE pass_id = :pass_id
+    ORDER BY labez, clique
+    """, dict (pass_id = passage['pass_id']))
+
+    return instance.make_json_response ([ dict (r) for r in res ])
+
+
+async def apparatus_json (instance, request, passage):
+    if wants_columns (request):
+        return None
+
+    readings = await fetch (instance.pool, """
+    SELECT labez, reading (labez, lesart) AS lesart
+    FROM readings
+    WHERE pass_id = :pass_id
+    ORDER BY labez
+    """, dict (pass_id = passage['pass_id']))
+
+    manuscripts = await fetch (instance.pool, """
+    SELECT labez, clique, labez_clique, labezsuf, reading (labez, lesart) AS lesart,
+           ms_id, hs, hsnr,
+           certainty::numeric::float8 AS certainty -- the shortest decimal, like psycopg2 reads float4
+    FROM apparatus_view_agg_mat
+    WHERE pass_id = :pass_id
+    ORDER BY hsnr, labez, clique
+    """, dict (pass_id = passage['pass_id']))
+
+    response = instance.make_json_response ({
+        'readings'    : [ dict (r) for r in readings ],
+        'manuscripts' : [ dict (r) for r in manuscripts ],
+    })
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+async def attestation_json (instance, request, passage):
+    if wants_columns (request):
+        return None
+
+    res = await fetch (instance.pool, """
+    SELECT ms_id, labez
+    FROM apparatus
+    WHERE pass_id = :pass_id
+    ORDER BY ms_id
+    """, dict (pass_id = passage['pass_id']))
+
+    response = instance.make_json_response ({
+        'attestations' : { str (r['ms_id']) : r['labez'] for r in res }
+    })
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+async def cached_textflow (instance, request, passage):
+    """ Like :func:`textflow.cached_textflow`. """
+
+    query = request.query
+    mode  = query.get ('mode') or 'sim'
+    if not instance.config['TEXTFLOW_CACHE'] or mode not in textflow.TEXTFLOW_CACHE_MODES:
+        return None
+    if query.get ('labez') or (query.get ('hyp_a') or 'A') != 'A':
+        return None
+    for arg in ('include[]', 'fragments[]', 'checks[]', 'var_only[]', 'cliques[]'):
+        if arg in query:
+            return None
+    if (int (query.get ('rg_id', 0)) or passage['rg_id']) != passage['rg_id']:
+        return None
+
+    row = await fetchrow (instance.pool, TEXTFLOW_SQL, dict (pass_id = passage['pass_id'], mode = mode))
+    metrics.registry.inc ('ntg_cache_requests_total', (
+        ('app', instance.name), ('cache', 'textflow'), ('result', 'miss' if row is None else 'hit')))
+    if row is None:
+        return None
+    return textflow.CachedTextflow (row['graph'], row['dot'], row['width'], row['fontsize'])
+
+
+async def excluded_ms_ids (instance, include):
+    """ Like :func:`helpers.get_excluded_ms_ids`. """
+
+    exclude = set (helpers.EXCLUDE_REGEX_MAP.keys ()) - set (include)
+    if not exclude:
+        return [-1] # a non-existing id
+    exclude = [ helpers.EXCLUDE_REGEX_MAP[x] for x in exclude ]
+
+    res = await fetch (instance.pool, """
+    SELECT ms_id
+    FROM manuscripts
+    WHERE hs ~ :regex
+    ORDER BY ms_id
+    """, dict (regex = '^({exclude})$'.format (exclude = '|'.join (exclude))))
+
+    return [ r['ms_id'] for r in res ] or [-1]
+
+
+async def congruence (instance, pass_id):
+    """ Like :func:`checks.congruence`. """
+
+    res = await fetch (instance.pool, checks.CONGRUENCE_SQL, dict (pass_id = pass_id))
+    return [ checks.Ranks._make (r) for r in res ]
+
+
+async def textflow_source (instance, request, passage, cached):
+    """Return the dot file of a textflow before the layout.
+
+    Like :func:`textflow.textflow`.  Runs the queries of
+    :func:`textflow.textflow_graph` on the asyncpg pool and builds the graph in
+    a worker thread.
+
+    """
+
+    a = textflow.textflow_args (werkzeug.datastructures.MultiDict (list (request.query.items ())))
+
+    if cached is not None:
+        return helpers.body_to_dot (cached.graph.split ('\n') if cached.graph else [],
+                                    a.width, a.fontsize)
+
+    pool   = instance.pool
+    rg_id  = int (request.query.get ('rg_id', 0)) or passage['rg_id']
+    params = textflow.textflow_params (passage['pass_id'], rg_id, a.labez, a.hyp_a,
+                                       a.connectivity, a.mode, a.fragments, a.var_only)
+    params['exclude'] = await excluded_ms_ids (instance, a.include)
+
+    res = await fetch (pool, textflow.NODES_SQL, params)
+    nodes = { r['ms_id'] for r in res }
+    if not nodes:
+        nodes = { -1 } # a non-existing id
+
+    res = await fetch (pool, textflow.RANKS_SQL, dict (params, nodes = list (nodes)))
+    ranks = [ textflow.Ranks._make (r) for r in res ]
+
+    ms_ids = { r.ms_id1 for r in ranks } | { r.ms_id2 for r in ranks } | nodes
+    res = await fetch (pool, textflow.MSS_SQL, dict (params, ms_ids = list (ms_ids)))
+    mss = [ textflow.Mss._make (r) for r in res ]
+
+    congruent = await congruence (instance, passage['pass_id']) if a.checks else ()
+
+    def build ():
+        graph = textflow.build_textflow_graph (ranks, mss, a.labez, a.hyp_a, a.include,
+                                               a.var_only, a.cliques, congruent)
+        return textflow.textflow_dot_source (graph, a)
+
+    return await asyncio.get_event_loop ().run_in_executor (request.app['executor'], build)
+
+
+async def textflow_dot (instance, request, passage):
+    cached = await cached_textflow (instance, request, passage)
+    if cached is not None and cached.dot is not None:
+        width    = helpers.clip (10.0, request.query.get ('width')    or 0.0,  1600.0)
+        fontsize = helpers.clip ( 6.0, request.query.get ('fontsize') or 10.0,   72.0)
+        if (cached.width, cached.fontsize) == (width, fontsize):
+            return instance.make_response (cached.dot, 'text/vnd.graphviz;charset=utf-8')
+
+    dot = await textflow_source (instance, request, passage, cached)
+    with metrics.timer ('ntg_graphviz_seconds', format = 'dot'):
+        dot = await graphviz_layout (dot)
+    return instance.make_response (dot, 'text/vnd.graphviz;charset=utf-8')
+
+
+async def textflow_png (instance, request, passage):
+    dot = await textflow_source (instance, request, passage,
+                                 await cached_textflow (instance, request, passage))
+    with metrics.timer ('ntg_graphviz_seconds', format = 'png'):
+        png = await graphviz_layout (dot, format = 'png')
+    return instance.make_response (png, 'image/png')
+
+
+async def congruence_json (instance, request, passage):
+    return instance.make_json_response (await congruence (instance, passage['pass_id']))
+
+
+ROUTES = (
+    ('/readings.json/{passage_or_id}',          'main.readings_json',     readings_json),
+    ('/cliques.json/{passage_or_id}',           'main.cliques_json',      cliques_json),
+    ('/apparatus.json/{passage_or_id}',         'main.apparatus_json',    apparatus_json),
+    ('/attestation.json/{passage_or_id}',       'main.attestation_json',  attestation_json),
+    ('/textflow.dot/{passage_or_id}',           'textflow.textflow_dot',  textflow_dot),
+    ('/textflow.png/{passage_or_id}',           'textflow.textflow_png',  textflow_png),
+    ('/checks/congruence.json/{passage_or_id}', 'checks.congruence_json', congruence_json),
+)
+""" The endpoints answered by coroutines, with the names of their WSGI endpoints. """
+
+
+def reject (instance, status, message, retry_after, cost_class, reason):
+    """ Like :func:`admission.reject`. """
+
+    metrics.registry.inc ('ntg_admission_rejected_total', (
+        ('app', instance.name), ('class', cost_class), ('reason', reason)))
+
+    retry_after = max (1, int (math.ceil (retry_after)))
+    response = instance.make_json_response (None, status, message)
+    response.headers['Retry-After'] = str (retry_after)
+    response.headers['Cache-Control'] = '%s, max-age=%d' % (
+        'private' if status == 429 else 'public', retry_after)
+    return response
+
+
+async def serve (instance, endpoint, handler, request):
+    """Answer a request with a coroutine.
+
+    Hands the request to the WSGI apps if the coroutine cannot answer it.
+
+    """
+
+    start      = time.perf_counter ()
+    cost_class = admission.ROUTE_CLASSES.get (endpoint, 'light')
+
+    limiter = admission.limiters.get (cost_class)
+    if limiter is not None:
+        wait = limiter.take ('addr:%s' % request.remote)
+        if wait > 0.0:
+            return reject (instance, 429, 'Too many requests.  Please retry later.',
+                           wait, cost_class, 'rate')
+
+    gate = request.app['gates'].get (cost_class)
+    if gate is not None:
+        admitted = await gate.acquire ()
+        metrics.registry.observe ('ntg_admission_wait_seconds', (('class', cost_class), ),
+                                  time.perf_counter () - start)
+        if not admitted:
+            return reject (instance, 503, 'The server is busy.  Please retry later.',
+                           instance.config['ADMISSION_RETRY_AFTER'], cost_class, 'busy')
+
+    try:
+        passage  = await instance.passage (request.match_info['passage_or_id'])
+        response = None
+        if passage is not None:
+            response = await handler (instance, request, passage)
+    except ValueError:
+        response = None
+    finally:
+        if gate is not None:
+            gate.release ()
+
+    if response is None:
+        return await serve_wsgi (request)
+
+    metrics.registry.observe ('ntg_request_duration_seconds', (
+        ('app', instance.name), ('endpoint', endpoint), ('status', str (response.status))),
+                              time.perf_counter () - start)
+    return response
+
+
+def make_environ (request, body):
+    """ Make the WSGI environment of a request. """
+
+    config = request.app['config']
+    path   = urllib.parse.unquote_to_bytes (request.raw_path.split ('?', 1)[0])
+
+    environ = {
+        'REQUEST_METHOD'    : request.method,
+        'SCRIPT_NAME'       : '',
+        'PATH_INFO'         : path.decode ('latin-1'),
+        'QUERY_STRING'      : request.query_string,
+        'CONTENT_TYPE'      : request.headers.get ('Content-Type', ''),
+        'CONTENT_LENGTH'    : str (len (body)),
+        'SERVER_NAME'       : config['APPLICATION_HOST'],
+        'SERVER_PORT'       : str (config['APPLICATION_PORT']),
+        'SERVER_PROTOCOL'   : 'HTTP/%d.%d' % request.version,
+        'REMOTE_ADDR'       : request.remote or '',
+        'wsgi.version'      : (1, 0),
+        'wsgi.url_scheme'   : request.scheme,
+        'wsgi.input'        : io.BytesIO (body),
+        'wsgi.errors'       : sys.stderr,
+        'wsgi.multithread'  : True,
+        'wsgi.multiprocess' : False,
+        'wsgi.run_once'     : False,
+    }
+
+    for name, value in request.headers.items ():
+        key = 'HTTP_' + name.upper ().replace ('-', '_')
+        if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            continue
+        environ[key] = environ[key] + ',' + value if key in environ else value
+
+    return environ
+
+
+def run_wsgi (wsgi_app, environ, loop, queue, cancelled):
+    """Run the WSGI apps in a worker thread.
+
+    Puts the status and the headers and then the chunks of the body onto the
+    queue, and None when done.  The whole response is produced in this thread
+    because a streamed flask response needs its request context.
+
+    """
+
+    def put (item):
+        asyncio.run_coroutine_threadsafe (queue.put (item), loop).result ()
+
+    def start_response (status, headers, exc_info = None):
+        put ((status, headers))
+        return put
+
+    result = None
+    try:
+        result = wsgi_app (environ, start_response)
+        for chunk in result:
+            if cancelled.is_set ():
+                break
+            if chunk:
+                put (chunk)
+    except Exception as e:
+        log (logging.ERROR, 'Error in WSGI app: %s' % e)
+    finally:
+        if hasattr (result, 'close'):
+            result.close ()
+        put (None)
+
+
+async def drain (queue):
+    """ Discard the rest of a WSGI response so that the worker thread can finish. """
+
+    while await queue.get () is not None:
+        pass
+
+
+async def serve_wsgi (request):
+    """ Answer a request with the WSGI apps. """
+
+    body      = await request.read ()
+    loop      = asyncio.get_event_loop ()
+    queue     = asyncio.Queue (QUEUE_SIZE)
+    cancelled = threading.Event ()
+    finished  = False
+
+    loop.run_in_executor (request.app['executor'], run_wsgi, request.app['wsgi'],
+                          make_environ (request, body), loop, queue, cancelled)
+
+    try:
+        item = await queue.get ()
+        if item is None:
+            finished = True
+            return aiohttp.web.Response (status = 500)
+
+        status, headers = item
+        code, _sep, reason = status.partition (' ')
+        response = aiohttp.web.StreamResponse (status = int (code), reason = reason or None)
+        for name, value in headers:
+            if name.lower () not in HOP_BY_HOP_HEADERS:
+                response.headers.add (name, value)
+
+        await response.prepare (request)
+        while True:
+            chunk = await queue.get ()
+            if chunk is None:
+                finished = True
+                break
+            await response.write (chunk)
+        await response.write_eof ()
+        return response
+    finally:
+        if not finished:
+            cancelled.set ()
+            asyncio.ensure_future (drain (queue))
+
+
+def make_app (wsgi_app):
+    """ Make the aiohttp app. """
+
+    config = wsgi_app.config
+    app    = aiohttp.web.Application ()
+
+    app['config']    = config
+    app['wsgi']      = wsgi_app
+    app['instances'] = []
+    app['gates']     = {}
+
+    for root, sub_app in wsgi_app.mounts.items ():
+        if 'main' not in sub_app.blueprints or sub_app.config['READ_ACCESS'] != 'public':
+            continue
+        instance = Instance (sub_app)
+        app['instances'].append (instance)
+        for path, endpoint, handler in ROUTES:
+            app.router.add_get (root + path, functools.partial (serve, instance, endpoint, handler))
+
+    app.router.add_route ('*', '/{path:.*}', serve_wsgi)
+
+    async def startup (app):
+        app['executor'] = concurrent.futures.ThreadPoolExecutor (
+            max_workers = int (config['AIO_THREADS']), thread_name_prefix = 'wsgi')
+        for cost_class, (limit, queue, timeout) in config['ADMISSION_CLASSES'].items ():
+            app['gates'][cost_class] = Gate (limit, queue, timeout)
+        for instance in app['instances']:
+            await instance.open ()
+            log (logging.INFO, 'Serving {name} at {root} asynchronously'.format (
+                name = instance.name, root = instance.root))
+
+    async def cleanup (app):
+        for instance in app['instances']:
+            await instance.close ()
+        app['executor'].shutdown (wait = False)
+
+    app.on_startup.append (startup)
+    app.on_cleanup.append (cleanup)
+    return app
+
+
+def run (wsgi_app):
+    """ Serve the apps with aiohttp. """
+
+    config = wsgi_app.config
+    aiohttp.web.run_app (
+        make_app (wsgi_app),
+        host = config['APPLICATION_HOST'],
+        port = int (config['APPLICATION_PORT']),
+        print = None,
+    )
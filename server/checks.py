@@ -6,7 +6,6 @@
 
 import collections
 import itertools
-import logging
 
 import flask
 from flask import request, current_app
@@ -15,9 +14,8 @@ import numpy as np
 
 from ntg_common.db_tools import execute
 from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix
-from ntg_common import tools
 
-from helpers import Passage, Manuscript, make_json_response, csvify
+from helpers import Passage, Manuscript, make_json_response, make_json_stream_response, csvify
 
 
 bp = flask.Blueprint ('checks', __name__)
@@ -29,97 +27,37 @@ def init_app (app):
     pass
 
 
-def congruence (conn, passage):
-    """Check the congruence.
-
-    "Das Prüfprogramm soll eine Inkongruenz anzeigen, wenn der Zeuge einer Lesart
-    x, die im lokalen Stemma von y abhängt UND (bei x keinen pV mit Conn <= 5
-    hat ODER bei y keinen pV mit höherem Rang hat als ein weiterer pV bei einer
-    anderen Variante), nicht mit x ODER x(n) der Quelle "?" zugeordnet wird."
-    -- email K. Wachtel 16.01.2020
+CONGRUENCE_SQL = """
+SELECT ms1.hs, ms2.hs, c.ms_id1, c.ms_id2, c.labez_clique1, c.labez_clique2, c.rank
+FROM congruence c
+  JOIN manuscripts ms1 ON ms1.ms_id = c.ms_id1
+  JOIN manuscripts ms2 ON ms2.ms_id = c.ms_id2
+WHERE c.pass_id = :pass_id
+ORDER BY ms2.hs, c.rank
+"""
+""" Get the congruence violations of a passage. """
 
-    Wenn Lesart x im lokalen Stemma von y != ? abhängt, muß jeder Zeuge der
-    Lesart x:
+Ranks = collections.namedtuple ('Ranks', 'ms1 ms2 ms_id1 ms_id2 labez1 labez2 rank')
 
-    1. einen pV(conn=5) der Lesart x haben, oder
 
-    2. der höchste pV(!= zz) die Lesart y haben.
+def congruence (conn, passage):
+    """Check the congruence.
 
-    Wenn Lesart x im lokalen Stemma von ? abhängt, ist keine Aussage möglich.
+    Return the congruence violations of the passage.  They are precomputed by
+    :func:`~ntg_common.cbgm_common.update_congruence_table`, which see for the
+    rules.
 
     """
 
-    res = execute (conn, """
-    -- get the closest ancestors ms1 for every manuscript ms2
-    WITH ranks AS (
-      SELECT
-        aff.ms_id1,
-        aff.ms_id2,
-        ms1.hs as hs1,
-        ms2.hs as hs2,
-        q1.labez AS labez1,
-        q2.labez AS labez2,
-        q1.clique AS clique1,
-        q2.clique AS clique2,
-        labez_clique (q1.labez, q1.clique) as lq1,
-        labez_clique (q2.labez, q2.clique) as lq2,
-        l.source_labez,
-        l.source_clique,
-        labez_clique (l.source_labez, l.source_clique) as source_lq,
-        rank () OVER (PARTITION BY ms_id2 ORDER BY affinity DESC, common, older, newer DESC, ms_id1) AS rank,
-        affinity
-      FROM affinity_p_view aff
-        JOIN manuscripts ms1 ON ms1.ms_id = aff.ms_id1
-        JOIN manuscripts ms2 ON ms2.ms_id = aff.ms_id2
-        JOIN apparatus_cliques_view q1 ON q1.ms_id = aff.ms_id1 AND q1.pass_id = :pass_id
-        JOIN apparatus_cliques_view q2 ON q2.ms_id = aff.ms_id2 AND q2.pass_id = :pass_id
-        JOIN locstem l ON (l.pass_id, l.labez, l.clique) = (q2.pass_id, q2.labez, q2.clique)
-      WHERE ms_id1 NOT IN :exclude
-        AND ms_id2 NOT IN :exclude
-        AND q1.labez != 'zz'
-        AND q2.labez != 'zz'
-        AND q1.certainty = 1.0
-        AND q2.certainty = 1.0
-        AND aff.rg_id = :rg_id
-        AND aff.newer < aff.older
-        AND aff.common > aff.ms2_length / 2
-      ORDER BY affinity DESC
-    )
-
-    -- output mss that fail both rules
-    SELECT hs1, hs2, ms_id1, ms_id2, lq1, lq2, rank
-    FROM ranks r
-    WHERE lq1 != lq2
-      AND r.source_labez != '?'
-      AND r.rank <= :connectivity
-      AND -- ms2 fails rule 1
-        NOT EXISTS (
-          SELECT 1 FROM ranks rr
-          WHERE rr.ms_id2 = r.ms_id2
-            AND rr.lq1    = r.lq2
-            AND rr.rank  <= :connectivity
-        )
-      AND -- ms2 fails rule 2
-        NOT EXISTS (
-          SELECT * FROM ranks rr
-          WHERE rr.ms_id2     = r.ms_id2
-            AND (rr.source_lq = r.lq1 OR rr.source_labez = '?')
-            AND rr.rank <= 1
-        )
-    ORDER BY hs2, rank
-    """, dict (
-        rg_id   = passage.range_id ('All'),
+    res = execute (conn, CONGRUENCE_SQL, dict (
         pass_id = passage.pass_id,
-        connectivity = 5,
-        exclude = (2,),
     ))
 
-    Ranks = collections.namedtuple ('Ranks', 'ms1 ms2 ms_id1 ms_id2 labez1 labez2 rank')
-    ranks = list (map (Ranks._make, res))
+    return list (map (Ranks._make, res))
 
-    tools.log (logging.INFO, 'rg_id: ' + str (passage.range_id ('All')))
 
-    return ranks
+CONGRUENCE_CHUNK = 256
+""" No. of passages :func:`congruence_list` checks in one vectorized step. """
 
 
 def congruence_list (conn, passage, range_id):
@@ -140,105 +78,150 @@ def congruence_list (conn, passage, range_id):
 
     Wenn Lesart x im lokalen Stemma von ? abhängt, ist keine Aussage möglich.
 
+    This function reads the certain readings and the local stemmas of all
+    passages in the range into arrays and checks the rules with numpy.  It
+    returns a generator that yields the failing manuscripts passage by passage.
+
     """
 
+    connectivity = 5
+    max_rank     = 2 * connectivity # speed things up
+    exclude      = (1, 2)
+
+    res = execute (conn, """
+    SELECT ms_id, hs, hsnr
+    FROM manuscripts
+    ORDER BY ms_id
+    """, {})
+    mss  = list (res)
+    n_ms = mss[-1][0] + 1
+    hs   = { ms_id : hs_ for ms_id, hs_, hsnr in mss }
+    hsnr = np.zeros (n_ms, dtype = np.int64)
+    for ms_id, hs_, hsnr_ in mss:
+        hsnr[ms_id] = hsnr_
+
+    # get the closest ancestors ms1 for every manuscript ms2
+    # ancestors[ms_id2, rank - 1] = ms_id1, 0 = none
     res = execute (conn, """
-    -- get the closest ancestors ms1 for every manuscript ms2
-    WITH ranked AS (
+    SELECT ms_id2, ms_id1, rank
+    FROM (
       SELECT
         ms_id1,
         ms_id2,
-        rank () OVER (PARTITION BY ms_id2 ORDER BY affinity DESC, common, older, newer DESC, ms_id1) AS rank,
-        affinity
+        rank () OVER (PARTITION BY ms_id2 ORDER BY affinity DESC, common, older, newer DESC, ms_id1) AS rank
       FROM affinity_p_view aff
       WHERE ms_id1 NOT IN :exclude
         AND ms_id2 NOT IN :exclude
         AND aff.rg_id = :rg_id
         AND aff.newer < aff.older
         AND aff.common > aff.ms2_length / 2
-      ORDER BY ms_id2, affinity DESC
-    ),
-
-    -- get readings
-    readings AS (
-      SELECT
-        p.pass_id,
-        p.begadr,
-        p.endadr,
-        r.ms_id1,
-        r.ms_id2,
-        r.rank,
-        q1.labez AS labez1,
-        q2.labez AS labez2,
-        q1.clique AS clique1,
-        q2.clique AS clique2,
-        labez_clique (q1.labez, q1.clique) as lq1,
-        labez_clique (q2.labez, q2.clique) as lq2,
-        l.source_labez  as source_l2,
-        l.source_clique as source_q2,
-        labez_clique (l.source_labez, l.source_clique) as source_lq2,
-        row_number () OVER (PARTITION BY p.pass_id, r.ms_id2 ORDER BY r.rank) as row_no,
-        count (*) FILTER (WHERE q1.labez !~ '^z') OVER (
-           PARTITION BY p.pass_id, r.ms_id2
-           ORDER BY r.rank
-           ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) as row_no_no_zz
-      FROM passages p
-        JOIN ranges rg ON (rg.rg_id = :range_id AND rg.passage @> p.passage)
-      CROSS JOIN ranked r
-        JOIN apparatus_cliques_view q1 ON q1.ms_id = r.ms_id1 AND q1.pass_id = p.pass_id
-        JOIN apparatus_cliques_view q2 ON q2.ms_id = r.ms_id2 AND q2.pass_id = p.pass_id
-        JOIN locstem l ON (l.pass_id, l.labez, l.clique) = (q2.pass_id, q2.labez, q2.clique)
-      WHERE q1.certainty = 1.0
-        AND q2.certainty = 1.0
-        AND r.rank <= 2 * :connectivity -- speed things up
-      ORDER BY pass_id, ms_id2, rank
-    )
-
-    -- output mss that fail both rules
-    SELECT
-      r.pass_id, r.begadr, r.endadr, ms1.hs AS hs1, ms2.hs AS hs2, r.ms_id1, r.ms_id2, r.lq1, r.lq2, r.rank
-    FROM readings r
-      JOIN manuscripts ms1 ON ms1.ms_id = r.ms_id1
-      JOIN manuscripts ms2 ON ms2.ms_id = r.ms_id2
-    WHERE r.lq2       != lq1
-      AND r.labez1    !~ '^z'
-      AND r.labez2    !~ '^z'
-      AND r.source_l2 != '?'
-      AND r.row_no    = 1
-      -- ancestor ms1 reads different from descendant ms2
-      AND -- ms2 fails rule 1 (muß einen pV(conn=5) der Lesart x haben)
-        NOT EXISTS (
-          SELECT 1 FROM readings c
-          WHERE c.ms_id2  = r.ms_id2
-            AND c.pass_id = r.pass_id
-            AND c.lq1     = r.lq2
-            AND c.row_no <= :connectivity
-        )
-      AND -- ms2 fails rule 2 (der höchste pV(!= zz) muß die Lesart y haben)
-        NOT EXISTS (
-          SELECT 1 FROM readings c
-          WHERE c.ms_id2  = r.ms_id2
-            AND c.pass_id = r.pass_id
-            AND c.lq1     = r.source_lq2
-            AND c.row_no_no_zz = 1
-        )
-
-    ORDER BY pass_id, ms1.hsnr
+    ) AS ranked
+    WHERE rank <= :max_rank
     """, dict (
-        rg_id = passage.range_id ('All'),
-        range_id = range_id,
-        connectivity = 5,
-        exclude = (1,2),
+        rg_id    = passage.range_id ('All'),
+        exclude  = exclude,
+        max_rank = max_rank,
     ))
 
-    Ranks = collections.namedtuple ('Ranks', 'pass_id begadr endadr ms1 ms2 ms_id1 ms_id2 labez1 labez2 rank')
-    ranks = []
-    for r in res:
-        rank = Ranks._make (r)._asdict ()
-        rank['hr'] = Passage.static_to_hr (rank['begadr'], rank['endadr'])
-        ranks.append (rank)
+    ancestors = np.zeros ((n_ms, max_rank), dtype = np.int64)
+    for ms_id2, ms_id1, rank in res:
+        ancestors[ms_id2, rank - 1] = ms_id1
+
+    res = execute (conn, """
+    SELECT p.pass_id, p.begadr, p.endadr
+    FROM passages p
+      JOIN passage_ranges pr ON (pr.rg_id = :range_id AND pr.pass_id = p.pass_id)
+    ORDER BY p.pass_id
+    """, dict (range_id = range_id))
+    passages = list (res)
+    pass_index = { row[0] : i for i, row in enumerate (passages) }
+
+    # every labez_clique gets a code, 0 = no certain reading
+    codes = {}
+    is_z  = [False]
+
+    def code (labez, lq):
+        if lq not in codes:
+            codes[lq] = len (is_z)
+            is_z.append (labez.startswith ('z'))
+        return codes[lq]
+
+    res = execute (conn, """
+    SELECT q.pass_id, q.ms_id, q.labez, labez_clique (q.labez, q.clique)
+    FROM apparatus_cliques_mat q
+      JOIN passage_ranges pr ON (pr.rg_id = :range_id AND pr.pass_id = q.pass_id)
+    WHERE q.certainty = 1.0
+    """, dict (range_id = range_id))
 
-    return ranks
+    readings = np.zeros ((len (passages), n_ms), dtype = np.int32)
+    for pass_id, ms_id, labez, lq in res:
+        readings[pass_index[pass_id], ms_id] = code (labez, lq)
+
+    res = execute (conn, """
+    SELECT l.pass_id, l.labez, labez_clique (l.labez, l.clique),
+           l.source_labez, labez_clique (l.source_labez, l.source_clique)
+    FROM locstem l
+      JOIN passage_ranges pr ON (pr.rg_id = :range_id AND pr.pass_id = l.pass_id)
+    """, dict (range_id = range_id))
+    locstem = [ (pass_index[pass_id], code (labez, lq), source_labez, code (source_labez, source_lq))
+                for pass_id, labez, lq, source_labez, source_lq in list (res) ]
+
+    n_codes = len (is_z)
+    is_z    = np.array (is_z)
+
+    # has_source[p, lq] is set if the reading is in the local stemma,
+    # unknown[p, lq] if it derives from '?'
+    has_source = np.zeros ((len (passages), n_codes), dtype = np.bool_)
+    unknown    = np.zeros ((len (passages), n_codes), dtype = np.bool_)
+    sources    = []
+    for p, lq, source_labez, source_lq in locstem:
+        has_source[p, lq] = True
+        if source_labez == '?':
+            unknown[p, lq] = True
+        sources.append ((p * n_codes + lq) * n_codes + source_lq)
+    sources = np.array (sources, dtype = np.int64)
+
+    Ranks = collections.namedtuple ('Ranks', 'pass_id begadr endadr ms1 ms2 ms_id1 ms_id2 labez1 labez2 rank')
+    labez_clique = { c : lq for lq, c in codes.items () }
+
+    def check (start, end):
+        lq2 = readings[start:end]                          # passages x mss
+        lq1 = lq2[:, ancestors]                            # passages x mss x ranks
+        p   = np.arange (start, end)[:, None]
+
+        # the ancestors with a certain reading, in order of rank
+        valid  = lq1 > 0
+        row_no = np.cumsum (valid, axis = 2)
+        first  = np.argmax (valid, axis = 2)
+        top    = np.take_along_axis (lq1, first[:, :, None], axis = 2)[:, :, 0]
+
+        # ms2 fails rule 1: no pV(conn=5) reads x
+        rule1 = ((lq1 == lq2[:, :, None]) & valid & (row_no <= connectivity)).any (axis = 2)
+        # ms2 fails rule 2: the highest pV does not read y
+        rule2 = np.isin ((p * n_codes + lq2) * n_codes + top, sources)
+
+        fail = (valid.any (axis = 2) & (lq2 > 0) & (top != lq2)
+                & ~is_z[lq2] & ~is_z[top]
+                & has_source[p, lq2] & ~unknown[p, lq2]
+                & ~rule1 & ~rule2)
+
+        for i, ms_id2 in zip (*np.nonzero (fail)):
+            ms_id1 = ancestors[ms_id2, first[i, ms_id2]]
+            yield hsnr[ms_id1], hsnr[ms_id2], start + i, ms_id1, ms_id2, first[i, ms_id2] + 1
+
+    def generate ():
+        for start in range (0, len (passages), CONGRUENCE_CHUNK):
+            end = min (start + CONGRUENCE_CHUNK, len (passages))
+            for _, _, p, ms_id1, ms_id2, rank in sorted (check (start, end), key = lambda r: (r[2], r[0], r[1])):
+                pass_id, begadr, endadr = passages[p]
+                rank = Ranks (
+                    pass_id, begadr, endadr, hs[ms_id1], hs[ms_id2], int (ms_id1), int (ms_id2),
+                    labez_clique[readings[p, ms_id1]], labez_clique[readings[p, ms_id2]], int (rank)
+                )._asdict ()
+                rank['hr'] = Passage.static_to_hr (begadr, endadr)
+                yield rank
+
+    return generate ()
 
 
 @bp.route ('/checks/congruence.json/<passage_or_id>')
@@ -256,4 +239,5 @@ def congruence_list_json (range_id):
 
     with current_app.config.dba.engine.begin () as conn:
         passage = Passage (conn, 1)
-        return make_json_response (congruence_list (conn, passage, range_id))
+        ranks = congruence_list (conn, passage, range_id)
+    return make_json_stream_response (ranks)
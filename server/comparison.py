@@ -3,22 +3,191 @@
 """The comparison function of the API server for CBGM."""
 
 import collections
+import logging
+import os.path
+import threading
 
 import flask
 from flask import request, current_app
 
-from ntg_common.db_tools import execute
+import numpy as np
+import sqlalchemy
+
+from ntg_common.db_tools import execute, get_table_generation
+from ntg_common.matrix_store import MatrixStore
+from ntg_common.tools import log
 
 from login import auth
-from helpers import csvify, parameters, Passage, Manuscript
+import metrics
+from helpers import csvify_stream, stream_rows, parameters, Passage, Manuscript, get_lookups
+import set_cover
 
 
 bp = flask.Blueprint ('comparison', __name__)
 
+AFFINITY_MATRICES = ('rg_ids', 'common', 'equal', 'older', 'newer', 'unclear', 'length')
+""" The arrays in a snapshot of the affinity table. """
+
+AFFINITY_VERSION = 1
+""" Bump this whenever :data:`AFFINITY_MATRICES` or their layout change. """
+
 
-def init_app (_app):
+def init_app (app):
     """ Initialize the flask app. """
 
+    app.config.affinity = None
+    app.config.affinity_lock = threading.Lock ()
+    app.config.affinity_rebuilding = False
+
+
+def build_affinity (dba):
+    """Read the affinity table into arrays.
+
+    The arrays `common`, `equal`, `older`, `newer` and `unclear` have the
+    dimensions ranges x mss x mss and are indexed by (range index, ms_id1,
+    ms_id2).  `older`, `newer` and `unclear` hold the p_older, p_newer and
+    p_unclear columns.  `length` holds the lengths from ms_ranges.
+
+    """
+
+    with dba.engine.begin () as conn:
+        res = execute (conn, "SELECT rg_id FROM ranges ORDER BY rg_id", {})
+        rg_ids = np.array ([ row[0] for row in res ], dtype = np.int64)
+        rg_index = { rg_id : i for i, rg_id in enumerate (rg_ids.tolist ()) }
+
+        res = execute (conn, "SELECT COALESCE (MAX (ms_id), 0) + 1 FROM manuscripts", {})
+        n_mss = res.fetchone ()[0]
+
+        arrays = { 'rg_ids' : rg_ids }
+        for name in ('common', 'equal', 'older', 'newer', 'unclear'):
+            arrays[name] = np.zeros ((len (rg_ids), n_mss, n_mss), dtype = np.uint16)
+
+        res = execute (conn, """
+        SELECT rg_id, ms_id1,
+               array_agg (ms_id2), array_agg (common), array_agg (equal),
+               array_agg (p_older), array_agg (p_newer), array_agg (p_unclear)
+        FROM affinity
+        GROUP BY rg_id, ms_id1
+        """, {})
+
+        for rg_id, ms_id1, ms_id2, *columns in res:
+            r = rg_index[rg_id]
+            for name, column in zip (('common', 'equal', 'older', 'newer', 'unclear'), columns):
+                arrays[name][r, ms_id1, ms_id2] = column
+
+        arrays['length'] = np.zeros ((len (rg_ids), n_mss), dtype = np.uint16)
+        res = execute (conn, "SELECT rg_id, ms_id, length FROM ms_ranges", {})
+        for rg_id, ms_id, length in res:
+            arrays['length'][rg_index[rg_id], ms_id] = length
+
+    return arrays
+
+
+def load_affinity (config, generation):
+    """Load the snapshot of the affinity table for the given data generation.
+
+    The snapshot is shared by all processes and is tagged with the generation
+    of the last change to the affinity table, so it survives edits that do not
+    touch the affinity table.  Returns None if the database does not record
+    that generation.
+
+    """
+
+    dba = config.dba
+    try:
+        with dba.engine.begin () as conn:
+            table_generation = get_table_generation (conn, 'affinity')
+            res = execute (conn, "SELECT 'generation_seq'::regclass::oid", {})
+            seq_oid = res.fetchone ()[0]
+    except sqlalchemy.exc.DBAPIError as e:
+        log (logging.WARNING, 'Cannot read the affinity generation: %s' % e.orig)
+        return None
+    if table_generation is None:
+        return None
+
+    affinity = config.affinity
+    if affinity is None or affinity['generation'] != table_generation:
+        store = MatrixStore (os.path.join (config['MATRIX_CACHE_DIR'],
+                                           dba.params['database'] + '-affinity'))
+        key = '%d-%d-v%d' % (seq_oid, table_generation, AFFINITY_VERSION)
+        affinity = store.get (key, lambda: build_affinity (dba))
+    affinity = dict (affinity)
+    affinity['generation'] = table_generation
+    affinity['checked']    = generation
+    return affinity
+
+
+def rebuild_affinity (config, generation):
+    """Rebuild the snapshot of the affinity table in a background thread.
+
+    The requests keep using the old snapshot, or the database if there is
+    none, until the new one is ready.
+
+    """
+
+    with config.affinity_lock:
+        if config.affinity_rebuilding:
+            return
+        config.affinity_rebuilding = True
+
+    def run ():
+        try:
+            affinity = load_affinity (config, generation)
+            with config.affinity_lock:
+                config.affinity = affinity
+        except Exception as e:
+            log (logging.ERROR, 'Cannot rebuild the affinity snapshot: %s' % e)
+        finally:
+            with config.affinity_lock:
+                config.affinity_rebuilding = False
+
+    threading.Thread (target = run, name = 'affinity-rebuild', daemon = True).start ()
+
+
+def get_affinity (wait = False):
+    """Return a snapshot of the affinity table or None.
+
+    If the data has changed since the snapshot was loaded, a rebuild is started
+    and the old snapshot is returned.  Returns None while there is no snapshot
+    yet, or if the database does not record the generation of the affinity
+    table.
+
+    :param bool wait: Load the snapshot in this thread instead.
+
+    """
+
+    config = current_app.config
+    if not config['MATRIX_CACHE_DIR']:
+        return None
+    generation = config.generation.current ()
+    if generation is None:
+        return None
+
+    affinity = config.affinity
+    if affinity is not None and affinity['checked'] == generation:
+        metrics.cache_hit ('affinity')
+        return affinity
+
+    metrics.cache_miss ('affinity')
+    if wait:
+        affinity = load_affinity (config, generation)
+        with config.affinity_lock:
+            config.affinity = affinity
+        return affinity
+
+    rebuild_affinity (config, generation)
+    return affinity
+
+
+def get_current_val ():
+    """ Return the set cover matrices if they are up to date, else None. """
+
+    config = current_app.config
+    val = set_cover.get_val ()
+    if val.generation is None or val.generation != config.generation.current ():
+        return None
+    return val
+
 
 _ComparisonRow = collections.namedtuple (
     'ComparisonRow',
@@ -39,11 +208,65 @@ class _ComparisonRowCalcFields (_ComparisonRow):
         return collections.OrderedDict (zip (self._fields, self + (self.norel, )))
 
 
+def _in_snapshot (affinity, *ms_ids):
+    """Return True if the snapshot knows the manuscripts.
+
+    An old snapshot that is served while the new one is built may not know the
+    manuscripts added since.
+
+    """
+
+    return all (ms_id is not None and ms_id < affinity['common'].shape[1] for ms_id in ms_ids)
+
+
+def _comparison_summary_arrays (affinity, ms_id1, ms_id2):
+    """ Compute the chapter summary from a snapshot of the affinity table. """
+
+    tables = get_lookups ()
+    names  = { rg_id : range_ for (bk_id, range_), rg_id in tables.rg_by_name.items () }
+    common, equal = affinity['common'], affinity['equal']
+    older, newer  = affinity['older'],  affinity['newer']
+
+    rows = []
+    for r, rg_id in enumerate (affinity['rg_ids'].tolist ()):
+        c = int (common[r, ms_id1, ms_id2])
+        if c == 0:
+            # no row in the affinity table
+            continue
+        e = int (equal[r, ms_id1, ms_id2])
+        o = int (older[r, ms_id1, ms_id2])
+        n = int (newer[r, ms_id1, ms_id2])
+        aff = e / c
+
+        # rank among the potential ancestors of ms1 resp. descendants of ms2
+        if n > o:
+            commons, equals = common[r, ms_id1, :], equal[r, ms_id1, :]
+            mask = (commons > 0) & (newer[r, ms_id1, :] > older[r, ms_id1, :])
+        elif n < o:
+            commons, equals = common[r, :, ms_id2], equal[r, :, ms_id2]
+            mask = (commons > 0) & (newer[r, :, ms_id2] < older[r, :, ms_id2])
+        else:
+            mask = None
+
+        rank = None
+        if mask is not None:
+            affs = equals[mask] / commons[mask]
+            rank = int (np.count_nonzero (affs > aff)) + 1
+
+        rows.append (_ComparisonRowCalcFields (
+            rg_id, names[rg_id], c, e, o, n, int (affinity['unclear'][r, ms_id1, ms_id2]), aff, rank,
+            int (affinity['length'][r, ms_id1]), int (affinity['length'][r, ms_id2])
+        ))
+
+    return rows
+
+
 def comparison_summary ():
     """Output comparison of 2 witnesses, chapter summary.
 
     Outputs a summary of the differences between 2 manuscripts, one summary row
-    per chapters.
+    per chapters.  Served from a snapshot of the affinity table if there is
+    one.
 
     """
 
@@ -51,51 +274,54 @@ def comparison_summary ():
         ms1 = Manuscript (conn, request.args.get ('ms1') or 'A')
         ms2 = Manuscript (conn, request.args.get ('ms2') or 'A')
 
-        res = execute (conn, """
-        (WITH ranks AS (
-          SELECT ms_id1, ms_id2, rg_id, rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank, affinity
-          FROM affinity aff
-          WHERE ms_id1 = :ms_id1
-            AND {prefix}newer > {prefix}older
-          ORDER BY affinity DESC
-        )
-
-        SELECT a.rg_id, a.range, a.common, a.equal,
-               a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
-        FROM {view} a
-        JOIN ranks r     USING (rg_id, ms_id1, ms_id2)
-        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2
-        )
-
-        UNION
-
-        (WITH ranks2 AS (
-          SELECT ms_id1, ms_id2, rg_id, rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank, affinity
-          FROM affinity aff
-          WHERE ms_id2 = :ms_id2
-            AND {prefix}newer < {prefix}older
-          ORDER BY affinity DESC
-        )
-
-        SELECT a.rg_id, a.range, a.common, a.equal,
-               a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
-        FROM {view} a
-        JOIN ranks2 r USING (rg_id, ms_id1, ms_id2)
-        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2
-        )
-
-        UNION
-
-        SELECT a.rg_id, a.range, a.common, a.equal,
-               a.older, a.newer, a.unclear, a.affinity, NULL, ms1_length, ms2_length
-        FROM {view} a
-        WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2 AND a.newer = a.older
-
-        ORDER BY rg_id
-        """, dict (parameters, ms_id1 = ms1.ms_id, ms_id2 = ms2.ms_id,
-                   view = 'affinity_p_view', prefix = 'p_'))
-
-        return list (map (_ComparisonRowCalcFields._make, res))
+        affinity = get_affinity ()
+        if affinity is not None and get_lookups () is not None and _in_snapshot (
+                affinity, ms1.ms_id, ms2.ms_id):
+            return _comparison_summary_arrays (affinity, ms1.ms_id, ms2.ms_id)
+
+    return stream_rows (_ComparisonRowCalcFields, """
+    (WITH ranks AS (
+      SELECT ms_id1, ms_id2, rg_id, rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank, affinity
+      FROM affinity aff
+      WHERE ms_id1 = :ms_id1
+        AND {prefix}newer > {prefix}older
+      ORDER BY affinity DESC
+    )
+
+    SELECT a.rg_id, a.range, a.common, a.equal,
+           a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
+    FROM {view} a
+    JOIN ranks r     USING (rg_id, ms_id1, ms_id2)
+    WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2
+    )
+
+    UNION
+
+    (WITH ranks2 AS (
+      SELECT ms_id1, ms_id2, rg_id, rank () OVER (PARTITION BY rg_id ORDER BY affinity DESC) AS rank, affinity
+      FROM affinity aff
+      WHERE ms_id2 = :ms_id2
+        AND {prefix}newer < {prefix}older
+      ORDER BY affinity DESC
+    )
+
+    SELECT a.rg_id, a.range, a.common, a.equal,
+           a.older, a.newer, a.unclear, a.affinity, r.rank, ms1_length, ms2_length
+    FROM {view} a
+    JOIN ranks2 r USING (rg_id, ms_id1, ms_id2)
+    WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2
+    )
+
+    UNION
+
+    SELECT a.rg_id, a.range, a.common, a.equal,
+           a.older, a.newer, a.unclear, a.affinity, NULL, ms1_length, ms2_length
+    FROM {view} a
+    WHERE a.ms_id1 = :ms_id1 AND a.ms_id2 = :ms_id2 AND a.newer = a.older
+
+    ORDER BY rg_id
+    """, dict (parameters, ms_id1 = ms1.ms_id, ms_id2 = ms2.ms_id,
+               view = 'affinity_p_view', prefix = 'p_'))
 
 
 _ComparisonDetailRow = collections.namedtuple (
@@ -120,10 +346,69 @@ class _ComparisonDetailRowCalcFields (_ComparisonDetailRow):
         return collections.OrderedDict (zip (self._fields, self + (self.pass_hr, self.norel)))
 
 
+def _bit_index (masks):
+    """ Return the index of the bit set in each of the one-bit masks. """
+
+    return np.log2 (np.maximum (masks, 1).astype (np.float64)).astype (np.intp)
+
+
+def _comparison_detail_arrays (conn, val, ms_id1, ms_id2, range_):
+    """ Compute the chapter detail from the set cover matrices. """
+
+    tables = get_lookups ()
+    pass_ids = [ tables.index.passages_of_range (rg_id)
+                 for (bk_id, name), rg_id in tables.rg_by_name.items () if name == range_ ]
+    if not pass_ids:
+        return []
+    p = np.unique (np.concatenate (pass_ids)).astype (np.intp) - 1
+
+    r1 = val.reading_matrix[ms_id1 - 1, p]
+    r2 = val.reading_matrix[ms_id2 - 1, p]
+    b1 = _bit_index (r1)
+    b2 = _bit_index (r2)
+
+    # both mss. offer a reading that is not a lacuna and the labez differs
+    differ = (r1 != 0) & (r2 != 0) & ((val.labez_mask_matrix[p, b2] & r1) == 0)
+
+    parents1 = val.parent_mask_matrix[p, b1]
+    parents2 = val.parent_mask_matrix[p, b2]
+    older    = (parents2 & r1) != 0
+    newer    = (parents1 & r2) != 0
+    unclear  = ((parents1 | parents2) & 1) != 0
+
+    differ = np.nonzero (differ)[0]
+    if len (differ) == 0:
+        return []
+
+    res = execute (conn, """
+    SELECT pass_id, ms_id, labez_clique, lesart
+    FROM apparatus_cliques_mat
+    WHERE cbgm AND ms_id IN :ms_ids AND pass_id IN :pass_ids
+    """, dict (parameters, ms_ids = (ms_id1, ms_id2),
+               pass_ids = tuple ((p[differ] + 1).tolist ())))
+    readings = { (pass_id, ms_id) : (labez_clique, lesart) for pass_id, ms_id, labez_clique, lesart in res }
+
+    rows = []
+    for i in differ.tolist ():
+        pass_id = int (p[i]) + 1
+        if (pass_id, ms_id1) not in readings or (pass_id, ms_id2) not in readings:
+            # changed since the matrices were built
+            continue
+        passage = tables.passage (pass_id)
+        rows.append (_ComparisonDetailRowCalcFields (
+            pass_id, passage[1], passage[2],
+            *readings[(pass_id, ms_id1)], *readings[(pass_id, ms_id2)],
+            bool (older[i]), bool (newer[i]), bool (unclear[i])
+        ))
+
+    return rows
+
+
 def comparison_detail ():
     """Output comparison of 2 witnesses, chapter detail.
 
     Outputs a detail of the differences between 2 manuscripts in one chapter.
+    Served from the set cover matrices if they are up to date.
     """
 
     with current_app.config.dba.engine.begin () as conn:
@@ -131,24 +416,32 @@ def comparison_detail ():
         ms2 = Manuscript (conn, request.args.get ('ms2') or 'A')
         range_ = request.args.get ('range') or 'All'
 
-        res = execute (conn, """
-        SELECT p.pass_id, p.begadr, p.endadr, v1.labez_clique, v1.lesart,
-                                              v2.labez_clique, v2.lesart,
-          is_p_older (p.pass_id, v1.labez, v1.clique, v2.labez, v2.clique) AS older,
-          is_p_older (p.pass_id, v2.labez, v2.clique, v1.labez, v1.clique) AS newer,
-          is_p_unclear (p.pass_id, v1.labez, v1.clique) OR
-          is_p_unclear (p.pass_id, v2.labez, v2.clique) AS unclear
-        FROM (SELECT * FROM ranges WHERE range = :range_) r
-          JOIN passages p ON (r.passage @> p.passage )
-          JOIN apparatus_cliques_view v1 USING (pass_id)
-          JOIN apparatus_cliques_view v2 USING (pass_id)
-        WHERE v1.ms_id = :ms1 AND v2.ms_id = :ms2
-          AND v1.labez != v2.labez AND v1.labez !~ '^z' AND v2.labez !~ '^z'
-          AND v1.cbgm AND v2.cbgm
-        ORDER BY p.pass_id
-        """, dict (parameters, ms1 = ms1.ms_id, ms2 = ms2.ms_id, range_ = range_))
-
-        return list (map (_ComparisonDetailRowCalcFields._make, res))
+        val = get_current_val ()
+        if val is not None and get_lookups () is not None:
+            return _comparison_detail_arrays (conn, val, ms1.ms_id, ms2.ms_id, range_)
+
+    return stream_rows (_ComparisonDetailRowCalcFields, """
+    SELECT p.pass_id, p.begadr, p.endadr, v1.labez_clique, v1.lesart,
+                                          v2.labez_clique, v2.lesart,
+      EXISTS (SELECT 1 FROM locstem l
+              WHERE (l.pass_id, l.labez, l.clique, l.source_labez, l.source_clique)
+                  = (p.pass_id, v2.labez, v2.clique, v1.labez, v1.clique)) AS older,
+      EXISTS (SELECT 1 FROM locstem l
+              WHERE (l.pass_id, l.labez, l.clique, l.source_labez, l.source_clique)
+                  = (p.pass_id, v1.labez, v1.clique, v2.labez, v2.clique)) AS newer,
+      EXISTS (SELECT 1 FROM locstem l
+              WHERE l.pass_id = p.pass_id AND l.source_labez = '?'
+                AND (l.labez, l.clique) IN ((v1.labez, v1.clique), (v2.labez, v2.clique))) AS unclear
+    FROM (SELECT rg_id FROM ranges WHERE range = :range_) r
+      JOIN passage_ranges pr USING (rg_id)
+      JOIN passages p USING (pass_id)
+      JOIN apparatus_cliques_mat v1 USING (pass_id)
+      JOIN apparatus_cliques_mat v2 USING (pass_id)
+    WHERE v1.ms_id = :ms1 AND v2.ms_id = :ms2
+      AND v1.labez != v2.labez AND v1.labez !~ '^z' AND v2.labez !~ '^z'
+      AND v1.cbgm AND v2.cbgm
+    ORDER BY p.pass_id
+    """, dict (parameters, ms1 = ms1.ms_id, ms2 = ms2.ms_id, range_ = range_))
 
 
 @bp.route ('/comparison-summary.csv')
@@ -157,7 +450,7 @@ def comparison_summary_csv ():
 
     auth ()
 
-    return csvify (_ComparisonRowCalcFields._fields, comparison_summary ())
+    return csvify_stream (_ComparisonRowCalcFields._fields, comparison_summary ())
 
 
 @bp.route ('/comparison-detail.csv')
@@ -166,4 +459,4 @@ def comparison_detail_csv ():
 
     auth ()
 
-    return csvify (_ComparisonDetailRowCalcFields._fields, comparison_detail ())
+    return csvify_stream (_ComparisonDetailRowCalcFields._fields, comparison_detail ())
@@ -16,6 +16,7 @@ from ntg_common import tools
 from ntg_common import db_tools
 from ntg_common.exceptions import EditError, PrivilegeError
 from ntg_common.db_tools import execute
+from ntg_common.cbgm_common import update_congruence_table
 
 from login import auth, private_auth, edit_auth
 from helpers import parameters, Passage, make_json_response, make_text_response
@@ -226,11 +227,20 @@ def stemma_edit (passage_or_id):
 
             tools.log (logging.INFO, 'Moved ms_ids: ' + str (ms_ids))
 
+        # the cliques of the manuscripts may have changed
+        db_tools.refresh_apparatus_tables (conn, passage.pass_id)
+        db_tools.invalidate_textflow_cache (conn, passage.pass_id)
+
+        # the local stemma changed: recheck the congruence of this passage
+        update_congruence_table (conn, parameters, passage.pass_id)
+
         # return the changed passage
         passage = Passage (conn, passage_or_id)
-        return make_json_response (passage.to_json ())
+        response = make_json_response (passage.to_json ())
 
-    raise EditError ('Could not edit local stemma.')
+    # the edit is committed: have the caches of this process reloaded
+    current_app.config.generation.invalidate ()
+    return response
 
 
 @bp.route ('/notes.txt/<passage_or_id>', methods = ['GET', 'PUT'])
@@ -301,11 +311,11 @@ def notes_json (range_id):
         res = execute (conn, """
         SELECT pass_id, begadr, endadr, note
         FROM passages_view p
-        JOIN ranges rg
-          ON (rg.passage @> p.passage)
+        JOIN passage_ranges pr
+          USING (pass_id)
         JOIN notes
           USING (pass_id)
-        WHERE rg.rg_id = :range_id
+        WHERE pr.rg_id = :range_id
         ORDER BY pass_id
         """, dict (parameters, range_id = range_id))
 
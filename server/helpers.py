@@ -4,16 +4,23 @@
 """ An application server for CBGM.  Helper classes. """
 
 import collections
+import csv
+import io
 import itertools
+import logging
 import re
 import os
 import os.path
+import threading
+import time
 
 import flask
 import flask_login
+import sqlalchemy
 
 from ntg_common import tools
-from ntg_common.db_tools import execute, to_csv
+from ntg_common.db_tools import execute, execute_stream, to_csv, get_generation
+from ntg_common.tools import log
 
 
 parameters = dict ()
@@ -56,6 +63,10 @@ def get_excluded_ms_ids (conn, include):
         return tuple ([-1]) # a non-existing id to avoid an SQL syntax error
     exclude = [ EXCLUDE_REGEX_MAP[x] for x in exclude]
 
+    tables = get_lookups ()
+    if tables is not None:
+        return tables.manuscripts_matching ('^({exclude})$'.format (exclude = '|'.join (exclude)))
+
     # get ids of nodes to exclude
     res = execute (conn, """
     SELECT ms_id
@@ -71,6 +82,75 @@ class Bag ():
     """ Class to stick values in. """
 
 
+class Generation ():
+    """Poll the data generation counter of one database.
+
+    Asking the database on every request would cost a round-trip, so the
+    counter is polled at most once every `interval` seconds.  Call
+    :meth:`invalidate` after a write to force a poll on the next call.
+
+    """
+
+    def __init__ (self, dba, interval = 5.0):
+        self.dba      = dba
+        self.interval = interval
+        self.value    = None
+        self.checked  = None
+        self.polling  = False
+        self.lock     = threading.Lock ()
+
+
+    def current (self):
+        """Return the current generation or None if the database has none.
+
+        The database is polled outside of the lock.  While one thread polls the
+        others get the last value.
+
+        """
+
+        now = time.monotonic ()
+        with self.lock:
+            checked = self.checked
+            if checked is not None and (self.polling or now - checked < self.interval):
+                return self.value
+            self.polling = True
+
+        try:
+            with self.dba.engine.begin () as conn:
+                value = get_generation (conn)
+        except sqlalchemy.exc.DBAPIError as e:
+            log (logging.WARNING, 'Cannot read the data generation: %s' % e.orig)
+            value = None
+
+        with self.lock:
+            self.polling = False
+            # do not overwrite an invalidation or a newer poll
+            if self.checked is checked:
+                self.value   = value
+                self.checked = now
+            elif self.checked is not None:
+                value = self.value
+        return value
+
+
+    def invalidate (self):
+        """ Force a poll on the next call to :meth:`current`. """
+
+        with self.lock:
+            self.checked = None
+
+
+def get_lookups ():
+    """ Return the lookup tables of the current app or None. """
+
+    if not flask.has_app_context ():
+        return None
+    lookups = getattr (flask.current_app.config, 'lookups', None)
+    if lookups is None:
+        return None
+    return lookups.current ()
+
+
 class Manuscript ():
     """ Represent one manuscript. """
 
@@ -96,13 +176,17 @@ class Manuscript ():
         else:
             return
 
-        res = execute (conn, """
-        SELECT ms_id, hs, hsnr
-        FROM manuscripts
-        WHERE {where} = :param
-        """, dict (parameters, where = where, param = param))
+        tables = get_lookups ()
+        if tables is not None:
+            row = tables.manuscript (where, param)
+        else:
+            res = execute (conn, """
+            SELECT ms_id, hs, hsnr
+            FROM manuscripts
+            WHERE {where} = :param
+            """, dict (parameters, where = where, param = param))
+            row = res.fetchone ()
 
-        row = res.fetchone ()
         if row is not None:
             self.ms_id, self.hs, self.hsnr = row
 
@@ -192,7 +276,13 @@ class Passage ():
         self.pass_id, self.start, self.end, self.bk_id, self.chapter = 0, 0, 0, 0, 0
         start, end =  self.fix (str (passage_or_id))
 
-        if int (start) > 10000000:
+        tables = get_lookups ()
+        if tables is not None:
+            if int (start) > 10000000:
+                row = tables.passage_by_adr (int (start), int (end))
+            else:
+                row = tables.passage (int (start))
+        elif int (start) > 10000000:
             res = execute (conn, """
             SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
             FROM passages
@@ -205,7 +295,8 @@ class Passage ():
             WHERE pass_id = :pass_id
             """, dict (parameters, pass_id = start))
 
-        row = res.fetchone ()
+        if tables is None:
+            row = res.fetchone ()
         if row is not None:
             self.pass_id, self.start, self.end, self.bk_id, self.chapter = row
 
@@ -277,6 +368,10 @@ class Passage ():
 
         range_ = range_ or str (self.chapter)
 
+        tables = get_lookups ()
+        if tables is not None:
+            return tables.range_id (self.bk_id, range_)
+
         res = execute (self.conn, """
         SELECT rg_id
         FROM ranges_view
@@ -371,6 +466,74 @@ def make_json_response (json = None, status = 200, message = None):
     })
 
 
+COLUMNS_MIMETYPE = 'application/vnd.ntg.columns+json'
+""" The media type a client may accept to get the columnar JSON format. """
+
+def wants_columns ():
+    """Return True if the client asked for the columnar JSON format.
+
+    The client asks either with the query parameter :code:`format=columns` or
+    with an Accept header that prefers :data:`COLUMNS_MIMETYPE` over
+    :mimetype:`application/json`.
+
+    """
+
+    if flask.request.args.get ('format') == 'columns':
+        return True
+    best = flask.request.accept_mimetypes.best_match (['application/json', COLUMNS_MIMETYPE])
+    return best == COLUMNS_MIMETYPE
+
+
+def to_columns (fields, rows, codable = ()):
+    """Transpose a list of rows into the columnar JSON format.
+
+    Returns a dict with the list of `fields` and one list of values for each
+    field, without building a dict for every row.  If the client lists a field
+    of `codable` in the query parameter :code:`codes`, eg. :code:`codes=labez`,
+    the values of that field are replaced by indices into the list of its
+    distinct values, which is returned in `codes`.
+
+    """
+
+    rows    = list (rows)
+    columns = [ list (c) for c in zip (*rows) ] if rows else [ [] for f in fields ]
+    wanted  = set (flask.request.args.get ('codes', '').split (','))
+
+    codes = {}
+    for i, field in enumerate (fields):
+        if field in codable and field in wanted:
+            values = list (dict.fromkeys (columns[i]))
+            index  = { v : n for n, v in enumerate (values) }
+            columns[i]   = [ index[v] for v in columns[i] ]
+            codes[field] = values
+
+    return {
+        'fields'  : list (fields),
+        'columns' : columns,
+        'codes'   : codes,
+    }
+
+
+def make_json_stream_response (items, status = 200):
+    """Stream a sequence of items as JSON.
+
+    The response has the same format as :func:`make_json_response` with a list
+    as data, but the items are encoded one by one as they are produced.
+
+    """
+
+    def generate ():
+        yield '{"data":['
+        for n, item in enumerate (items):
+            yield (',' if n else '') + flask.json.dumps (item)
+        yield '],"status":%d}' % status
+
+    return flask.Response (flask.stream_with_context (generate ()), status, {
+        'content-type' : 'application/json;charset=utf-8',
+        'Access-Control-Allow-Origin' : '*',
+    })
+
+
 def make_dot_response (dot, status = 200):
     return flask.make_response (dot, status, {
         'content-type' : 'text/vnd.graphviz;charset=utf-8',
@@ -405,6 +568,49 @@ def csvify (fields, rows):
     return make_csv_response (to_csv (fields, rows))
 
 
+CSV_CHUNK_ROWS = 500
+""" The no. of rows :func:`csvify_stream` encodes into one chunk. """
+
+def csvify_stream (fields, rows, status = 200):
+    """Stream a HTTP response in CSV format.
+
+    The response is the same as :func:`csvify`, but the rows are encoded in
+    chunks as they are produced.
+
+    """
+
+    def generate ():
+        fp = io.StringIO ()
+        writer = csv.DictWriter (fp, fields, restval='', extrasaction='raise', dialect='excel')
+        writer.writeheader ()
+        for n, r in enumerate (rows, 1):
+            writer.writerow (r._asdict ())
+            if n % CSV_CHUNK_ROWS == 0:
+                yield fp.getvalue ()
+                fp.seek (0)
+                fp.truncate ()
+        yield fp.getvalue ()
+
+    return flask.Response (flask.stream_with_context (generate ()), status, {
+        'content-type' : 'text/csv;charset=utf-8',
+        'Access-Control-Allow-Origin' : '*',
+    })
+
+
+def stream_rows (row_type, sql, params):
+    """Yield the rows of a query as `row_type`.
+
+    The query runs on its own connection and the rows are fetched in batches
+    from a server-side cursor.  The connection is held until the last row was
+    yielded.
+
+    """
+
+    with flask.current_app.config.dba.engine.begin () as conn:
+        for row in execute_stream (conn, sql, params):
+            yield row_type._make (row)
+
+
 DOT_SKELETON = """
 strict digraph G {{
         graph [nodesep={nodesep},
@@ -455,33 +661,52 @@ def dot_skeleton (width = 960.0, fontsize = 10.0, ranksep = 0.4, nodesep = 0.1):
     )]
 
 
-def nx_to_dot (graph, width = 960.0, fontsize = 10.0, nodesep = 0.1):
-    """Convert an nx graph into a dot file.
+def nx_to_dot_body (graph):
+    """Return the node and edge statements of an nx graph in dot format.
 
-    We'd like to sort the nodes in the graph, but nx internally uses
-    dictionaries "all the way down".  Thus the only chance to sort nodes and
-    edges is while writing the file.  This function is a lightweight
-    re-implementation of nx.nx_pydot.to_pydot ().
+    The statements do not depend on the layout parameters.  See
+    :func:`nx_to_dot`.
 
     """
 
-    dot = dot_skeleton (width = width, fontsize = fontsize, nodesep = nodesep)
+    body = []
 
     # Copy nodes and sort them.  (Sorting nodes is important too.)
     for n, nodedata in sorted (graph.nodes (data = True)):
-        dot.append ("\"%s\" [%s];" %
-                    (n, ','.join (["\"%s\"=\"%s\"" % (k, v) for k, v in nodedata.items ()])))
+        body.append ("\"%s\" [%s];" %
+                     (n, ','.join (["\"%s\"=\"%s\"" % (k, v) for k, v in nodedata.items ()])))
 
     # Copy edges and sort them.
     for u, v, edgedata in sorted (graph.edges (data = True)):
-        dot.append ("\"%s\" -> \"%s\" [%s];" %
-                    (u, v, ','.join (["\"%s\"=\"%s\"" % (k, v) for k, v in edgedata.items ()])))
+        body.append ("\"%s\" -> \"%s\" [%s];" %
+                     (u, v, ','.join (["\"%s\"=\"%s\"" % (k, v) for k, v in edgedata.items ()])))
 
+    return body
+
+
+def body_to_dot (body, width = 960.0, fontsize = 10.0, nodesep = 0.1):
+    """ Wrap node and edge statements into a dot file. """
+
+    dot = dot_skeleton (width = width, fontsize = fontsize, nodesep = nodesep)
+    dot.extend (body)
     dot.append ('}\n')
 
     return '\n'.join (dot)
 
 
+def nx_to_dot (graph, width = 960.0, fontsize = 10.0, nodesep = 0.1):
+    """Convert an nx graph into a dot file.
+
+    We'd like to sort the nodes in the graph, but nx internally uses
+    dictionaries "all the way down".  Thus the only chance to sort nodes and
+    edges is while writing the file.  This function is a lightweight
+    re-implementation of nx.nx_pydot.to_pydot ().
+
+    """
+
+    return body_to_dot (nx_to_dot_body (graph), width, fontsize, nodesep)
+
+
 def nx_to_dot_subgraphs (graph, field, width = 960.0, fontsize = 10.0):
     """Convert an nx graph into a dot file.
 
@@ -0,0 +1,175 @@
+# -*- encoding: utf-8 -*-
+
+"""An application server for CBGM.  In-memory lookup tables.
+
+Almost every request resolves a manuscript, a passage or a range id, but the
+manuscripts, passages and ranges tables change only when a new book is
+imported.  This module loads those tables once at app start and keeps them in
+memory.  The snapshot is keyed on the generations of the last changes to
+those three tables, so edits to other tables, eg. the local stemmata, do not
+reload it.
+
+"""
+
+import logging
+import re
+import threading
+
+import sqlalchemy
+
+from ntg_common.db_tools import execute, get_table_generation
+from ntg_common.interval_index import PassageRangeIndex
+from ntg_common.tools import log
+
+import metrics
+
+TABLES = ('manuscripts', 'passages', 'ranges')
+""" The tables in a snapshot. """
+
+
+class Tables ():
+    """A snapshot of the manuscripts, passages and ranges tables.
+
+    A snapshot is never changed after it was loaded.  The rows are stored as
+    tuples in the same format the SQL queries in :mod:`helpers` return.
+    :attr:`index` relates passages to ranges.
+
+    """
+
+    def __init__ (self, conn, key):
+        self.key = key
+
+        res = execute (conn, """
+        SELECT ms_id, hs, hsnr
+        FROM manuscripts
+        ORDER BY ms_id
+        """, {})
+
+        self.manuscripts = [ tuple (row) for row in res ]
+        self.ms_by = {
+            'ms_id' : { row[0] : row for row in self.manuscripts },
+            'hs'    : { row[1] : row for row in self.manuscripts },
+            'hsnr'  : { row[2] : row for row in self.manuscripts },
+        }
+
+        res = execute (conn, """
+        SELECT pass_id, begadr, endadr, adr2bk_id (begadr), adr2chapter (begadr)
+        FROM passages
+        ORDER BY pass_id
+        """, {})
+
+        passages = [ tuple (row) for row in res ]
+        self.pass_by_id  = { row[0]           : row for row in passages }
+        self.pass_by_adr = { (row[1], row[2]) : row for row in passages }
+
+        res = execute (conn, """
+        SELECT rg_id, bk_id, range, lower (passage), upper (passage)
+        FROM ranges
+        """, {})
+
+        ranges = [ tuple (row) for row in res ]
+        self.rg_by_name = { (row[1], row[2]) : row[0] for row in ranges }
+
+        self.index = PassageRangeIndex ([ row[0:3] for row in passages ], ranges)
+
+
+    def manuscript (self, where, param):
+        """ Return (ms_id, hs, hsnr) of the manuscript with `where` = `param` or None. """
+        return self.ms_by[where].get (param)
+
+
+    def manuscripts_matching (self, regex):
+        """ Return the ms_ids of the manuscripts whose hs matches the regex. """
+        regex = re.compile (regex)
+        return tuple ([ row[0] for row in self.manuscripts if regex.search (row[1]) ] or [ -1 ])
+
+
+    def passage (self, pass_id):
+        """ Return (pass_id, begadr, endadr, bk_id, chapter) of the passage or None. """
+        return self.pass_by_id.get (pass_id)
+
+
+    def passage_by_adr (self, begadr, endadr):
+        """ Return (pass_id, begadr, endadr, bk_id, chapter) of the passage or None. """
+        return self.pass_by_adr.get ((begadr, endadr))
+
+
+    def range_id (self, bk_id, range_):
+        """ Return the rg_id of the named range in the book or None. """
+        return self.rg_by_name.get ((bk_id, range_))
+
+
+def get_key (conn, generation):
+    """Return the key of a snapshot.
+
+    The key is a tuple of the generations of the last changes to the tables in
+    :data:`TABLES`.  In a database that does not record table generations the
+    key is the data generation.
+
+    """
+
+    res = execute (conn, "SELECT to_regclass ('table_generation') IS NOT NULL", {})
+    if not res.fetchone ()[0]:
+        return ('generation', generation)
+    return tuple ([ get_table_generation (conn, table) for table in TABLES ])
+
+
+class Lookups ():
+    """The lookup tables of one app.
+
+    :meth:`current` returns a :class:`Tables` snapshot that is up to date with
+    the manuscripts, passages and ranges tables.  The key of the snapshot is
+    checked again only after the data generation of the database changed.
+
+    """
+
+    def __init__ (self, dba, generation):
+        self.dba        = dba
+        self.generation = generation
+        self.tables     = None
+        self.checked    = None
+        self.lock       = threading.Lock ()
+
+
+    def current (self):
+        """ Return the current snapshot or None if the tables cannot be loaded. """
+
+        generation = self.generation.current ()
+        tables = self.tables
+        if tables is not None and self.checked == generation:
+            metrics.cache_hit ('lookups')
+            return tables
+
+        with self.lock:
+            if self.tables is None or self.checked != generation:
+                self.load (generation)
+            return self.tables
+
+
+    def load (self, generation):
+        """ Load a new snapshot if one of the tables changed. """
+
+        try:
+            with self.dba.engine.begin () as conn:
+                key = get_key (conn, generation)
+                if self.tables is not None and self.tables.key == key:
+                    metrics.cache_hit ('lookups')
+                    self.checked = generation
+                    return
+                metrics.cache_miss ('lookups')
+                tables = Tables (conn, key)
+        except sqlalchemy.exc.DBAPIError as e:
+            log (logging.WARNING, 'Cannot load the lookup tables: %s' % e.orig)
+            return
+
+        log (logging.INFO, 'Loaded lookup tables for key %s: %d manuscripts, %d passages, %d ranges' % (
+            key, len (tables.manuscripts), len (tables.pass_by_id), len (tables.rg_by_name)))
+        self.tables  = tables
+        self.checked = generation
+
+
+def init_app (app):
+    """ Initialize the flask app. """
+
+    app.config.lookups = Lookups (app.config.dba, app.config.generation)
+    app.config.lookups.current ()
@@ -14,8 +14,8 @@ from ntg_common.db_tools import execute
 from ntg_common import tools
 
 from login import auth
-from helpers import parameters, Passage, Manuscript, cache, csvify, get_excluded_ms_ids, \
-     make_json_response
+from helpers import parameters, Passage, Manuscript, cache, csvify_stream, stream_rows, \
+     get_excluded_ms_ids, get_lookups, make_json_response, wants_columns, to_columns, LABEZ_I18N
 
 bp = flask.Blueprint ('main', __name__)
 
@@ -176,39 +176,85 @@ def cliques_json (passage_or_id):
         return make_json_response (passage.cliques ())
 
 
-@bp.route ('/leitzeile.json/<passage_or_id>')
-def leitzeile_json (passage_or_id):
-    """Endpoint.  Serve the leitzeile for the verse containing passage_or_id. """
+Leitzeile = collections.namedtuple ('Leitzeile', 'begadr, endadr, lemma, pass_ids')
 
-    auth ()
+def leitzeilen (conn, verses, columns = False):
+    """Return the leitzeilen of some verses.
 
-    with current_app.config.dba.engine.begin () as conn:
-        passage = Passage (conn, passage_or_id)
-        verse_start = (passage.start // 1000) * 1000
-        verse_end = verse_start + 999
+    :param list verses: The addresses of the verses, eg. 50101000.
+    :return: A dict of verse => leitzeile.
+
+    """
 
+    groups = collections.defaultdict (list)
+
+    tables = get_lookups ()
+    if tables is None:
         res = execute (conn, """
-        SELECT l.begadr, l.endadr, l.lemma, ARRAY_AGG (p.pass_id)
-        FROM nestle l
-          LEFT JOIN passages p ON (p.passage @> l.passage)
-        WHERE int4range (:start, :end + 1) @> l.passage
-        GROUP BY l.begadr, l.endadr, l.lemma
+        SELECT v.verse, l.begadr, l.endadr, l.lemma, ARRAY_AGG (p.pass_id ORDER BY p.pass_id)
+        FROM unnest (:verses) AS v (verse)
+          JOIN nestle l ON int4range (v.verse, v.verse + 1000) @> l.passage
+          LEFT JOIN passages p ON p.passage @> l.passage
+        GROUP BY v.verse, l.begadr, l.endadr, l.lemma
 
-        UNION -- get the insertions
+        UNION ALL -- get the insertions
 
-        SELECT p.begadr, p.endadr, '', ARRAY_AGG (p.pass_id)
-        FROM passages_view p
-        WHERE int4range (:start, :end + 1) @> p.passage AND (begadr % 2) = 1
-        GROUP BY p.begadr, p.endadr
+        SELECT v.verse, p.begadr, p.endadr, '', ARRAY_AGG (p.pass_id ORDER BY p.pass_id)
+        FROM unnest (:verses) AS v (verse)
+          JOIN passages p ON int4range (v.verse, v.verse + 1000) @> p.passage
+        WHERE p.begadr % 2 = 1
+        GROUP BY v.verse, p.begadr, p.endadr
+        """, dict (parameters, verses = sorted (verses)))
 
-        ORDER BY begadr, endadr DESC
-        """, dict (parameters, start = verse_start, end = verse_end))
+        for row in res:
+            groups[row[0]].append (Leitzeile._make (row[1:]))
+    else:
+        res = execute (conn, """
+        SELECT DISTINCT v.verse, l.begadr, l.endadr, l.lemma
+        FROM unnest (:verses) AS v (verse)
+          JOIN nestle l ON int4range (v.verse, v.verse + 1000) @> l.passage
+        """, dict (parameters, verses = sorted (verses)))
+
+        index = tables.index
+        for verse, begadr, endadr, lemma in res:
+            groups[verse].append (Leitzeile (
+                begadr, endadr, lemma, sorted (index.passages_containing (begadr, endadr)) or [ None ]))
+
+        # get the insertions
+        for verse in verses:
+            insertions = collections.defaultdict (list)
+            for pass_id in index.passages_inside (verse, verse + 999).tolist ():
+                begadr, upper = index.passage_bounds[pass_id]
+                if begadr % 2 == 1:
+                    insertions[(begadr, upper - 1)].append (pass_id)
+            for (begadr, endadr), pass_ids in insertions.items ():
+                groups[verse].append (Leitzeile (begadr, endadr, '', sorted (pass_ids)))
+
+    result = {}
+    for verse in verses:
+        leitzeile = sorted (groups[verse], key = lambda l: (l.begadr, -l.endadr))
+
+        if columns:
+            result[verse] = to_columns (Leitzeile._fields, leitzeile)
+        else:
+            result[verse] = [ l._asdict () for l in leitzeile ]
+
+    return result
 
-        Leitzeile = collections.namedtuple (
-            'Leitzeile', 'begadr, endadr, lemma, pass_ids')
-        leitzeile = [ Leitzeile._make (r)._asdict () for r in res ]
 
-        return make_json_response (leitzeile)
+@bp.route ('/leitzeile.json/<passage_or_id>')
+def leitzeile_json (passage_or_id):
+    """Endpoint.  Serve the leitzeile for the verse containing passage_or_id. """
+
+    auth ()
+
+    with current_app.config.dba.engine.begin () as conn:
+        passage = Passage (conn, passage_or_id)
+        verse = (passage.start // 1000) * 1000
+
+        response = make_json_response (leitzeilen (conn, [ verse ], wants_columns ())[verse])
+        response.vary.add ('Accept')
+        return response
 
 
 @bp.route ('/suggest.json')
@@ -333,7 +379,7 @@ def manuscript_full_json (passage_or_id, hs_hsnr_id):
         # Get the attestation(s) of the manuscript (may be uncertain eg. a/b/c)
         res = execute (conn, """
         SELECT labez, clique, labez_clique, certainty
-        FROM apparatus_view_agg
+        FROM apparatus_view_agg_mat
         WHERE ms_id = :ms_id AND pass_id = :pass_id
         """, dict (parameters, ms_id = ms.ms_id, pass_id = passage.pass_id))
 
@@ -424,60 +470,116 @@ def relatives_csv (passage_or_id, hs_hsnr_id):
 
         exclude = get_excluded_ms_ids (conn, include)
 
-        # Get the X most similar manuscripts and their attestations
-        res = execute (conn, """
-        /* get the LIMIT closest ancestors for this node */
-        WITH ranks AS (
-          SELECT ms_id1, ms_id2,
-            rank () OVER (ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank,
-            affinity
-          FROM {view} aff
-          WHERE ms_id1 = :ms_id1 AND aff.rg_id = :rg_id AND ms_id2 NOT IN :exclude
-            AND newer > older {frag_where}
-          ORDER BY affinity DESC
-        )
-
-        SELECT r.rank,
-               aff.ms_id2 as ms_id,
-               ms.hs,
-               ms.hsnr,
-               aff.ms2_length,
-               aff.common,
-               aff.equal,
-               aff.older,
-               aff.newer,
-               aff.unclear,
-               aff.common - aff.equal - aff.older - aff.newer - aff.unclear as norel,
-               CASE WHEN aff.newer < aff.older THEN ''
-                    WHEN aff.newer = aff.older THEN '-'
-                    ELSE '>'
-               END as direction,
-               aff.affinity,
-               a.labez,
-               a.certainty
-        FROM
-          {view} aff
-        JOIN apparatus_view_agg a
-          ON aff.ms_id2 = a.ms_id
-        JOIN manuscripts ms
-          ON aff.ms_id2 = ms.ms_id
-        LEFT JOIN ranks r
-          ON r.ms_id2 = aff.ms_id2
-        WHERE aff.ms_id2 NOT IN :exclude AND aff.ms_id1 = :ms_id1
-              AND aff.rg_id = :rg_id AND aff.common > 0
-              AND a.pass_id = :pass_id {where} {frag_where}
-        ORDER BY affinity DESC, r.rank, newer DESC, older DESC, hsnr
-        {limit}
-        """, dict (parameters, where = where, frag_where = frag_where,
-                   ms_id1 = ms.ms_id, hsnr = ms.hsnr,
-                   pass_id = passage.pass_id, rg_id = rg_id, limit = limit,
-                   view = view, exclude = exclude))
-
-        Relatives = collections.namedtuple (
-            'Relatives',
-            'rank ms_id hs hsnr length common equal older newer unclear norel direction affinity labez certainty'
-        )
-        return csvify (Relatives._fields, list (map (Relatives._make, res)))
+    Relatives = collections.namedtuple (
+        'Relatives',
+        'rank ms_id hs hsnr length common equal older newer unclear norel direction affinity labez certainty'
+    )
+
+    # Get the X most similar manuscripts and their attestations
+    return csvify_stream (Relatives._fields, stream_rows (Relatives, """
+    /* get the LIMIT closest ancestors for this node */
+    WITH ranks AS (
+      SELECT ms_id1, ms_id2,
+        rank () OVER (ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank,
+        affinity
+      FROM {view} aff
+      WHERE ms_id1 = :ms_id1 AND aff.rg_id = :rg_id AND ms_id2 NOT IN :exclude
+        AND newer > older {frag_where}
+      ORDER BY affinity DESC
+    )
+
+    SELECT r.rank,
+           aff.ms_id2 as ms_id,
+           ms.hs,
+           ms.hsnr,
+           aff.ms2_length,
+           aff.common,
+           aff.equal,
+           aff.older,
+           aff.newer,
+           aff.unclear,
+           aff.common - aff.equal - aff.older - aff.newer - aff.unclear as norel,
+           CASE WHEN aff.newer < aff.older THEN ''
+                WHEN aff.newer = aff.older THEN '-'
+                ELSE '>'
+           END as direction,
+           aff.affinity,
+           a.labez,
+           a.certainty
+    FROM
+      {view} aff
+    JOIN apparatus_view_agg_mat a
+      ON aff.ms_id2 = a.ms_id
+    JOIN manuscripts ms
+      ON aff.ms_id2 = ms.ms_id
+    LEFT JOIN ranks r
+      ON r.ms_id2 = aff.ms_id2
+    WHERE aff.ms_id2 NOT IN :exclude AND aff.ms_id1 = :ms_id1
+          AND aff.rg_id = :rg_id AND aff.common > 0
+          AND a.pass_id = :pass_id {where} {frag_where}
+    ORDER BY affinity DESC, r.rank, newer DESC, older DESC, hsnr
+    {limit}
+    """, dict (parameters, where = where, frag_where = frag_where,
+               ms_id1 = ms.ms_id, hsnr = ms.hsnr,
+               pass_id = passage.pass_id, rg_id = rg_id, limit = limit,
+               view = view, exclude = exclude)))
+
+
+Readings = collections.namedtuple ('Readings', 'labez lesart')
+
+Manuscripts = collections.namedtuple (
+    'Manuscripts',
+    'labez clique labez_clique labezsuf lesart ms_id hs hsnr certainty'
+)
+
+def group_by_passage (res):
+    """ Group rows by their first column, the pass_id. """
+
+    groups = collections.defaultdict (list)
+    for row in res:
+        groups[row[0]].append (tuple (row[1:]))
+    return groups
+
+
+def apparatuses (conn, pass_ids, columns = False):
+    """Return the contents of the apparatus table of some passages.
+
+    :return: A dict of pass_id => apparatus.
+
+    """
+
+    # list of labez => lesart
+    res = execute (conn, """
+    SELECT pass_id, labez, reading (labez, lesart)
+    FROM readings
+    WHERE pass_id IN :pass_ids
+    ORDER BY pass_id, labez
+    """, dict (parameters, pass_ids = tuple (pass_ids)))
+    readings = group_by_passage (res)
+
+    # list of labez_clique => manuscripts
+    res = execute (conn, """
+    SELECT pass_id, labez, clique, labez_clique, labezsuf, reading (labez, lesart), ms_id, hs, hsnr, certainty
+    FROM apparatus_view_agg_mat
+    WHERE pass_id IN :pass_ids
+    ORDER BY pass_id, hsnr, labez, clique
+    """, dict (parameters, pass_ids = tuple (pass_ids)))
+    manuscripts = group_by_passage (res)
+
+    result = {}
+    for pass_id in pass_ids:
+        if columns:
+            result[pass_id] = {
+                'readings'    : to_columns (Readings._fields, readings[pass_id], ('labez', )),
+                'manuscripts' : to_columns (Manuscripts._fields, manuscripts[pass_id],
+                                            ('labez', 'clique', 'labez_clique', 'labezsuf', 'lesart')),
+            }
+        else:
+            result[pass_id] = {
+                'readings'    : [ Readings._make (r)._asdict () for r in readings[pass_id] ],
+                'manuscripts' : [ Manuscripts._make (r)._asdict () for r in manuscripts[pass_id] ],
+            }
+    return result
 
 
 @bp.route ('/apparatus.json/<passage_or_id>')
@@ -489,37 +591,39 @@ def apparatus_json (passage_or_id):
     with current_app.config.dba.engine.begin () as conn:
         passage = Passage (conn, passage_or_id)
 
-        # list of labez => lesart
-        res = execute (conn, """
-        SELECT labez, reading (labez, lesart)
-        FROM readings
-        WHERE pass_id = :pass_id
-        ORDER BY labez
-        """, dict (parameters, pass_id = passage.pass_id))
+        response = make_json_response (
+            apparatuses (conn, [ passage.pass_id ], wants_columns ())[passage.pass_id])
+        response.vary.add ('Accept')
+        return response
 
-        Readings = collections.namedtuple ('Readings', 'labez lesart')
-        readings = [ Readings._make (r)._asdict () for r in res ]
 
-        # list of labez_clique => manuscripts
-        res = execute (conn, """
-        SELECT labez, clique, labez_clique, labezsuf, reading (labez, lesart), ms_id, hs, hsnr, certainty
-        FROM apparatus_view_agg
-        WHERE pass_id = :pass_id
-        ORDER BY hsnr, labez, clique
-        """, dict (parameters, pass_id = passage.pass_id))
+def attestations (conn, pass_ids, columns = False):
+    """Return the attestations of all manuscripts at some passages.
 
-        Manuscripts = collections.namedtuple (
-            'Manuscripts',
-            'labez clique labez_clique labezsuf lesart ms_id hs hsnr certainty'
-        )
-        manuscripts = [ Manuscripts._make (r)._asdict () for r in res ]
+    :return: A dict of pass_id => attestations.
 
-        return make_json_response ({
-            'readings'    : readings,
-            'manuscripts' : manuscripts,
-        })
+    """
 
-    return 'Error'
+    res = execute (conn, """
+    SELECT pass_id, ms_id, labez
+    FROM apparatus
+    WHERE pass_id IN :pass_ids
+    ORDER BY pass_id, ms_id
+    """, dict (parameters, pass_ids = tuple (pass_ids)))
+    groups = group_by_passage (res)
+
+    result = {}
+    for pass_id in pass_ids:
+        if columns:
+            attestations = to_columns (('ms_id', 'labez'), groups[pass_id], ('labez', ))
+        else:
+            attestations = {}
+            for ms_id, labez in groups[pass_id]:
+                attestations[str (ms_id)] = labez
+        result[pass_id] = {
+            'attestations': attestations
+        }
+    return result
 
 
 @bp.route ('/attestation.json/<passage_or_id>')
@@ -532,21 +636,122 @@ def attestation_json (passage_or_id):
     with current_app.config.dba.engine.begin () as conn:
         passage = Passage (conn, passage_or_id)
 
-        res = execute (conn, """
-        SELECT ms_id, labez
-        FROM apparatus
-        WHERE pass_id = :pass_id
-        ORDER BY ms_id
-        """, dict (parameters, pass_id = passage.pass_id))
+        response = make_json_response (
+            attestations (conn, [ passage.pass_id ], wants_columns ())[passage.pass_id])
+        response.vary.add ('Accept')
+        return response
 
-        attestations = {}
-        for row in res:
-            ms_id, labez = row
-            attestations[str (ms_id)] = labez
 
-        return make_json_response ({
-            'attestations': attestations
-        })
+BATCH_FIELDS = ('passage', 'readings', 'cliques', 'apparatus', 'attestation', 'leitzeile')
+""" The fields :func:`passages_json` can serve. """
+
+def parse_pass_ids (arg, max_passages):
+    """Parse a list of passage ids and ranges of passage ids, eg. :code:`3,5,10-20`.
+
+    Raises ValueError if the list is malformed or longer than max_passages.
+
+    """
+
+    pass_ids = set ()
+    for item in arg.split (','):
+        item = item.strip ()
+        if not item:
+            continue
+        lo, dummy_sep, hi = item.partition ('-')
+        lo = int (lo)
+        hi = int (hi) if hi else lo
+        if hi < lo or len (pass_ids) + hi - lo + 1 > max_passages:
+            raise ValueError ('too many passages')
+        pass_ids.update (range (lo, hi + 1))
+    return sorted (pass_ids)
+
+
+@bp.route ('/passages.json')
+def passages_json ():
+    """Endpoint.  Serve the data of many passages at once.
+
+    Serves for every passage the data the single-passage endpoints serve, in
+    one response and with one query per field.  Passage ids that do not exist
+    are skipped.
+
+    :param string pass_ids: The passage ids, eg. :code:`3,5,10-20`.
+    :param string fields:   The fields to serve, eg. :code:`passage,apparatus`.
+                            Default: all of :data:`BATCH_FIELDS`.
+
+    """
+
+    auth ()
+
+    try:
+        pass_ids = parse_pass_ids (request.args.get ('pass_ids') or '',
+                                   current_app.config['BATCH_MAX_PASSAGES'])
+    except ValueError:
+        return make_json_response (None, 400, 'Bad request: Invalid list of passage ids.')
+
+    fields = (request.args.get ('fields') or ','.join (BATCH_FIELDS)).split (',')
+    if not set (fields) <= set (BATCH_FIELDS):
+        return make_json_response (None, 400, 'Bad request: Unknown field.')
+
+    columns = wants_columns ()
+
+    with current_app.config.dba.engine.begin () as conn:
+        passages = [ Passage (conn, pass_id) for pass_id in pass_ids ]
+        passages = [ p for p in passages if p.pass_id ]
+        pass_ids = [ p.pass_id for p in passages ]
+
+        data = collections.OrderedDict ((p.pass_id, { 'pass_id' : p.pass_id }) for p in passages)
+
+        if 'passage' in fields:
+            for p in passages:
+                data[p.pass_id]['passage'] = p.to_json ()
+
+        if pass_ids and 'readings' in fields:
+            res = execute (conn, """
+            SELECT pass_id, labez
+            FROM readings
+            WHERE pass_id IN :pass_ids AND labez != 'zz'
+            ORDER BY pass_id, labez
+            """, dict (parameters, pass_ids = tuple (pass_ids)))
+
+            for pass_id in pass_ids:
+                data[pass_id]['readings'] = []
+            for pass_id, labez in res:
+                data[pass_id]['readings'].append (collections.OrderedDict ([
+                    ('labez', labez), ('labez_i18n', LABEZ_I18N.get (labez, labez))
+                ]))
+
+        if pass_ids and 'cliques' in fields:
+            res = execute (conn, """
+            SELECT pass_id, labez, clique, labez_clique (labez, clique) AS labez_clique
+            FROM cliques
+            WHERE pass_id IN :pass_ids
+            ORDER BY pass_id, labez, clique
+            """, dict (parameters, pass_ids = tuple (pass_ids)))
+
+            for pass_id in pass_ids:
+                data[pass_id]['cliques'] = []
+            for pass_id, labez, clique, labez_clique in res:
+                data[pass_id]['cliques'].append (collections.OrderedDict ([
+                    ('labez', labez), ('clique', clique), ('labez_clique', labez_clique)
+                ]))
+
+        if pass_ids and 'apparatus' in fields:
+            for pass_id, apparatus in apparatuses (conn, pass_ids, columns).items ():
+                data[pass_id]['apparatus'] = apparatus
+
+        if pass_ids and 'attestation' in fields:
+            for pass_id, attestation in attestations (conn, pass_ids, columns).items ():
+                data[pass_id]['attestation'] = attestation
+
+        if pass_ids and 'leitzeile' in fields:
+            verses = { (p.start // 1000) * 1000 for p in passages }
+            leitzeile = leitzeilen (conn, verses, columns)
+            for p in passages:
+                data[p.pass_id]['leitzeile'] = leitzeile[(p.start // 1000) * 1000]
+
+        response = make_json_response (list (data.values ()))
+        response.vary.add ('Accept')
+        return response
 
 
 @bp.route ('/attesting.csv/<passage_or_id>/<labez>')
@@ -558,13 +763,11 @@ def attesting_csv (passage_or_id, labez):
     with current_app.config.dba.engine.begin () as conn:
         passage = Passage (conn, passage_or_id)
 
-        res = execute (conn, """
-        SELECT ms_id, hs, hsnr
-        FROM apparatus_view
-        WHERE pass_id = :pass_id AND labez = :labez
-        ORDER BY hsnr
-        """, dict (parameters, pass_id = passage.pass_id, labez = labez))
-
-        Attesting = collections.namedtuple ('Attesting', 'ms_id hs hsnr')
+    Attesting = collections.namedtuple ('Attesting', 'ms_id hs hsnr')
 
-        return csvify (Attesting._fields, list (map (Attesting._make, res)))
+    return csvify_stream (Attesting._fields, stream_rows (Attesting, """
+    SELECT ms_id, hs, hsnr
+    FROM apparatus_view
+    WHERE pass_id = :pass_id AND labez = :labez
+    ORDER BY hsnr
+    """, dict (parameters, pass_id = passage.pass_id, labez = labez)))
@@ -0,0 +1,321 @@
+# -*- encoding: utf-8 -*-
+
+"""An application server for CBGM.  Metrics.
+
+This module collects:
+
+- the latency of every request by app and endpoint,
+- the number and the duration of the SQL statements every request executes,
+- the time spent in the GraphViz dot program,
+- the hits and misses of the in-memory caches,
+- the occupancy of the database connection pools and the time spent waiting
+  for a connection,
+- how often the prepared statements were executed and prepared, and
+- the requests the admission control kept waiting or turned away.
+
+The metrics are served in the Prometheus text format at :file:`/metrics`, but
+only to clients that send the bearer token set in :attr:`METRICS_TOKEN`.  The
+client address is no proof, because behind a reverse proxy every request comes
+from the proxy.  Every process keeps its own metrics.
+
+"""
+
+import collections
+import contextlib
+import hmac
+import threading
+import time
+
+import flask
+from flask import current_app
+import sqlalchemy
+
+from ntg_common import db_tools
+
+
+bp = flask.Blueprint ('metrics', __name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+""" The upper bounds of the latency histograms in seconds. """
+
+Metric = collections.namedtuple ('Metric', 'type help')
+
+METRICS = collections.OrderedDict ([
+    ('ntg_request_duration_seconds',
+     Metric ('histogram', 'Request latency by app and endpoint.')),
+    ('ntg_request_sql_statements_total',
+     Metric ('counter',   'SQL statements executed by app and endpoint.')),
+    ('ntg_request_sql_seconds_total',
+     Metric ('counter',   'Time spent in SQL statements by app and endpoint.')),
+    ('ntg_graphviz_seconds',
+     Metric ('histogram', 'Time spent in the GraphViz dot program by output format.')),
+    ('ntg_cache_requests_total',
+     Metric ('counter',   'Cache lookups by app, cache and result (hit or miss).')),
+    ('ntg_pool_size',
+     Metric ('gauge',     'Connections kept open by the pool of a database.')),
+    ('ntg_pool_checked_out',
+     Metric ('gauge',     'Connections of the pool currently in use.')),
+    ('ntg_pool_overflow',
+     Metric ('gauge',     'Connections currently open beyond the pool size.')),
+    ('ntg_pool_checkouts_total',
+     Metric ('counter',   'Connections taken from the pool.')),
+    ('ntg_pool_wait_seconds_total',
+     Metric ('counter',   'Time spent waiting for a connection from the pool.')),
+    ('ntg_statement_executions_total',
+     Metric ('counter',   'Executions of a prepared statement.')),
+    ('ntg_statement_prepares_total',
+     Metric ('counter',   'Preparations of a prepared statement, one per connection.')),
+    ('ntg_admission_wait_seconds',
+     Metric ('histogram', 'Time spent waiting for admission by cost class.')),
+    ('ntg_admission_rejected_total',
+     Metric ('counter',   'Requests not admitted by app, cost class and reason (busy or rate).')),
+])
+""" The metrics this module collects. """
+
+BACKGROUND = '(background)'
+""" The endpoint label of SQL statements executed outside of a request. """
+
+
+class Histogram ():
+    """ A histogram with fixed buckets. """
+
+    def __init__ (self, buckets):
+        self.buckets = buckets
+        self.counts  = [0] * len (buckets)
+        self.sum     = 0.0
+        self.count   = 0
+
+
+    def observe (self, value):
+        for i, bound in enumerate (self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum   += value
+        self.count += 1
+
+
+class Registry ():
+    """The metrics of this process.
+
+    The labels of a sample are stored as a tuple of (name, value) pairs.
+
+    """
+
+    def __init__ (self):
+        self.lock    = threading.Lock ()
+        self.samples = { name : {} for name in METRICS }
+
+
+    def inc (self, name, labels, value = 1):
+        """ Add to a counter. """
+
+        with self.lock:
+            samples = self.samples[name]
+            samples[labels] = samples.get (labels, 0) + value
+
+
+    def observe (self, name, labels, value):
+        """ Add an observation to a histogram. """
+
+        with self.lock:
+            samples = self.samples[name]
+            if labels not in samples:
+                samples[labels] = Histogram (LATENCY_BUCKETS)
+            samples[labels].observe (value)
+
+
+    def render (self):
+        """ Return all metrics in the Prometheus text format. """
+
+        pools = collect_pools ()
+        pools.update (collect_statements ())
+        lines = []
+        with self.lock:
+            for name, metric in METRICS.items ():
+                lines.append ('# HELP %s %s' % (name, metric.help))
+                lines.append ('# TYPE %s %s' % (name, metric.type))
+                samples = dict (self.samples[name])
+                samples.update (pools.get (name, {}))
+                for labels, sample in sorted (samples.items ()):
+                    if metric.type in ('counter', 'gauge'):
+                        lines.append ('%s%s %s' % (name, format_labels (labels), sample))
+                        continue
+                    for bound, count in zip (sample.buckets, sample.counts):
+                        lines.append ('%s_bucket%s %d' % (
+                            name, format_labels (labels + (('le', str (bound)), )), count))
+                    lines.append ('%s_bucket%s %d' % (
+                        name, format_labels (labels + (('le', '+Inf'), )), sample.count))
+                    lines.append ('%s_sum%s %s'   % (name, format_labels (labels), sample.sum))
+                    lines.append ('%s_count%s %d' % (name, format_labels (labels), sample.count))
+        return '\n'.join (lines) + '\n'
+
+
+registry = Registry ()
+
+
+def collect_pools ():
+    """ Return the samples of the pool metrics. """
+
+    samples = collections.defaultdict (dict)
+    for stats in db_tools.pool_manager.stats ():
+        labels = (('database', stats.database), )
+        samples['ntg_pool_size'][labels]               = stats.size
+        samples['ntg_pool_checked_out'][labels]        = stats.checked_out
+        samples['ntg_pool_overflow'][labels]           = stats.overflow
+        samples['ntg_pool_checkouts_total'][labels]    = stats.checkouts
+        samples['ntg_pool_wait_seconds_total'][labels] = stats.wait_seconds
+    return samples
+
+
+def collect_statements ():
+    """ Return the samples of the prepared statement metrics.
+
+    The difference between executions and preparations is the number of
+    executions that reused a prepared statement.
+
+    """
+
+    samples = collections.defaultdict (dict)
+    for statement in db_tools.statements.stats ():
+        labels = (('statement', statement.name), ('query', ' '.join (statement.sql.split ())[:80]))
+        samples['ntg_statement_executions_total'][labels] = statement.executions
+        samples['ntg_statement_prepares_total'][labels]   = statement.prepares
+    return samples
+
+
+def format_labels (labels):
+    """ Format a tuple of (name, value) pairs as Prometheus labels. """
+
+    def escape (value):
+        return str (value).replace ('\\', '\\\\').replace ('"', '\\"').replace ('\n', '\\n')
+
+    return '{' + ','.join ('%s="%s"' % (k, escape (v)) for k, v in labels) + '}'
+
+
+def count_cache (cache, result):
+    if flask.has_app_context ():
+        registry.inc ('ntg_cache_requests_total', (
+            ('app', current_app.config['APPLICATION_NAME']), ('cache', cache), ('result', result)))
+
+
+def cache_hit (cache):
+    """ Count a hit on a cache of the current app. """
+
+    count_cache (cache, 'hit')
+
+
+def cache_miss (cache):
+    """ Count a miss on a cache of the current app. """
+
+    count_cache (cache, 'miss')
+
+
+@contextlib.contextmanager
+def timer (name, **labels):
+    """ Observe the duration of the with-block in a histogram. """
+
+    start = time.perf_counter ()
+    try:
+        yield
+    finally:
+        registry.observe (name, tuple (sorted (labels.items ())), time.perf_counter () - start)
+
+
+def before_cursor_execute (conn, cursor, statement, params, context, executemany):
+    if context is not None:
+        context.ntg_start_time = time.perf_counter ()
+
+
+def after_cursor_execute (conn, cursor, statement, params, context, executemany):
+    start = getattr (context, 'ntg_start_time', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter () - start
+    if flask.has_request_context () and 'ntg_metrics' in flask.g:
+        m = flask.g.ntg_metrics
+        m.sql_statements += 1
+        m.sql_seconds    += elapsed
+    else:
+        if flask.has_app_context ():
+            app_name = current_app.config['APPLICATION_NAME']
+        else:
+            app_name = conn.engine.url.database
+        labels = (('app', app_name), ('endpoint', BACKGROUND))
+        registry.inc ('ntg_request_sql_statements_total', labels)
+        registry.inc ('ntg_request_sql_seconds_total', labels, elapsed)
+
+
+def instrument_engine (engine):
+    """Count the SQL statements executed on the engine.
+
+    The engines are shared by all apps using the same database, so the
+    listeners are added only once per engine.
+
+    """
+
+    for name, fn in (('before_cursor_execute', before_cursor_execute),
+                     ('after_cursor_execute',  after_cursor_execute)):
+        if not sqlalchemy.event.contains (engine, name, fn):
+            sqlalchemy.event.listen (engine, name, fn)
+
+
+class RequestMetrics ():
+    """ The metrics of one request. """
+
+    def __init__ (self):
+        self.start_time     = time.perf_counter ()
+        self.status         = 0
+        self.sql_statements = 0
+        self.sql_seconds    = 0.0
+
+
+def init_app (app):
+    """ Initialize the flask app. """
+
+    app_name = app.config['APPLICATION_NAME']
+
+    dba = getattr (app.config, 'dba', None)
+    if dba is not None:
+        instrument_engine (dba.engine)
+
+    @app.before_request
+    def start_request_metrics ():
+        flask.g.ntg_metrics = RequestMetrics ()
+
+    @app.after_request
+    def record_status (response):
+        if 'ntg_metrics' in flask.g:
+            flask.g.ntg_metrics.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request_metrics (exc):
+        m = flask.g.pop ('ntg_metrics', None)
+        if m is None:
+            return
+        endpoint = flask.request.endpoint or '(none)'
+        labels = (('app', app_name), ('endpoint', endpoint))
+        registry.observe ('ntg_request_duration_seconds',
+                          labels + (('status', str (m.status or 500)), ),
+                          time.perf_counter () - m.start_time)
+        registry.inc ('ntg_request_sql_statements_total', labels, m.sql_statements)
+        registry.inc ('ntg_request_sql_seconds_total',    labels, m.sql_seconds)
+
+
+@bp.route ('/metrics')
+def metrics ():
+    """Endpoint.  Serve the metrics in the Prometheus text format.
+
+    The client must send the header: Authorization: Bearer <METRICS_TOKEN>.
+    If no token is configured the metrics are not served at all.
+
+    """
+
+    token = current_app.config['METRICS_TOKEN']
+    auth  = flask.request.headers.get ('Authorization', '')
+    if not token or not hmac.compare_digest (auth.encode (), ('Bearer ' + token).encode ()):
+        flask.abort (404)
+
+    return flask.make_response (registry.render (), 200, {
+        'content-type' : 'text/plain; version=0.0.4; charset=utf-8',
+    })
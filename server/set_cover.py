@@ -7,7 +7,11 @@ See: CBGM_Pres.pdf p. 490ff.
 """
 
 import collections
+import heapq
 import itertools
+import logging
+import threading
+import time
 
 import flask
 from flask import request, current_app
@@ -15,157 +19,101 @@ from flask import request, current_app
 import numpy as np
 
 from ntg_common.db_tools import execute
-from ntg_common.cbgm_common import CBGM_Params, create_labez_matrix
+from ntg_common.tools import log
+from ntg_common.set_cover_common import MAX_COVER_SIZE, CoverStep, get_ancestors, \
+     build_matrices, load_matrices, build_explain_matrix, cover_vectors, pack_bits, popcount, \
+     greedy_cover
 
-from helpers import Passage, Manuscript, make_json_response, csvify
-
-
-MAX_COVER_SIZE = 12
+import metrics
+from helpers import parameters, Passage, Manuscript, make_json_response, csvify, \
+     csvify_stream, stream_rows
 
 
 bp = flask.Blueprint ('set_cover', __name__)
 
+MAX_SELECTION = 20
+""" The max. no. of selected ancestors.  All their combinations are evaluated at
+once, which needs memory in proportion to 2 ** n. """
 
-def get_ancestors (conn, rg_id, ms_id):
-    """ Get all ancestors of ms. """
 
-    mode = 'sim'
-    view = 'affinity_view' if mode == 'rec' else 'affinity_p_view'
+def load_val (config, generation):
+    """Load the state for the given data generation.
 
-    res = execute (conn, """
-    SELECT aff.ms_id2 as ms_id
-    FROM
-      {view} aff
-    WHERE aff.ms_id1 = :ms_id1 AND aff.rg_id = :rg_id
-          AND aff.common > 0 AND aff.older < aff.newer
-    ORDER BY affinity DESC, newer DESC, older DESC
-    """, dict (ms_id1  = ms_id,
-               rg_id   = rg_id,
-               view    = view))
+    The matrices are mapped read-only from a snapshot shared by all processes
+    that serve the same database.  The first process to need a snapshot builds
+    it.
 
-    return frozenset ([r[0] for r in res])
+    """
 
+    dba = config.dba
+    if generation is None or not config['MATRIX_CACHE_DIR']:
+        # no generation counter in this database: keep a private copy
+        val = build_matrices (dba)
+    else:
+        val = load_matrices (dba, config['MATRIX_CACHE_DIR'], generation)
+    val.generation = generation
+    return val
 
-def powerset (iterable):
-    """powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"""
-    s = list (iterable)
-    return itertools.chain.from_iterable (
-        itertools.combinations (s, r) for r in range (len (s) + 1))
 
+def rebuild_val (config, generation):
+    """Rebuild the state in a background thread.
 
-WITH_SELECT = """
-  SELECT pass_id, labez, clique,
-         (1 << (ROW_NUMBER () OVER (PARTITION BY pass_id ORDER BY labez, clique)::integer)) AS rn
-  FROM cliques
-  WHERE labez !~ '^z'
-"""
+    The requests keep using the old state until the new one is ready.
 
-def init (db):
-    """ Do some preparative calculations and cache the results. """
-
-    val = CBGM_Params ()
-
-    with db.engine.begin () as conn:
-        # get max number of different cliques in any one passage
-        res = execute (conn, """
-        SELECT MAX (c)
-        FROM (
-          SELECT COUNT ((labez, clique)) AS c
-          FROM locstem
-          WHERE labez !~ '^z'
-          GROUP BY pass_id
-        ) AS foo
-        """, {})
-        n_cliques = res.fetchone ()[0]
-        # see that the bitmask fits into uint64
-        # one bit is reserved for 'unknown' derivation
-        assert n_cliques < 64
-
-        # load all attestations into one big numpy array
-        create_labez_matrix (db, {}, val)
-
-        # build a mask of all readings of all mss.
-        # every labez_clique gets an id (in the range 1..63)
-
-        # Matrix mss x passages containing the bitmask of all manuscripts readings
-        val.mask_matrix = np.zeros ((val.n_mss, val.n_passages), dtype = np.uint64)
-
-        res = execute (conn, """
-        WITH rn AS (
-          {with}
-        )
-        SELECT msq.ms_id, msq.pass_id, rn1.rn
-        FROM ms_cliques AS msq
-        JOIN (select * from rn) as rn1
-          USING (pass_id, labez, clique)
-        """, { 'with' : WITH_SELECT })
+    """
 
-        mask_row = collections.namedtuple ('Mask_Row', 'ms_id, pass_id, shift')
-        for r in res:
-            mask = mask_row._make (r)
-            val.mask_matrix[mask.ms_id - 1, mask.pass_id - 1] = np.uint64 (mask.shift)
+    with config.val_lock:
+        if config.val_rebuilding:
+            return
+        config.val_rebuilding = True
 
-    return val
+    def run ():
+        try:
+            val = load_val (config, generation)
+            with config.val_lock:
+                config.val = val
+        except Exception as e:
+            log (logging.ERROR, 'Cannot rebuild the set cover state: %s' % e)
+        finally:
+            with config.val_lock:
+                config.val_rebuilding = False
 
+    threading.Thread (target = run, name = 'set-cover-rebuild', daemon = True).start ()
 
-def build_explain_matrix (conn, val, ms_id):
-    """Build the explain matrix.
 
-    A matrix of 1 x n_passages containing the bitmask of all those readings that
-    would explain the reading in the manuscript under scrutiny.
+def get_val ():
+    """Return the state of the current app.
 
-    Bit 1 means: the reading stems from an unknown source.
-    Bit 2..64 are the bitmask of all cliques.
+    The state is tagged with the data generation it was built from.  If the
+    data has changed since, a rebuild is started and the old state is returned.
+    Only the very first call waits for the state to be built.
 
     """
 
-    explain_matrix = np.zeros (val.n_passages, dtype = np.uint64)
-
-    res = execute (conn, """
-    WITH RECURSIVE
-    rn AS (
-      {with}
-    ),
-    lsrn AS (
-      SELECT ls.pass_id, ls.labez, ls.clique,
-        -- set 1 as flag for unknown derivation
-        CASE WHEN ls.source_labez = '?' THEN rn1.rn | 1 ELSE rn1.rn END AS rn1,
-        rn2.rn AS rn2
-      FROM locstem ls
-      JOIN rn as rn1
-        USING (pass_id, labez, clique)
-      LEFT JOIN rn as rn2
-        ON (ls.pass_id, ls.source_labez, ls.source_clique) = (rn2.pass_id, rn2.labez, rn2.clique)
-    ),
-    lsrec (pass_id, rn1, rn2) AS (
-      SELECT lsrn.pass_id, lsrn.rn1, lsrn.rn2
-      FROM ms_cliques AS msq
-        JOIN lsrn USING (pass_id, labez, clique)
-      WHERE ms_id = :ms_id
-    UNION
-      SELECT lsrn.pass_id, lsrn.rn1, lsrn.rn2
-      FROM lsrec
-      JOIN lsrn
-        ON (lsrn.pass_id = lsrec.pass_id AND (lsrn.rn1 & ~B'1'::integer) = lsrec.rn2)
-    )
-    SELECT pass_id, BIT_OR (rn1) AS rn
-    FROM lsrec
-    GROUP BY pass_id
-    ORDER BY pass_id;
-    """, { 'with' : WITH_SELECT, 'ms_id' : ms_id })
-
-    explain_row = collections.namedtuple ('Explain_Row', 'pass_id, mask')
-    for r in res:
-        mask = explain_row._make (r)
-        explain_matrix[mask.pass_id - 1] = np.uint64 (mask.mask)
-
-    return explain_matrix
+    config = current_app.config
+    generation = config.generation.current ()
+    val = config.val
+    if val is None:
+        metrics.cache_miss ('matrices')
+        with config.val_lock:
+            val = config.val
+            if val is None:
+                val = load_val (config, generation)
+                config.val = val
+    elif val.generation != generation:
+        metrics.cache_miss ('matrices')
+        rebuild_val (config, generation)
+    else:
+        metrics.cache_hit ('matrices')
+    return val
 
 
 def init_app (app):
     """ Init the Flask app. """
 
     app.config.val = None
+    app.config.val_lock = threading.Lock ()
+    app.config.val_rebuilding = False
 
 
 @bp.route ('/set-cover.json/<hs_hsnr_id>')
@@ -180,9 +128,7 @@ def set_cover_json (hs_hsnr_id):
     response   = {}
 
     with current_app.config.dba.engine.begin () as conn:
-        if current_app.config.val is None:
-            current_app.config.val = init (current_app.config.dba)
-        val = current_app.config.val
+        val = get_val ()
 
         cover = []
 
@@ -194,88 +140,45 @@ def set_cover_json (hs_hsnr_id):
         pre_selected = [ Manuscript (conn, anc_id) for anc_id in pre_select ]
         response['mss'] = [s.to_json () for s in pre_selected]
 
-        np.set_printoptions (edgeitems = 8, linewidth = 100)
-
-        # The mss x passages boolean matrix that is TRUE whenever the inspected
-        # ms. and the source ms. are both defined.
-        b_common = np.logical_and (val.def_matrix, val.def_matrix[ms_id])
-
-        # Remove mss. we don't want to compare
-        b_common[ms_id] = False  # don't find original ms.
-        if 'A' not in include and 'A' not in pre_select:
-            b_common[0] = False
-        if 'MT' not in include and 'MT' not in pre_select:
-            b_common[1] = False
-        # also eliminate all descendants
-        ancestors = get_ancestors (conn, current_app.config.rg_id_all, ms.ms_id)
-        for i in range (0, val.n_mss):
-            if (i + 1) not in ancestors:
-                b_common[i] = False
-
         n_defined = np.count_nonzero (val.def_matrix[ms_id])
         response['ms']['open'] = n_defined
 
-        # mask_matrix ist the mss x passages matrix containing the bitmask of
-        # all readings
-        explain_matrix       = build_explain_matrix (conn, val, ms.ms_id)
-        explain_equal_matrix = val.mask_matrix[ms_id]
-
-        # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
-        # agrees with the potential source ms.
-        b_equal = np.bitwise_and (val.mask_matrix, explain_equal_matrix) > 0
-        b_equal = np.logical_and (b_equal, b_common)
-
-        # The mss x passages boolean matrix that is TRUE whenever the inspected ms.
-        # agrees with the potential source ms. or is posterior to it.
-        b_post = np.bitwise_and (val.mask_matrix, explain_matrix) > 0
-        b_post = np.logical_and (b_post, b_common)
-
-        # The 1 x passages boolean matrix that is TRUE whenever the passage is
-        # still unexplained.
-        b_open = np.copy (val.def_matrix[ms_id])
-
-        # The 1 x passages boolean matrix that is TRUE whenever the source of
-        # the reading in the inspected ms. is unknown
-        b_unknown = np.bitwise_and (explain_matrix, 0x1)
-        b_unknown = np.logical_and (b_unknown, b_open)
-
-        n_explained = 0
-
-        for n in range (0, MAX_COVER_SIZE):
-            if n < len (pre_selected):
-                # use manuscript pre-selected by user
-                ms_id_most_similar = pre_selected[n].ms_id - 1
+        steps = []
+        generation = current_app.config.generation.current ()
+        if not pre_select and not include and generation is not None:
+            # use the cover precomputed by scripts/cceh/set_cover.py if it is
+            # up to date
+            res = execute (conn, """
+            SELECT cover_ms_id - 1, explains, equal, unknown, open
+            FROM set_cover
+            WHERE ms_id = :ms_id AND generation = :generation
+            ORDER BY n
+            """, dict (parameters, ms_id = ms.ms_id, generation = generation))
+            steps = list (map (CoverStep._make, res))
+            if steps:
+                metrics.cache_hit ('set_cover')
             else:
-                # find manuscript that explains the most passages by agreement
-                ms_id_most_similar = int (np.argmax (np.sum (b_equal, axis = 1)))
-
-            ms_most_similar = Manuscript (conn, 'id' + str (ms_id_most_similar + 1))
-            d = ms_most_similar.to_json ()
+                metrics.cache_miss ('set_cover')
 
-            b_explained = np.copy (b_post[ms_id_most_similar])
-            n_explains = int (np.count_nonzero (b_explained))
-            # exit if no passages could be explained
-            if n_explains == 0:
-                break
+        if not steps:
+            ancestors = get_ancestors (conn, current_app.config.rg_id_all, ms.ms_id)
+            b_equal, b_post, b_unknown, b_open = cover_vectors (
+                val, ms.ms_id, ancestors, set (include) | set (pre_select))
+            steps = greedy_cover (b_equal, b_post, b_unknown, b_open,
+                                  [ anc.ms_id - 1 for anc in pre_selected ])
 
-            n_equal = int (np.count_nonzero (b_equal[ms_id_most_similar]))
-
-            # remove "explained" readings, so they will not be matched again
-            b_post[:,b_explained] = False
-            b_equal[:,b_explained] = False
-            b_unknown[b_explained] = False
-            b_open[b_explained]    = False
+        n_explained = 0
+        for n, step in enumerate (steps):
+            d = Manuscript (conn, 'id' + str (step.ms_id + 1)).to_json ()
 
-            n_explained += n_explains
-            n_unknown = int (np.count_nonzero (b_unknown))
-            n_open    = int (np.count_nonzero (b_open))
+            n_explained += step.explains
 
-            d['explains']  = n_explains
+            d['explains']  = step.explains
             d['explained'] = n_explained
-            d['equal']     = n_equal
-            d['post']      = n_explains - n_equal
-            d['unknown']   = n_unknown
-            d['open']      = n_open - n_unknown
+            d['equal']     = step.equal
+            d['post']      = step.explains - step.equal
+            d['unknown']   = step.unknown
+            d['open']      = step.open - step.unknown
             d['n']         = n + 1
             cover.append (d)
 
@@ -341,14 +244,13 @@ class Combination ():
         ]
 
 
-def _optimal_substemma (ms_id, explain_matrix, combinations, mode):
+def _optimal_substemma (val, ms_id, explain_matrix, combinations, mode):
     """Do an exhaustive search for the combination among a given set of ancestors
     that best explains a given manuscript.
 
     """
 
     ms_id = ms_id - 1  # numpy indices start at 0
-    val = current_app.config.val
 
     b_defined = val.def_matrix[ms_id]
     # remove variants where the inspected ms is undefined
@@ -391,16 +293,207 @@ def _optimal_substemma (ms_id, explain_matrix, combinations, mode):
             comb.open_indices    = tuple (int (n + 1) for n in np.nonzero (b_open)[0])
             comb.unknown_indices = tuple (int (n + 1) for n in np.nonzero (b_unknown)[0])
 
-    if mode == 'search':
-        # add the 'hint' column
-        def key_len (c):
-            return c.len
 
-        def key_explained (c):
-            return -c.explained ()
+Combinations = collections.namedtuple (
+    'Combinations', 'subsets count equal post unknown open hint')
+
+
+def subset_sums (counts, n_bits):
+    """Sum the counts over all subsets.
+
+    Transforms in place a vector indexed by bitmask, so that afterwards entry
+    n holds the sum of the original entries of all subsets of n.
+
+    """
+
+    for i in range (n_bits):
+        view = counts.reshape (-1, 2, 1 << i)
+        view[:, 1, :] += view[:, 0, :]
+    return counts
+
+
+def evaluate_combinations (b_equal, b_post, b_unknown, b_open):
+    """Evaluate all non-empty combinations of a set of candidate ancestors.
+
+    Every passage gets a bitmask of the candidates that explain it.  A
+    combination explains a passage unless the passage's bitmask lies entirely
+    in the complement of the combination.  Counting the passages by bitmask
+    and summing the counts over all subsets thus yields the figures for all
+    combinations at once.
+
+    :param b_equal:   Boolean matrix (candidates x passages), TRUE where the
+                      candidate explains the passage by agreement.
+    :param b_post:    Boolean matrix (candidates x passages), TRUE where the
+                      candidate explains the passage by agreement or by being
+                      posterior.
+    :param b_unknown: Boolean vector (passages), TRUE where the source of the
+                      reading is unknown.
+    :param b_open:    Boolean vector (passages), TRUE where the reading has a
+                      known source.
+    :return: Combinations of numpy arrays, in the same order as
+             :func:`itertools.combinations` by increasing size.  Bit n of
+             :attr:`subsets` is set if candidate n is in the combination.
+
+    """
+
+    n_candidates = len (b_equal)
+    n = 1 << n_candidates
+    n_passages = b_equal.shape[1]
+
+    # the bitmask of the candidates that explain each passage
+    weights   = np.left_shift (1, np.arange (n_candidates, dtype = np.int64))
+    equal     = np.dot (weights, b_equal)
+    explained = np.dot (weights, np.logical_or (b_equal, b_post))
+
+    s_equal     = subset_sums (np.bincount (equal,                minlength = n), n_candidates)
+    s_explained = subset_sums (np.bincount (explained,            minlength = n), n_candidates)
+    s_unknown   = subset_sums (np.bincount (explained[b_unknown], minlength = n), n_candidates)
+    s_open      = subset_sums (np.bincount (explained[b_open],    minlength = n), n_candidates)
+
+    # sort like itertools.combinations: by size, then lexicographically by
+    # candidate index, which is descending order of the bit-reversed subset
+    subsets  = np.arange (1, n, dtype = np.int64)
+    count    = np.zeros (n - 1, dtype = np.int64)
+    rev_bits = np.zeros (n - 1, dtype = np.int64)
+    for i in range (n_candidates):
+        bit = (subsets >> i) & 1
+        count    += bit
+        rev_bits |= bit << (n_candidates - 1 - i)
+    order = np.lexsort ((-rev_bits, count))
+
+    subsets    = subsets[order]
+    count      = count[order]
+    complement = (n - 1) ^ subsets
+
+    equal     = n_passages - s_equal[complement]
+    explained = n_passages - s_explained[complement]
+
+    # hint the first combination of each size that explains the most passages
+    hint = np.zeros (n - 1, dtype = np.bool_)
+    for size in range (1, n_candidates + 1):
+        first, last = np.searchsorted (count, [size, size + 1])
+        hint[first + int (np.argmax (explained[first:last]))] = True
+
+    return Combinations (
+        subsets,
+        count,
+        equal,
+        explained - equal,
+        s_unknown[complement],
+        s_open[complement],
+        hint
+    )
+
+
+def search_substemmas (b_equal, b_post, max_size, limit, budget):
+    """Search the best combinations of candidate ancestors by branch and bound.
+
+    Finds the `limit` best combinations of every size up to `max_size` under
+    :meth:`Combination.score` without enumerating all combinations.
 
-        for _k, g in itertools.groupby (sorted (combinations, key = key_len), key = key_len):
-            sorted (g, key = key_explained)[0].hint = True
+    The score is a coverage function, so the gain of adding a candidate can
+    only shrink as the combination grows.  The score of the current
+    combination plus the largest gains of the remaining candidates is thus an
+    upper bound for every extension.  A branch is pruned when that bound
+    cannot beat the worst of the best combinations found so far.
+
+    :param b_equal:  Boolean matrix (candidates x passages), see
+                     :func:`evaluate_combinations`.
+    :param b_post:   Boolean matrix (candidates x passages), see
+                     :func:`evaluate_combinations`.
+    :param budget:   The time budget in seconds.
+    :return: (results, complete) where results[size] is a list of (score,
+             tuple of candidate indices) sorted by descending score, and
+             complete is False if the search ran out of time.
+
+    """
+
+    equal     = pack_bits (b_equal)
+    explained = pack_bits (np.logical_or (b_equal, b_post))
+
+    deadline = time.monotonic () + budget
+    best     = [ [] for dummy in range (max_size + 1) ]  # min-heaps
+    serial   = itertools.count ()
+    state    = { 'complete' : True }
+
+    def threshold (size):
+        heap = best[size]
+        return heap[0][0] if len (heap) >= limit else -1
+
+    def record (score, subset):
+        # prefer the combination found first among equal scores
+        item = (score, -next (serial), subset)
+        heap = best[len (subset)]
+        if len (heap) < limit:
+            heapq.heappush (heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace (heap, item)
+
+    def visit (subset, score, e, x, remaining):
+        size = len (subset)
+        if size == max_size or len (remaining) == 0:
+            return
+
+        # the gain of adding each remaining candidate, best first
+        gains = 5 * (popcount (equal[remaining] & ~e) + popcount (explained[remaining] & ~x))
+        # keep the candidates that add nothing yet: a combination may contain them
+        order = np.argsort (-gains, kind = 'stable')
+        remaining = remaining[order]
+        gains = gains[order]
+        cumulated = np.concatenate (([0], np.cumsum (gains))).tolist ()
+        n = len (gains)
+
+        for j, (c, gain) in enumerate (zip (remaining.tolist (), gains.tolist ())):
+            if time.monotonic () > deadline:
+                state['complete'] = False
+                return
+
+            # the bounds only shrink with j: stop if no size can improve
+            if all (score + gain + cumulated[min (j + k - size, n)] - cumulated[j + 1] <= threshold (k)
+                    for k in range (size + 1, max_size + 1)):
+                return
+
+            child_e = e | equal[c]
+            child_x = x | explained[c]
+            child = subset + (c, )
+            child_score = 5 * int (popcount (child_e) + popcount (child_x))
+            record (child_score, child)
+            visit (child, child_score, child_e, child_x, remaining[j + 1:])
+            if not state['complete']:
+                return
+
+    empty = np.zeros (equal.shape[1], dtype = np.uint64)
+    visit ((), 0, empty, empty, np.arange (len (equal)))
+
+    results = [ [ (score, subset) for score, dummy, subset in sorted (heap, reverse = True) ]
+                for heap in best ]
+    return results, state['complete']
+
+
+def _explain_vectors (val, ms_id, explain_matrix, candidates):
+    """Build the passage vectors of the candidate ancestors of a manuscript.
+
+    Returns the inputs of :func:`evaluate_combinations`.
+
+    """
+
+    ms_id = ms_id - 1  # numpy indices start at 0
+    vec   = [ c.ms_id - 1 for c in candidates ]
+
+    b_defined = val.def_matrix[ms_id]
+    b_common  = np.logical_and (val.def_matrix[vec], b_defined)
+
+    b_equal = np.bitwise_and (val.mask_matrix[vec], val.mask_matrix[ms_id]) > 0
+    b_equal = np.logical_and (b_equal, b_common)
+
+    b_post = np.bitwise_and (val.mask_matrix[vec], explain_matrix) > 0
+    b_post = np.logical_and (b_post, b_common)
+
+    unexplained_matrix = np.where (b_defined, explain_matrix, np.uint64 (0))
+    b_unknown = np.bitwise_and (unexplained_matrix, np.uint64 (0x1)) > 0
+    b_open    = np.logical_and (unexplained_matrix > 0, np.logical_not (b_unknown))
+
+    return b_equal, b_post, b_unknown, b_open
 
 
 @bp.route ('/optimal-substemma.json')
@@ -408,17 +501,19 @@ def optimal_substemma_json ():
     """Normalize parameters only and add some general info.
     """
 
-    if current_app.config.val is None:
-        current_app.config.val = init (current_app.config.dba)
-    val = current_app.config.val
+    selection = (request.args.get ('selection') or '').split ()
+    if len (selection) > MAX_SELECTION:
+        return make_json_response (
+            None, 400, 'Bad request: Select at most %d ancestors.' % MAX_SELECTION)
+
+    val = get_val ()
 
     with current_app.config.dba.engine.begin () as conn:
         # the manuscript to explain
         ms = Manuscript (conn, request.args.get ('ms'))
 
         # get the selected set of ancestors and build all combinations of that set
-        selected = [ Manuscript (conn, anc_id)
-                     for anc_id in (request.args.get ('selection') or '').split () ]
+        selected = [ Manuscript (conn, anc_id) for anc_id in selection ]
         response = {
             'ms'  : ms.to_json (),
             'mss' : [s.to_json () for s in selected],
@@ -441,33 +536,104 @@ def optimal_substemma_csv ():
 
     """
 
-    if current_app.config.val is None:
-        current_app.config.val = init (current_app.config.dba)
-    val = current_app.config.val
+    selection = (request.args.get ('selection') or '').split ()
+    if len (selection) > MAX_SELECTION:
+        return make_json_response (
+            None, 400, 'Bad request: Select at most %d ancestors.' % MAX_SELECTION)
+
+    val = get_val ()
 
     with current_app.config.dba.engine.begin () as conn:
         # the manuscript to explain
         ms = Manuscript (conn, request.args.get ('ms'))
 
-        # get the selected set of ancestors and build all combinations of that set
-        selected = [ Manuscript (conn, anc_id)
-                     for anc_id in (request.args.get ('selection') or '').split () ]
-        combinations = []
-        i = 0
-        for l in range (len (selected)):
-            for c in itertools.combinations (selected, l + 1):
-                combinations.append (Combination (c, i))
-                i += 1
+        # get the selected set of ancestors and evaluate all combinations of that set
+        selected = [ Manuscript (conn, anc_id) for anc_id in selection ]
 
-        explain_matrix = build_explain_matrix (conn, val, ms.ms_id)
-        _optimal_substemma (ms.ms_id, explain_matrix, combinations, mode = 'search')
+        explain_matrix = build_explain_matrix (val, ms.ms_id)
+        combinations = evaluate_combinations (
+            *_explain_vectors (val, ms.ms_id, explain_matrix, selected))
 
-        res = [c.to_csv () for c in combinations]
+        # the names of all subsets
+        names = [ '' ]
+        for anc in selected:
+            names += [ (name + ' ' + anc.hs) if name else anc.hs for name in names ]
+
+        res = zip (
+            [ names[subset] for subset in combinations.subsets.tolist () ],
+            *[ a.tolist () for a in combinations[1:] ]
+        )
 
         return csvify (_OptimalSubstemmaRow._fields,
                        list (map (_OptimalSubstemmaRow._make, res)))
 
 
+@bp.route ('/optimal-substemma-search.csv')
+def optimal_substemma_search_csv ():
+    """Search the best combinations among all potential ancestors of a manuscript.
+
+    Returns the `limit` best combinations of every size up to `size`, best
+    first.  The hint column marks the best combination of each size.  The
+    header X-Search-Complete is 'false' if the search ran out of time and the
+    results are only the best found so far.
+
+    """
+
+    val = get_val ()
+
+    include  = request.args.getlist ('include[]') or []
+    max_size = min (max (int (request.args.get ('size') or 4), 1), MAX_COVER_SIZE)
+    limit    = max (int (request.args.get ('limit') or 10), 1)
+
+    with current_app.config.dba.engine.begin () as conn:
+        # the manuscript to explain
+        ms = Manuscript (conn, request.args.get ('ms'))
+
+        excluded = set ()
+        if 'A' not in include:
+            excluded.add (1)
+        if 'MT' not in include:
+            excluded.add (2)
+        ancestors = get_ancestors (conn, current_app.config.rg_id_all, ms.ms_id)
+        candidates = [ Manuscript (conn, 'id' + str (ms_id))
+                       for ms_id in sorted (ancestors - excluded) ]
+
+        explain_matrix = build_explain_matrix (val, ms.ms_id)
+        b_equal, b_post, b_unknown, b_open = _explain_vectors (
+            val, ms.ms_id, explain_matrix, candidates)
+
+        results, complete = search_substemmas (
+            b_equal, b_post, max_size, limit, current_app.config['SUBSTEMMA_SEARCH_BUDGET'])
+
+        equal     = pack_bits (b_equal)
+        explained = pack_bits (np.logical_or (b_equal, b_post))
+        unknown   = pack_bits (b_unknown)[0]
+        open_     = pack_bits (b_open)[0]
+        n_unknown = int (popcount (unknown))
+        n_open    = int (popcount (open_))
+
+        res = []
+        for size_results in results:
+            for n, (dummy_score, subset) in enumerate (size_results):
+                subset = sorted (subset)
+                e = np.bitwise_or.reduce (equal[subset])
+                x = np.bitwise_or.reduce (explained[subset])
+                n_equal = int (popcount (e))
+                res.append (_OptimalSubstemmaRow (
+                    ' '.join ([ candidates[c].hs for c in subset ]),
+                    len (subset),
+                    n_equal,
+                    int (popcount (x)) - n_equal,
+                    n_unknown - int (popcount (unknown & x)),
+                    n_open    - int (popcount (open_ & x)),
+                    n == 0
+                ))
+
+        response = csvify (_OptimalSubstemmaRow._fields, res)
+        response.headers['X-Search-Complete'] = 'true' if complete else 'false'
+        return response
+
+
 _OptimalSubstemmaDetailRow = collections.namedtuple (
     'OptimalSubstemmaDetailRow',
     'type pass_id begadr endadr labez_clique lesart'
@@ -492,9 +658,7 @@ def optimal_substemma_detail_csv ():
     """Report details about one combination of ancestors.
     """
 
-    if current_app.config.val is None:
-        current_app.config.val = init (current_app.config.dba)
-    val = current_app.config.val
+    val = get_val ()
 
     with current_app.config.dba.engine.begin () as conn:
         # the manuscript to explain
@@ -505,24 +669,22 @@ def optimal_substemma_detail_csv ():
                      for anc_id in (request.args.get ('selection') or '').split () ]
 
         combinations   = [Combination (selected, 0)]
-        explain_matrix = build_explain_matrix (conn, val, ms.ms_id)
-        _optimal_substemma (ms.ms_id, explain_matrix, combinations, mode = 'detail')
-
-        res = execute (conn, """
-        SELECT 'unknown' as type, p.pass_id, p.begadr, p.endadr, v.labez_clique, v.lesart
-        FROM passages p
-          JOIN apparatus_cliques_view v USING (pass_id)
-        WHERE v.ms_id = :ms_id AND pass_id IN :unknown_pass_ids
-        UNION
-        SELECT 'open' as type, p.pass_id, p.begadr, p.endadr, v.labez_clique, v.lesart
-        FROM passages p
-          JOIN apparatus_cliques_view v USING (pass_id)
-        WHERE v.ms_id = :ms_id AND pass_id IN :open_pass_ids
-        """, dict (
-            ms_id = ms.ms_id,
-            unknown_pass_ids = combinations[0].unknown_indices or (-1, ),
-            open_pass_ids    = combinations[0].open_indices    or (-1, )
-        ))
-
-        return csvify (_OptimalSubstemmaDetailRowCalcFields._fields,
-                       list (map (_OptimalSubstemmaDetailRowCalcFields._make, res)))
+        explain_matrix = build_explain_matrix (val, ms.ms_id)
+        _optimal_substemma (val, ms.ms_id, explain_matrix, combinations, mode = 'detail')
+
+    return csvify_stream (_OptimalSubstemmaDetailRowCalcFields._fields,
+                          stream_rows (_OptimalSubstemmaDetailRowCalcFields, """
+    SELECT 'unknown' as type, p.pass_id, p.begadr, p.endadr, v.labez_clique, v.lesart
+    FROM passages p
+      JOIN apparatus_cliques_mat v USING (pass_id)
+    WHERE v.ms_id = :ms_id AND pass_id IN :unknown_pass_ids
+    UNION
+    SELECT 'open' as type, p.pass_id, p.begadr, p.endadr, v.labez_clique, v.lesart
+    FROM passages p
+      JOIN apparatus_cliques_mat v USING (pass_id)
+    WHERE v.ms_id = :ms_id AND pass_id IN :open_pass_ids
+    """, dict (
+        ms_id = ms.ms_id,
+        unknown_pass_ids = combinations[0].unknown_indices or (-1, ),
+        open_pass_ids    = combinations[0].open_indices    or (-1, )
+    )))
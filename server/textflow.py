@@ -4,18 +4,23 @@
 """The API server for CBGM.  The textflow and stemmata diagrams."""
 
 import collections
+import logging
+import threading
+import time
 
 import flask
 from flask import request, current_app
 import flask_login
 import networkx as nx
 
-from ntg_common.db_tools import execute
+from ntg_common.db_tools import execute, get_table_generation
 from ntg_common import tools
 from ntg_common import db_tools
+from ntg_common.tools import log
 
 from login import auth, user_can_write
 import helpers
+import metrics
 from helpers import parameters, Passage, get_excluded_ms_ids, \
      make_dot_response, make_png_response
 from checks import congruence
@@ -24,9 +29,28 @@ from checks import congruence
 bp = flask.Blueprint ('textflow', __name__)
 
 
-def init_app (_app):
+TEXTFLOW_CACHE_MODES = ('sim', 'rec')
+""" The modes of the global textflow that are precomputed. """
+
+TEXTFLOW_CACHE_BATCH = 20
+""" The no. of textflows to precompute in one batch. """
+
+TEXTFLOW_CACHE_INTERVAL = 60.0
+""" The time in seconds to wait before looking for more work. """
+
+TEXTFLOW_CACHE_LOCK = 0x6e7467746663
+""" The key of the advisory lock held while precomputing. """
+
+
+def init_app (app):
     """ Initialize the flask app. """
 
+    if app.config['TEXTFLOW_CACHE']:
+        @app.before_first_request
+        def start_textflow_cache ():
+            threading.Thread (target = fill_textflow_cache, args = (app, ),
+                              name = 'textflow-cache', daemon = True).start ()
+
 
 SHAPES = {
     'a' : 'ellipse',
@@ -60,27 +84,76 @@ def remove_z_leaves (graph):
             graph.remove_node (n)
 
 
-def textflow (passage_or_id):
-    """ Output a stemma of manuscripts. """
+NODES_SQL = """
+SELECT ms_id
+FROM apparatus app
+WHERE pass_id = :pass_id AND ms_id != ALL (:exclude) {labez_where} {z_where}
+"""
+""" Get all nodes or all nodes (hypothetically) attesting labez. """
+
+RANKS_SQL = """
+SELECT ms_id1, ms_id2, rank
+FROM (
+  SELECT ms_id1, ms_id2, rank () OVER (PARTITION BY ms_id1
+     ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank
+  FROM {view} a
+  WHERE ms_id1 = ANY (:nodes) AND a.rg_id = :rg_id AND ms_id2 != ALL (:exclude)
+    AND newer > older {frag_where}
+) AS r
+WHERE rank <= :connectivity
+ORDER BY rank
+"""
+""" Get the closest ancestors for every node with rank <= connectivity. """
+
+MSS_SQL = """
+SELECT ms.ms_id, ms.hs, ms.hsnr, a.labez, a.clique, a.labez_clique,
+       a.certainty::numeric::float8 -- the shortest decimal, like psycopg2 reads float4
+FROM apparatus_view_agg_mat a
+JOIN manuscripts ms USING (ms_id)
+WHERE pass_id = :pass_id AND ms_id = ANY (:ms_ids)
+"""
+""" Get the attestations of the nodes. """
+
+Ranks = collections.namedtuple ('Ranks', 'ms_id1 ms_id2 rank')
+Mss   = collections.namedtuple ('Mss', 'ms_id hs hsnr labez clique labez_clique certainty')
+
+
+TextflowArgs = collections.namedtuple (
+    'TextflowArgs',
+    'labez hyp_a connectivity width fontsize mode include fragments checks var_only cliques'
+)
+
+
+def textflow_args (args):
+    """ Parse the arguments of a textflow request. """
+
+    fragments = args.getlist ('fragments[]') or []
+    checks    = args.getlist ('checks[]')    or []
+    var_only  = args.getlist ('var_only[]')  or []
+    cliques   = args.getlist ('cliques[]')   or []
+
+    return TextflowArgs (
+        labez        = args.get ('labez') or '',
+        hyp_a        = args.get ('hyp_a') or 'A',
+        connectivity = int (args.get ('connectivity') or 10),
+        width        = float (args.get ('width') or 0.0),
+        fontsize     = float (args.get ('fontsize') or 10.0),
+        mode         = args.get ('mode') or 'sim',
+        include      = args.getlist ('include[]') or [],
+        fragments    = 'fragments' in fragments,
+        checks       = 'checks'    in checks,
+        var_only     = 'var_only'  in var_only,   # Panel: Coherence at Variant Passages (GraphViz)
+        cliques      = 'cliques'   in cliques,    # consider or ignore cliques
+    )
+
+
+def textflow_params (pass_id, rg_id, labez = '', hyp_a = 'A', connectivity = 10,
+                     mode = 'sim', fragments = False, var_only = False):
+    """Return the parameters of the textflow queries.
+
+    Add the parameter `exclude` before running :data:`NODES_SQL`.
 
-    labez        = request.args.get ('labez') or ''
-    hyp_a        = request.args.get ('hyp_a') or 'A'
-    connectivity = int (request.args.get ('connectivity') or 10)
-    width        = float (request.args.get ('width') or 0.0)
-    fontsize     = float (request.args.get ('fontsize') or 10.0)
-    mode         = request.args.get ('mode') or 'sim'
-
-    include      = request.args.getlist ('include[]')   or []
-    fragments    = request.args.getlist ('fragments[]') or []
-    checks       = request.args.getlist ('checks[]') or []
-    var_only     = request.args.getlist ('var_only[]')  or []
-    cliques      = request.args.getlist ('cliques[]')   or []
-
-    fragments = 'fragments' in fragments
-    checks    = 'checks'    in checks
-    var_only  = 'var_only'  in var_only   # Panel: Coherence at Variant Passages (GraphViz)
-    cliques   = 'cliques'   in cliques    # consider or ignore cliques
-    leaf_z    = 'Z'         in include    # show leaf z nodes in global textflow?
+    """
 
     view = 'affinity_view' if mode == 'rec' else 'affinity_p_view'
 
@@ -108,207 +181,392 @@ def textflow (passage_or_id):
     if not rank_z:
         z_where = "AND app.labez !~ '^z' AND app.certainty = 1.0"
 
+    return dict (parameters, pass_id = pass_id, rg_id = rg_id, labez = labez, hyp_a = hyp_a,
+                 connectivity = connectivity, view = view, labez_where = labez_where,
+                 frag_where = frag_where, z_where = z_where)
+
+
+def textflow_graph (conn, passage, rg_id, labez = '', hyp_a = 'A', connectivity = 10,
+                    mode = 'sim', include = (), fragments = False, checks = False,
+                    var_only = False, cliques = False):
+    """Build the textflow graph of a passage.
+
+    With the default arguments this is the global textflow.
+
+    """
+
+    params = textflow_params (passage.pass_id, rg_id, labez, hyp_a, connectivity,
+                              mode, fragments, var_only)
+    params['exclude'] = list (get_excluded_ms_ids (conn, include))
+
+    res = execute (conn, NODES_SQL, params)
+    nodes = { row[0] for row in res }
+    if not nodes:
+        nodes = { -1 } # a non-existing id
+
+    res = execute (conn, RANKS_SQL, dict (params, nodes = list (nodes)))
+    ranks = list (map (Ranks._make, res))
+
+    ms_ids = { r.ms_id1 for r in ranks } | { r.ms_id2 for r in ranks } | nodes
+    res = execute (conn, MSS_SQL, dict (params, ms_ids = list (ms_ids)))
+    mss = list (map (Mss._make, res))
+
+    congruent = congruence (conn, passage) if checks else ()
+
+    return build_textflow_graph (ranks, mss, labez, hyp_a, include, var_only, cliques, congruent)
+
+
+def build_textflow_graph (ranks, mss, labez = '', hyp_a = 'A', include = (),
+                          var_only = False, cliques = False, congruent = ()):
+    """Build the textflow graph from the results of the textflow queries.
+
+    :param list ranks: The :data:`RANKS_SQL` rows as :class:`Ranks`.
+    :param list mss: The :data:`MSS_SQL` rows as :class:`Mss`.
+    :param list congruent: The congruence violations to draw in bold, see
+        :func:`checks.congruence`.
+
+    """
+
+    leaf_z = 'Z' in include   # show leaf z nodes in global textflow?
+
+    global_textflow = not ((labez != '') or var_only)
+
     group_field = 'labez_clique' if cliques else 'labez'
 
+    # Initially build an unconnected graph with one node for each
+    # manuscript.  We will connect the nodes later.  Finally we will remove
+    # unconnected nodes.
+
+    graph = nx.DiGraph ()
+
+    for ms in mss:
+        attrs = {}
+        attrs['hs']           = ms.hs
+        attrs['hsnr']         = ms.hsnr
+        attrs['labez']        = ms.labez if ms.certainty == 1.0 else 'zw ' + ms.labez
+        attrs['clique']       = ms.clique
+        attrs['labez_clique'] = ms.labez_clique if ms.certainty == 1.0 else 'zw ' + ms.labez_clique
+        attrs['ms_id']        = ms.ms_id
+        attrs['label']        = ms.hs
+        attrs['certainty']    = ms.certainty
+        attrs['clickable']    = '1'
+        if ms.ms_id == 1 and hyp_a != 'A':
+            attrs['labez']        = hyp_a[0]
+            attrs['clique']       = ''
+            attrs['labez_clique'] = hyp_a[0]
+        # FIXME: attrs['shape'] = SHAPES.get (attrs['labez'], SHAPES['a'])
+        graph.add_node (ms.ms_id, **attrs)
+
+    # Connect the nodes
+    #
+    # Step 1: If the node has internal parents, keep only the top-ranked
+    # internal parent.
+    #
+    # Step 2: If the node has no internal parents, keep the top-ranked
+    # parents for each external attestation.
+    #
+    # Assumption: ranks are sorted top-ranked first
+
+    def is_z_node (n):
+        labez = n['labez']
+        cert  = n['certainty']
+        return (labez[0] == 'z') or (cert < 1.0)
+
+    tags = set ()
+    for step in (1, 2):
+        for r in ranks:
+            a1 = graph.nodes[r.ms_id1]
+            if not r.ms_id2 in graph.nodes:
+                continue
+            a2 = graph.nodes[r.ms_id2]
+            if not (global_textflow) and is_z_node (a2):
+                # disregard zz / zw
+                continue
+            if step == 1 and a1[group_field] != a2[group_field]:
+                # differing attestations are handled in step 2
+                continue
+            if r.ms_id1 in tags:
+                # an ancestor of this node that lays within the node's
+                # attestation was already seen.  we need not look into other
+                # attestations
+                continue
+            if str (r.ms_id1) + a2[group_field] in tags:
+                # an ancestor of this node that lays within this attestation
+                # was already seen.  we need not look into further nodes
+                continue
+            # add a new parent
+            if r.rank > 1:
+                graph.add_edge (r.ms_id2, r.ms_id1, rank = r.rank, headlabel = r.rank)
+            else:
+                graph.add_edge (r.ms_id2, r.ms_id1)
+
+            if a1[group_field] == a2[group_field]:
+                # tag: has ancestor node within the same attestation
+                tags.add (r.ms_id1)
+            else:
+                # tag: has ancestor node with this other attestation
+                tags.add (str (r.ms_id1) + a2[group_field])
+
+    if not leaf_z:
+        remove_z_leaves (graph)
+
+    # the if clause fixes #83
+    graph.remove_nodes_from ([n for n in nx.isolates (graph)
+                              if graph.nodes[n]['labez'] != labez])
+
+    if var_only:
+        # Panel: Coherence at Variant Passages (GraphViz)
+        #
+        # if one predecessor is within the same attestation then remove all
+        # other predecessors that are not within the same attestation
+        for n in graph:
+            within = False
+            attestation_n = graph.nodes[n][group_field]
+            for p in graph.predecessors (n):
+                if graph.nodes[p][group_field] == attestation_n:
+                    within = True
+                    break
+            if within:
+                for p in graph.predecessors (n):
+                    if graph.nodes[p][group_field] != attestation_n:
+                        graph.remove_edge (p, n)
+
+        # remove edges between nodes within the same attestation
+        for u, v in list (graph.edges ()):
+            if graph.nodes[u][group_field] == graph.nodes[v][group_field]:
+                graph.remove_edge (u, v)
+
+        # remove now isolated nodes
+        graph.remove_nodes_from (list (nx.isolates (graph)))
+
+        # unconstrain backward edges (yields a better GraphViz layout)
+        for u, v in graph.edges ():
+            if graph.nodes[u][group_field] > graph.nodes[v][group_field]:
+                graph.adj[u][v]['constraint'] = 'false'
+
+    else:
+        for n in graph:
+            # Use a different label if the parent's labez_clique differs from this
+            # node's labez_clique.
+            pred = list (graph.predecessors (n))
+            attrs = graph.nodes[n]
+            if not pred:
+                attrs['label'] = "%s: %s" % (attrs['labez_clique'], attrs['hs'])
+            for p in pred:
+                if attrs['labez_clique'] != graph.nodes[p]['labez_clique']:
+                    attrs['label'] = "%s: %s" % (attrs['labez_clique'], attrs['hs'])
+                    graph.adj[p][n]['style'] = 'dashed'
+
+    for rank in congruent:
+        try:
+            graph.adj[rank.ms_id1][rank.ms_id2]['style'] = 'bold'
+        except KeyError:
+            pass
+
+    return graph
+
+
+def textflow (passage_or_id, cached = None):
+    """Output a stemma of manuscripts.
+
+    Uses the precomputed graph if `cached` is given, see :func:`cached_textflow`.
+
+    """
+
+    a = textflow_args (request.args)
+
+    if cached is not None:
+        return helpers.body_to_dot (cached.graph.split ('\n') if cached.graph else [],
+                                    a.width, a.fontsize)
+
     with current_app.config.dba.engine.begin () as conn:
         passage = Passage (conn, passage_or_id)
         rg_id   = passage.request_rg_id (request)
 
-        exclude = get_excluded_ms_ids (conn, include)
+        graph = textflow_graph (conn, passage, rg_id, a.labez, a.hyp_a, a.connectivity, a.mode,
+                                a.include, a.fragments, a.checks, a.var_only, a.cliques)
 
-        # nodes query
-        #
-        # get all nodes or all nodes (hypothetically) attesting labez
+    return textflow_dot_source (graph, a)
 
-        res = execute (conn, """
-        SELECT ms_id
-        FROM apparatus app
-        WHERE pass_id = :pass_id AND ms_id NOT IN :exclude {labez_where} {z_where}
-        """, dict (parameters, exclude = exclude,
-                   pass_id = passage.pass_id, labez = labez,
-                   hyp_a = hyp_a, labez_where = labez_where, z_where = z_where))
-
-        nodes = { row[0] for row in res }
-        if not nodes:
-            nodes = { -1 } # avoid SQL syntax error
-
-        # rank query
-        #
-        # query to get the closest ancestors for every node with rank <= connectivity
-
-        query = """
-        SELECT ms_id1, ms_id2, rank
-        FROM (
-          SELECT ms_id1, ms_id2, rank () OVER (PARTITION BY ms_id1
-             ORDER BY affinity DESC, common, older, newer DESC, ms_id2) AS rank
-          FROM {view} a
-          WHERE ms_id1 IN :nodes AND a.rg_id = :rg_id AND ms_id2 NOT IN :exclude
-            AND newer > older {frag_where}
-        ) AS r
-        WHERE rank <= :connectivity
-        ORDER BY rank
-        """
-
-        res = execute (conn, query,
-                       dict (parameters, nodes = tuple (nodes), exclude = exclude,
-                             rg_id = rg_id, pass_id = passage.pass_id, view = view,
-                             labez = labez, connectivity = connectivity,
-                             frag_where = frag_where, hyp_a = hyp_a))
-
-        Ranks = collections.namedtuple ('Ranks', 'ms_id1 ms_id2 rank')
-        ranks = list (map (Ranks._make, res))
-
-        # Initially build an unconnected graph with one node for each
-        # manuscript.  We will connect the nodes later.  Finally we will remove
-        # unconnected nodes.
-
-        graph = nx.DiGraph ()
-
-        dest_nodes = { r.ms_id1 for r in ranks }
-        src_nodes  = { r.ms_id2 for r in ranks }
+
+def textflow_dot_source (graph, a):
+    """ Convert a textflow graph into a dot file according to the :class:`TextflowArgs`. """
+
+    if a.var_only:
+        group_field = 'labez_clique' if a.cliques else 'labez'
+        return helpers.nx_to_dot_subgraphs (graph, group_field, a.width, a.fontsize)
+    return helpers.nx_to_dot (graph, a.width, a.fontsize)
+
+
+CachedTextflow = collections.namedtuple ('CachedTextflow', 'graph dot width fontsize')
+
+def cached_textflow (passage_or_id):
+    """Return the precomputed global textflow if the request asks for one.
+
+    Only the global textflow with the default options over the whole book is
+    precomputed.  Returns None if the request asks for something else or if
+    the textflow is not precomputed yet.
+
+    """
+
+    args = request.args
+    mode = args.get ('mode') or 'sim'
+    if not current_app.config['TEXTFLOW_CACHE'] or mode not in TEXTFLOW_CACHE_MODES:
+        return None
+    if args.get ('labez') or (args.get ('hyp_a') or 'A') != 'A':
+        return None
+    for arg in ('include[]', 'fragments[]', 'checks[]', 'var_only[]', 'cliques[]'):
+        if args.getlist (arg):
+            return None
+
+    with current_app.config.dba.engine.begin () as conn:
+        passage = Passage (conn, passage_or_id)
+        if passage.request_rg_id (request) != passage.range_id ('All'):
+            return None
 
         res = execute (conn, """
-        SELECT ms.ms_id, ms.hs, ms.hsnr, a.labez, a.clique, a.labez_clique, a.certainty
-        FROM apparatus_view_agg a
-        JOIN manuscripts ms USING (ms_id)
-        WHERE pass_id = :pass_id AND ms_id IN :ms_ids
-        """, dict (parameters,
-                   ms_ids = tuple (src_nodes | dest_nodes | nodes),
-                   pass_id = passage.pass_id))
-
-        Mss = collections.namedtuple ('Mss', 'ms_id hs hsnr labez clique labez_clique certainty')
-        mss = list (map (Mss._make, res))
-
-        for ms in mss:
-            attrs = {}
-            attrs['hs']           = ms.hs
-            attrs['hsnr']         = ms.hsnr
-            attrs['labez']        = ms.labez if ms.certainty == 1.0 else 'zw ' + ms.labez
-            attrs['clique']       = ms.clique
-            attrs['labez_clique'] = ms.labez_clique if ms.certainty == 1.0 else 'zw ' + ms.labez_clique
-            attrs['ms_id']        = ms.ms_id
-            attrs['label']        = ms.hs
-            attrs['certainty']    = ms.certainty
-            attrs['clickable']    = '1'
-            if ms.ms_id == 1 and hyp_a != 'A':
-                attrs['labez']        = hyp_a[0]
-                attrs['clique']       = ''
-                attrs['labez_clique'] = hyp_a[0]
-            # FIXME: attrs['shape'] = SHAPES.get (attrs['labez'], SHAPES['a'])
-            graph.add_node (ms.ms_id, **attrs)
-
-        # Connect the nodes
-        #
-        # Step 1: If the node has internal parents, keep only the top-ranked
-        # internal parent.
-        #
-        # Step 2: If the node has no internal parents, keep the top-ranked
-        # parents for each external attestation.
-        #
-        # Assumption: ranks are sorted top-ranked first
-
-        def is_z_node (n):
-            labez = n['labez']
-            cert  = n['certainty']
-            return (labez[0] == 'z') or (cert < 1.0)
-
-        tags = set ()
-        for step in (1, 2):
-            for r in ranks:
-                a1 = graph.nodes[r.ms_id1]
-                if not r.ms_id2 in graph.nodes:
-                    continue
-                a2 = graph.nodes[r.ms_id2]
-                if not (global_textflow) and is_z_node (a2):
-                    # disregard zz / zw
-                    continue
-                if step == 1 and a1[group_field] != a2[group_field]:
-                    # differing attestations are handled in step 2
-                    continue
-                if r.ms_id1 in tags:
-                    # an ancestor of this node that lays within the node's
-                    # attestation was already seen.  we need not look into other
-                    # attestations
-                    continue
-                if str (r.ms_id1) + a2[group_field] in tags:
-                    # an ancestor of this node that lays within this attestation
-                    # was already seen.  we need not look into further nodes
-                    continue
-                # add a new parent
-                if r.rank > 1:
-                    graph.add_edge (r.ms_id2, r.ms_id1, rank = r.rank, headlabel = r.rank)
-                else:
-                    graph.add_edge (r.ms_id2, r.ms_id1)
-
-                if a1[group_field] == a2[group_field]:
-                    # tag: has ancestor node within the same attestation
-                    tags.add (r.ms_id1)
-                else:
-                    # tag: has ancestor node with this other attestation
-                    tags.add (str (r.ms_id1) + a2[group_field])
-
-        if not leaf_z:
-            remove_z_leaves (graph)
-
-        # the if clause fixes #83
-        graph.remove_nodes_from ([n for n in nx.isolates (graph)
-                                  if graph.nodes[n]['labez'] != labez])
-
-        if var_only:
-            # Panel: Coherence at Variant Passages (GraphViz)
-            #
-            # if one predecessor is within the same attestation then remove all
-            # other predecessors that are not within the same attestation
-            for n in graph:
-                within = False
-                attestation_n = graph.nodes[n][group_field]
-                for p in graph.predecessors (n):
-                    if graph.nodes[p][group_field] == attestation_n:
-                        within = True
-                        break
-                if within:
-                    for p in graph.predecessors (n):
-                        if graph.nodes[p][group_field] != attestation_n:
-                            graph.remove_edge (p, n)
-
-            # remove edges between nodes within the same attestation
-            for u, v in list (graph.edges ()):
-                if graph.nodes[u][group_field] == graph.nodes[v][group_field]:
-                    graph.remove_edge (u, v)
-
-            # remove now isolated nodes
-            graph.remove_nodes_from (list (nx.isolates (graph)))
-
-            # unconstrain backward edges (yields a better GraphViz layout)
-            for u, v in graph.edges ():
-                if graph.nodes[u][group_field] > graph.nodes[v][group_field]:
-                    graph.adj[u][v]['constraint'] = 'false'
-
-        else:
-            for n in graph:
-                # Use a different label if the parent's labez_clique differs from this
-                # node's labez_clique.
-                pred = list (graph.predecessors (n))
-                attrs = graph.nodes[n]
-                if not pred:
-                    attrs['label'] = "%s: %s" % (attrs['labez_clique'], attrs['hs'])
-                for p in pred:
-                    if attrs['labez_clique'] != graph.nodes[p]['labez_clique']:
-                        attrs['label'] = "%s: %s" % (attrs['labez_clique'], attrs['hs'])
-                        graph.adj[p][n]['style'] = 'dashed'
+        SELECT graph, dot, width, fontsize
+        FROM textflow_cache
+        WHERE (pass_id, mode) = (:pass_id, :mode)
+          AND generation >= COALESCE ((SELECT generation
+                                       FROM table_generation
+                                       WHERE table_name = 'affinity'), 0)
+        """, dict (parameters, pass_id = passage.pass_id, mode = mode))
+
+        row = res.fetchone ()
+
+    if row is None:
+        metrics.cache_miss ('textflow')
+        return None
+    metrics.cache_hit ('textflow')
+    return CachedTextflow._make (row)
+
+
+def fill_textflow_cache_batch (config, failed = None):
+    """Precompute some global textflows.
+
+    Computes the textflows that are missing or stale in the textflow_cache
+    table.  A textflow that cannot be computed is logged and added to the set
+    `failed` as 'pass_id/mode'.  The textflows in `failed` are not tried again.
+    Returns the no. of textflows written or failed.
+
+    Every passage is computed in its own transaction that holds a share lock
+    on the passage.  :func:`ntg_common.db_tools.invalidate_textflow_cache`
+    locks the passage before it deletes the rows, so an edit either waits for
+    the row to be written and then deletes it, or the passage is skipped.  The
+    rows are tagged with the generation of the affinity table this transaction
+    sees, not with the generation counter, which also counts uncommitted
+    changes.
 
-        if checks:
-            for rank in congruence (conn, passage):
+    """
+
+    width    = helpers.clip (10.0, config['TEXTFLOW_CACHE_WIDTH'],    1600.0)
+    fontsize = helpers.clip ( 6.0, config['TEXTFLOW_CACHE_FONTSIZE'],   72.0)
+    failed   = set () if failed is None else failed
+
+    with config.dba.engine.connect () as conn:
+        # only one process per database
+        res = execute (conn, """
+        SELECT pg_try_advisory_lock (:key)
+        """, dict (parameters, key = TEXTFLOW_CACHE_LOCK))
+        if not res.fetchone ()[0]:
+            return 0
+
+        try:
+            with conn.begin ():
+                res = execute (conn, """
+                SELECT p.pass_id, m.mode
+                FROM passages p
+                  CROSS JOIN unnest (:modes) AS m (mode)
+                  LEFT JOIN textflow_cache c
+                    ON (c.pass_id, c.mode) = (p.pass_id, m.mode)
+                      AND c.generation >= COALESCE ((SELECT generation
+                                                     FROM table_generation
+                                                     WHERE table_name = 'affinity'), 0)
+                WHERE c.pass_id IS NULL
+                  AND p.pass_id || '/' || m.mode != ALL (:failed)
+                ORDER BY p.pass_id, m.mode
+                LIMIT :limit
+                """, dict (parameters, modes = list (TEXTFLOW_CACHE_MODES),
+                           failed = list (failed), limit = TEXTFLOW_CACHE_BATCH))
+                todo = res.fetchall ()
+
+            done = 0
+            for pass_id, mode in todo:
                 try:
-                    graph.adj[rank.ms_id1][rank.ms_id2]['style'] = 'bold'
-                except KeyError:
-                    pass
+                    with conn.begin ():
+                        done += fill_textflow_cache_row (conn, pass_id, mode, width, fontsize)
+                except Exception as e:
+                    log (logging.ERROR, 'Cannot precompute the textflow of passage %d mode %s: %s' % (
+                        pass_id, mode, e))
+                    failed.add ('%d/%s' % (pass_id, mode))
+                    done += 1
+        finally:
+            execute (conn, """
+            SELECT pg_advisory_unlock (:key)
+            """, dict (parameters, key = TEXTFLOW_CACHE_LOCK))
 
-    if var_only:
-        dot = helpers.nx_to_dot_subgraphs (graph, group_field, width, fontsize)
-    else:
-        dot = helpers.nx_to_dot (graph, width, fontsize)
-    return dot
+    return done
+
+
+def fill_textflow_cache_row (conn, pass_id, mode, width, fontsize):
+    """Precompute one global textflow.
+
+    Returns the no. of rows written, 0 if the passage is being edited.
+
+    """
+
+    # skip the passage if it is being edited
+    res = execute (conn, """
+    SELECT pass_id
+    FROM passages
+    WHERE pass_id = :pass_id
+    FOR SHARE SKIP LOCKED
+    """, dict (parameters, pass_id = pass_id))
+    if res.fetchone () is None:
+        return 0
+
+    generation = get_table_generation (conn, 'affinity') or 0
+
+    passage = Passage (conn, pass_id)
+    graph   = textflow_graph (conn, passage, passage.range_id ('All'), mode = mode)
+    body    = helpers.nx_to_dot_body (graph)
+    with metrics.timer ('ntg_graphviz_seconds', format = 'dot'):
+        dot = tools.graphviz_layout (helpers.body_to_dot (body, width, fontsize))
+    dot = dot.decode ('utf-8') if dot else None
+
+    res = execute (conn, """
+    INSERT INTO textflow_cache (pass_id, mode, graph, dot, width, fontsize, generation)
+    VALUES (:pass_id, :mode, :graph, :dot, :width, :fontsize, :generation)
+    ON CONFLICT (pass_id, mode) DO UPDATE
+    SET graph = EXCLUDED.graph, dot = EXCLUDED.dot, width = EXCLUDED.width,
+        fontsize = EXCLUDED.fontsize, generation = EXCLUDED.generation
+    """, dict (parameters, pass_id = pass_id, mode = mode, graph = '\n'.join (body),
+               dot = dot, width = width, fontsize = fontsize,
+               generation = generation))
+    return res.rowcount
+
+
+def fill_textflow_cache (app):
+    """Precompute the global textflows of all passages.
+
+    Runs forever in a background thread.  Looks for more work every
+    :data:`TEXTFLOW_CACHE_INTERVAL` seconds.  The textflows that failed are
+    tried again after all others are done.
+
+    """
+
+    failed = set ()
+    with app.app_context ():
+        while True:
+            try:
+                done = fill_textflow_cache_batch (app.config, failed)
+            except Exception as e:
+                log (logging.ERROR, 'Cannot precompute the textflows: %s' % e)
+                done = 0
+            if done == 0:
+                failed.clear ()
+                time.sleep (TEXTFLOW_CACHE_INTERVAL)
 
 
 @bp.route ('/textflow.dot/<passage_or_id>')
@@ -317,8 +575,16 @@ def textflow_dot (passage_or_id):
 
     auth ()
 
-    dot = textflow (passage_or_id)
-    dot = tools.graphviz_layout (dot)
+    cached = cached_textflow (passage_or_id)
+    if cached is not None and cached.dot is not None:
+        width    = helpers.clip (10.0, request.args.get ('width')    or 0.0,  1600.0)
+        fontsize = helpers.clip ( 6.0, request.args.get ('fontsize') or 10.0,   72.0)
+        if (cached.width, cached.fontsize) == (width, fontsize):
+            return make_dot_response (cached.dot)
+
+    dot = textflow (passage_or_id, cached)
+    with metrics.timer ('ntg_graphviz_seconds', format = 'dot'):
+        dot = tools.graphviz_layout (dot)
     return make_dot_response (dot)
 
 
@@ -328,8 +594,9 @@ def textflow_png (passage_or_id):
 
     auth ()
 
-    dot = textflow (passage_or_id)
-    png = tools.graphviz_layout (dot, format = 'png')
+    dot = textflow (passage_or_id, cached_textflow (passage_or_id))
+    with metrics.timer ('ntg_graphviz_seconds', format = 'png'):
+        png = tools.graphviz_layout (dot, format = 'png')
     return make_png_response (png)
 
 
@@ -373,7 +640,8 @@ def stemma_dot (passage_or_id):
     auth ()
 
     dot = stemma (passage_or_id)
-    dot = tools.graphviz_layout (dot)
+    with metrics.timer ('ntg_graphviz_seconds', format = 'dot'):
+        dot = tools.graphviz_layout (dot)
     return make_dot_response (dot)
 
 
@@ -384,5 +652,6 @@ def stemma_png (passage_or_id):
     auth ()
 
     dot = stemma (passage_or_id)
-    png = tools.graphviz_layout (dot, format = 'png')
+    with metrics.timer ('ntg_graphviz_seconds', format = 'png'):
+        png = tools.graphviz_layout (dot, format = 'png')
     return make_png_response (png)
@@ -0,0 +1,148 @@
+# -*- encoding: utf-8 -*-
+
+"""An application server for CBGM.  Warm-up and readiness.
+
+A freshly started server would do a lot of expensive work on the first
+requests.  If :attr:`WARMUP` is set, every app is warmed up in a background
+thread right after it was created:
+
+- the connections of its database pool are opened,
+- the tables and indexes listed in :data:`WARMUP_TABLES` are read into the
+  PostgreSQL buffer cache, and
+- the set cover matrices and the snapshot of the affinity table are loaded.
+
+The tables and indexes are read with the pg_prewarm extension if it is
+installed in the database, else only the tables are read by a sequential scan.
+
+The endpoint :file:`/ready` answers with 200 once all apps are warmed up and
+with 503 before.  Use it as the readiness probe of the server.
+
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import flask
+
+from ntg_common.db_tools import execute
+from ntg_common.tools import log
+
+import comparison
+import set_cover
+from helpers import make_json_response
+
+
+bp = flask.Blueprint ('warmup', __name__)
+
+WARMUP_TABLES = (
+    'passages', 'readings', 'cliques', 'manuscripts', 'apparatus', 'ms_cliques',
+    'locstem', 'apparatus_view_agg_mat', 'affinity', 'congruence', 'textflow_cache',
+)
+""" The tables read into the buffer cache, together with their indexes. """
+
+states = collections.OrderedDict ()
+""" The state of the warm-up of every app by name: 'warming', 'ready' or 'failed'. """
+
+lock = threading.Lock ()
+
+
+def set_state (name, state):
+    with lock:
+        states[name] = state
+
+
+def open_connections (engine, n):
+    """ Open `n` connections of the pool, so that the first requests need not wait. """
+
+    conns = []
+    try:
+        for _i in range (n):
+            conns.append (engine.connect ())
+    finally:
+        for conn in conns:
+            conn.close ()
+
+
+def prewarm (conn):
+    """ Read the tables in :data:`WARMUP_TABLES` and their indexes into the buffer cache. """
+
+    res = execute (conn, """
+    SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm')
+    """, {})
+    has_prewarm = res.fetchone ()[0]
+
+    res = execute (conn, """
+    SELECT t.oid::regclass::text, i.indexrelid::regclass::text
+    FROM unnest (:tables) AS n (name)
+      JOIN pg_class t ON t.oid = to_regclass (n.name)
+      LEFT JOIN pg_index i ON i.indrelid = t.oid
+    ORDER BY 1, 2
+    """, dict (tables = list (WARMUP_TABLES)))
+    rows = res.fetchall ()
+
+    tables  = list (collections.OrderedDict.fromkeys (table for table, _index in rows))
+    indexes = [ index for _table, index in rows if index is not None ]
+
+    for relation in tables + (indexes if has_prewarm else []):
+        if has_prewarm:
+            execute (conn, "SELECT pg_prewarm (:relation)", dict (relation = relation))
+        else:
+            execute (conn, "SELECT count (*) FROM {relation}", dict (relation = relation))
+
+
+def warm_up (app):
+    """ Warm up one app. """
+
+    config = app.config
+    name   = config['APPLICATION_NAME']
+    start  = time.perf_counter ()
+
+    try:
+        open_connections (config.dba.engine, int (config['POOL_SIZE']))
+        if 'main' in app.blueprints:
+            with config.dba.engine.begin () as conn:
+                prewarm (conn)
+            with app.app_context ():
+                set_cover.get_val ()
+                comparison.get_affinity (wait = True)
+    except Exception as e:
+        log (logging.ERROR, 'Cannot warm up {name}: {e}'.format (name = name, e = e))
+        set_state (name, 'failed')
+        return
+
+    log (logging.INFO, 'Warmed up {name} in {t:.1f}s'.format (
+        name = name, t = time.perf_counter () - start))
+    set_state (name, 'ready')
+
+
+def init_app (app):
+    """ Initialize the flask app.  Start its warm-up. """
+
+    name = app.config['APPLICATION_NAME']
+
+    if not app.config['WARMUP']:
+        set_state (name, 'ready')
+        return
+
+    set_state (name, 'warming')
+    threading.Thread (target = warm_up, args = (app, ),
+                      name = 'warmup', daemon = True).start ()
+
+
+@bp.route ('/ready')
+def ready ():
+    """Endpoint.  Answer 200 if all apps are warmed up, else 503.
+
+    An app whose warm-up failed counts as ready, because it can still serve.
+
+    """
+
+    with lock:
+        data = dict (states)
+
+    status = 503 if 'warming' in data.values () else 200
+    response = make_json_response (data, status, 'ready' if status == 200 else 'warming up')
+    response.headers['Cache-Control'] = 'no-store'
+    return response